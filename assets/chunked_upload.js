@@ -0,0 +1,175 @@
+// 分片上传文件选择框里的文件，服务器接口见 easy_finance/utils/chunked_upload.py
+//
+// 1. 先计算整个文件的 sha256，同一个批次里的同一个文件在服务器上对应同一个上传，
+//    已经上传完的文件直接跳过，上传了一部分的文件从服务器已经收到的位置继续上传
+// 2. 每个分片附带 sha256，服务器校验失败时重新发送这个分片
+// 3. 网络错误和服务器 5xx 错误按指数退避重试，重试前向服务器查询已经收到的位置
+//
+// crypto.subtle 只能在 https 或者 localhost 下使用，不能使用时不做校验，刷新页面后也不能续传
+(function () {
+  const CONCURRENCY = 3; // 同时上传的文件数量
+  const MAX_RETRIES = 6; // 每个分片的最大重试次数
+  const CHECKSUM_MISMATCH = 460;
+
+  const hasCrypto = !!(window.crypto && window.crypto.subtle);
+
+  function sleep(ms) {
+    return new Promise((resolve) => setTimeout(resolve, ms));
+  }
+
+  async function sha256(data) {
+    return new Uint8Array(await window.crypto.subtle.digest("SHA-256", data));
+  }
+
+  function toHex(bytes) {
+    return Array.from(bytes, (byte) => byte.toString(16).padStart(2, "0")).join(
+      ""
+    );
+  }
+
+  function toBase64(bytes) {
+    return btoa(String.fromCharCode(...bytes));
+  }
+
+  async function readJson(response) {
+    try {
+      return await response.json();
+    } catch (e) {
+      return {};
+    }
+  }
+
+  // 网络错误和 5xx 错误时重试，其他响应直接返回给调用方处理
+  async function request(url, options) {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const response = await fetch(url, options);
+        if (response.status < 500 || attempt >= MAX_RETRIES) {
+          return response;
+        }
+      } catch (e) {
+        if (attempt >= MAX_RETRIES) {
+          throw e;
+        }
+      }
+      await sleep(Math.min(1000 * 2 ** attempt, 30000));
+    }
+  }
+
+  async function uploadFile(file, options) {
+    const digest = hasCrypto ? toHex(await sha256(await file.arrayBuffer())) : "";
+    let response = await request(options.endpoint, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        batch_id: options.batchId,
+        mode: options.mode,
+        file_name: file.name,
+        size: file.size,
+        sha256: digest,
+      }),
+    });
+    let body = await readJson(response);
+    if (!response.ok) {
+      throw new Error(body.detail || response.statusText);
+    }
+    if (body.completed) {
+      return "skipped";
+    }
+
+    const url = `${options.endpoint}/${body.id}`;
+    let offset = body.offset;
+    let failures = 0;
+    while (offset < file.size) {
+      const chunk = await file
+        .slice(offset, offset + options.chunkSize)
+        .arrayBuffer();
+      const headers = {
+        "Content-Type": "application/offset+octet-stream",
+        "Upload-Offset": String(offset),
+      };
+      if (hasCrypto) {
+        headers["Upload-Checksum"] = "sha256 " + toBase64(await sha256(chunk));
+      }
+
+      try {
+        response = await fetch(url, { method: "PATCH", headers, body: chunk });
+        body = await readJson(response);
+      } catch (e) {
+        response = null;
+      }
+
+      if (response && response.ok) {
+        offset = body.offset;
+        failures = 0;
+        continue;
+      }
+      if (response && response.status === 409 && body.offset != null) {
+        // 上一次请求其实已经写入了，从服务器收到的位置继续
+        offset = body.offset;
+        continue;
+      }
+      const retryable =
+        !response ||
+        response.status >= 500 ||
+        response.status === CHECKSUM_MISMATCH ||
+        (response.status === 400 && body.offset != null);
+      if (!retryable || ++failures > MAX_RETRIES) {
+        throw new Error((body && body.detail) || "网络错误");
+      }
+      await sleep(Math.min(1000 * 2 ** failures, 30000));
+      if (response && body.offset != null) {
+        offset = body.offset;
+      } else {
+        // 没有收到响应，不知道这个分片有没有写入，先查询服务器收到的位置
+        const status = await request(url, { method: "GET" });
+        const statusBody = await readJson(status);
+        if (!status.ok) {
+          throw new Error(statusBody.detail || status.statusText);
+        }
+        offset = statusBody.offset;
+      }
+    }
+    return "uploaded";
+  }
+
+  // 上传文件选择框里的所有文件，返回 {uploaded, skipped, failed}，failed 是失败原因的列表
+  window.easyFinanceUpload = async function (inputId, options) {
+    const input = document.getElementById(inputId);
+    const files = Array.from((input && input.files) || []);
+    const progress = document.getElementById(options.progressId);
+    const result = { uploaded: 0, skipped: 0, failed: [] };
+    let next = 0;
+
+    function showProgress() {
+      if (progress) {
+        const done = result.uploaded + result.skipped + result.failed.length;
+        progress.textContent = `上传进度：${done}/${files.length}`;
+      }
+    }
+
+    async function worker() {
+      while (next < files.length) {
+        const file = files[next++];
+        try {
+          if (file.size > options.maxBytes) {
+            throw new Error(
+              `超过 ${Math.floor(options.maxBytes / 1024 / 1024)}mb`
+            );
+          }
+          result[await uploadFile(file, options)] += 1;
+        } catch (e) {
+          result.failed.push(`文件「${file.name}」上传失败：${e.message}`);
+        }
+        showProgress();
+      }
+    }
+
+    showProgress();
+    await Promise.all(Array.from({ length: CONCURRENCY }, worker));
+    if (input) {
+      input.value = ""; // 同样的文件可以再次选择
+    }
+    return result;
+  };
+})();
@@ -1,2 +1,2 @@
-from .pages import upload, index, recognize, display
+from .pages import upload, index, recognize, display, rules, statement
 from .utils import bank_slip, invoice, log, request_api
@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+from .settings import settings
+from .utils.folder_recognize import DB_BATCH_SIZE, recognize_folder
+from .utils.job_queue import job_queue
+from .utils.ocr_provider import get_ocr_router
+from .utils.storage import storage_manager
+from .utils.watch_folder import FolderWatcher
+
+"""
+命令行入口，安装后可以直接运行 easy-finance，需要在项目根目录（rxconfig.py 所在目录）运行：
+
+    easy-finance recognize ./2024-09 --mode bank_slip --export 2024-09.xlsx
+    easy-finance watch /mnt/scanner --workers
+    easy-finance sweep
+"""
+
+
+def mode_error(mode: str) -> str | None:
+    """没有服务商支持识别模式时返回错误信息"""
+    if get_ocr_router().supports_mode(mode):  # type:ignore
+        return None
+    if mode == "auto":
+        return "auto 模式需要配置腾讯云的密钥（TENCENT_SECRET_ID、TENCENT_SECRET_KEY），或者用 --mode 指定票据类型"
+    return f"没有配置支持 {mode} 模式的 OCR 服务商的密钥"
+
+
+def run_recognize(args: argparse.Namespace) -> int:
+    directory = Path(args.directory)
+    if not directory.is_dir():
+        print(f"文件夹不存在：{directory}")
+        return 2
+    error = mode_error(args.mode)
+    if error:
+        print(error)
+        return 2
+    if not args.workers and not asyncio.run(job_queue.has_workers()):
+        print(
+            "没有运行中的网页后端处理识别任务，请先启动网页后端，或者加上 --workers 在这个进程里识别"
+        )
+        return 2
+
+    result = asyncio.run(
+        recognize_folder(
+            directory,
+            mode=args.mode,
+            manifest_path=Path(args.manifest) if args.manifest else None,
+            max_pending=args.max_pending,
+            save_to_db=not args.no_db,
+            export_path=Path(args.export) if args.export else None,
+            recursive=not args.no_recursive,
+            batch_size=args.batch_size,
+            run_workers=args.workers,
+        )
+    )
+
+    print(
+        f"共 {result.total} 个文件：识别 {result.recognized} 个，"
+        f"之前已经识别 {result.resumed} 个，失败 {result.failed} 个"
+    )
+    if not args.no_db:
+        print(
+            f"保存了 {result.journals_saved} 条流水（跳过 {result.duplicates} 条重复的流水）、"
+            f"{result.invoices_saved} 张发票，自动对账匹配了 {result.matched} 笔"
+        )
+    for path in result.exported:
+        print(f"导出文件：{path}")
+    for error in result.errors:
+        print(f"识别失败：{error}")
+    return 1 if result.failed else 0
+
+
+async def watch(watcher: FolderWatcher, workers: bool) -> None:
+    if workers:
+        await asyncio.gather(watcher.run(), job_queue.run())
+    else:
+        await watcher.run()
+
+
+def run_watch(args: argparse.Namespace) -> int:
+    if not args.directory:
+        print("请指定扫描文件夹，或者配置 WATCH_DIR")
+        return 2
+    error = mode_error(args.mode)
+    if error:
+        print(error)
+        return 2
+
+    watcher = FolderWatcher(
+        Path(args.directory), mode=args.mode, max_pending=args.max_pending
+    )
+    try:
+        asyncio.run(watch(watcher, args.workers))
+    except KeyboardInterrupt:
+        pass
+    print(f"提交了 {watcher.submitted} 个扫描文件")
+    return 0
+
+
+def run_sweep(args: argparse.Namespace) -> int:
+    if args.restore:
+        try:
+            path = storage_manager.restore_file(args.restore)
+        except FileNotFoundError:
+            print(f"回收站里没有这个文件：{args.restore}")
+            return 2
+        print(f"已恢复：{path}")
+        return 0
+
+    result = storage_manager.sweep()
+    print(
+        f"新登记 {result.discovered} 个文件，确认被引用 {result.referenced} 个，"
+        f"移到回收站 {result.trashed} 个，删除 {result.deleted} 个，"
+        f"释放 {result.freed_bytes / 1024 / 1024:.1f}mb"
+    )
+    print(f"上传目录和回收站共占用 {result.usage_bytes / 1024 / 1024:.1f}mb")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="easy-finance", description="Easy Finance 命令行工具"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    recognize_parser = subparsers.add_parser(
+        "recognize",
+        help="批量识别文件夹里的票据",
+        description="批量识别文件夹里的票据，中断后重新运行会跳过已经处理过的文件",
+    )
+    recognize_parser.add_argument("directory", help="票据所在的文件夹")
+    recognize_parser.add_argument(
+        "--mode",
+        choices=["bank_slip", "invoice", "auto"],
+        default="auto",
+        help="识别模式，auto 表示由服务商自动判断票据类型",
+    )
+    recognize_parser.add_argument(
+        "--manifest", default=None, help="进度清单的路径，默认保存在识别的文件夹里"
+    )
+    recognize_parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=settings.watch_max_pending,
+        help="任务队列里最多有多少个还没有识别完的文件",
+    )
+    recognize_parser.add_argument(
+        "--workers",
+        action="store_true",
+        help="在这个进程里识别文件，只在网页后端没有运行时使用，"
+        "否则没有配置 REDIS_URL 时请求速度会超过服务商的 QPS 配额",
+    )
+    recognize_parser.add_argument(
+        "--export", default=None, help="把识别结果导出为 .xlsx 或 .csv 文件"
+    )
+    recognize_parser.add_argument(
+        "--no-db", action="store_true", help="不把识别结果写入数据库"
+    )
+    recognize_parser.add_argument(
+        "--no-recursive", action="store_true", help="不识别子文件夹里的文件"
+    )
+    recognize_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DB_BATCH_SIZE,
+        help="每次写入数据库的识别结果数量",
+    )
+    recognize_parser.set_defaults(handler=run_recognize)
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="监听扫描文件夹",
+        description="监听扫描文件夹，把新文件提交到识别任务队列，识别结果在 upload 页面导入",
+    )
+    watch_parser.add_argument(
+        "directory",
+        nargs="?",
+        default=settings.watch_dir,
+        help="扫描文件夹，默认是 WATCH_DIR",
+    )
+    watch_parser.add_argument(
+        "--mode",
+        choices=["bank_slip", "invoice", "auto"],
+        default=settings.watch_mode,
+        help="识别模式",
+    )
+    watch_parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=settings.watch_max_pending,
+        help="任务队列里最多有多少个还没有识别完的扫描文件",
+    )
+    watch_parser.add_argument(
+        "--workers",
+        action="store_true",
+        help="在这个进程里识别文件，网页后端没有运行时使用（需要和网页后端使用同一个 JOB_DB_PATH）",
+    )
+    watch_parser.set_defaults(handler=run_watch)
+
+    sweep_parser = subparsers.add_parser(
+        "sweep",
+        help="清理上传目录",
+        description="把超过保留期限、没有被流水和发票引用的上传文件压缩后移到回收站",
+    )
+    sweep_parser.add_argument(
+        "--restore", default=None, help="从回收站恢复一个文件，参数是上传目录里的文件名"
+    )
+    sweep_parser.set_defaults(handler=run_sweep)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.cli recognize <文件夹>
+    sys.exit(main())
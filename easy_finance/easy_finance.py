@@ -1,5 +1,11 @@
 import reflex as rx
 
+from .utils.chunked_upload import router as chunked_upload_router
+from .utils.counterparty import warm_counterparty_cache
+from .utils.job_queue import job_queue
+from .utils.storage import storage_manager
+from .utils.watch_folder import watch_folder
+
 """
 TODO:
 
@@ -23,3 +29,11 @@ app = rx.App(
         scaling="100%",
     )
 )
+
+app.register_lifespan_task(job_queue.run)  # 启动后台识别任务的 worker
+app.register_lifespan_task(warm_counterparty_cache)  # 预热交易对象的别名缓存
+app.register_lifespan_task(watch_folder)  # 配置了 WATCH_DIR 时监听扫描文件夹
+app.register_lifespan_task(storage_manager.run)  # 定期清理上传目录
+
+# 分片上传的接口，见 utils/chunked_upload.py
+app.api.include_router(chunked_upload_router)
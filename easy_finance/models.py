@@ -1,8 +1,12 @@
 import reflex as rx
-from sqlmodel import Field, select
+from sqlalchemy import update
+from sqlmodel import Field, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import datetime, date
 from typing import Annotated
 
+from . import db
+
 
 class User(rx.Model, table=True):
     id: Annotated[int | None, Field(primary_key=True)] = None
@@ -12,7 +16,7 @@ class User(rx.Model, table=True):
 
 
 def create_users(users: list[User]):
-    with rx.session() as session:
+    with db.session() as session:
         for user in users:
             session.add(user)
         session.commit()
@@ -26,44 +30,188 @@ def create_users(users: list[User]):
     return userid_list
 
 
+class TableVersion(rx.Model, table=True):
+    """每张表的数据版本，表里的数据发生变化时版本号加一，用于判断导出文件等缓存是否失效"""
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    table_name: Annotated[str, Field(unique=True)]
+    version: int = 0
+
+
+def bump_table_version(session: Session, table_name: str) -> None:
+    """在修改数据的 session 里把表的版本号加一，和数据修改一起提交
+
+    Args:
+        session (Session): 修改数据的 session
+        table_name (str): 表名
+    """
+    result = session.execute(
+        update(TableVersion)
+        .where(TableVersion.table_name == table_name)  # type:ignore
+        .values(version=TableVersion.version + 1)
+    )
+    if result.rowcount == 0:  # type:ignore
+        session.add(TableVersion(table_name=table_name, version=1))
+
+
+async def abump_table_version(session: AsyncSession, table_name: str) -> None:
+    """bump_table_version 的异步版本，用于 db.asession()"""
+    result = await session.execute(
+        update(TableVersion)
+        .where(TableVersion.table_name == table_name)  # type:ignore
+        .values(version=TableVersion.version + 1)
+    )
+    if result.rowcount == 0:  # type:ignore
+        session.add(TableVersion(table_name=table_name, version=1))
+
+
+def get_table_version(table_name: str) -> int:
+    """获取表的当前版本号，表还没有修改过时返回 0"""
+    with db.session() as session:
+        version = session.exec(
+            select(TableVersion.version).where(TableVersion.table_name == table_name)
+        ).first()
+    return version or 0
+
+
+async def aget_table_version(table_name: str) -> int:
+    """get_table_version 的异步版本"""
+    async with db.asession() as session:
+        version = (
+            await session.exec(
+                select(TableVersion.version).where(
+                    TableVersion.table_name == table_name
+                )
+            )
+        ).first()
+    return version or 0
+
+
 class JournalAccount(rx.Model, table=True):
+    # SQLite 默认会复用被删除的最大 id，归档后新流水可能拿到归档流水的 id，
+    # 发票的 journal_id 会指向错误的流水，见 utils.archive.ensure_autoincrement
+    __table_args__ = {"sqlite_autoincrement": True}
+
     id: Annotated[int | None, Field(primary_key=True)] = None
     trade_date: Annotated[date, Field(index=True)]  # 交易发生的时间
     description: Annotated[str, Field(index=True)] = ""  # 关于这笔流水的说明
     additional_info: Annotated[str, Field(index=True)] = ""  # 备注
     amount: str  # 金额
     category: Annotated[str, Field(index=True)] = ""  # 分类
-    payer: Annotated[str, Field(index=True)]  # 付款方
-    receiver: Annotated[str, Field(index=True)]  # 收款方
-    bank_slip_url: str = ""  # 银行回单文件链接
-    tax_invoice_url: str = ""  # 发票文件链接
+    payer: str  # 付款方，识别或者导入时的原始户名
+    receiver: str  # 收款方，识别或者导入时的原始户名
+    # 付款方和收款方对应的 Counterparty id
+    payer_id: Annotated[int | None, Field(index=True)] = None
+    receiver_id: Annotated[int | None, Field(index=True)] = None
+    # 银行回单和发票的文件链接，清理上传目录时按链接查找文件是否被引用，见 utils.storage
+    bank_slip_url: Annotated[str, Field(index=True)] = ""
+    tax_invoice_url: Annotated[str, Field(index=True)] = ""
     created_datetime: datetime = datetime.now()  # 记录生成时间
+    raw_response: bytes | None = None  # 压缩后的 OCR 原始返回值，用于重新解析
+    parser_version: int = 0  # 生成这条记录时的解析器版本
+    # 日期、金额、付款方和收款方标准化后的哈希值，用于查找重复流水，见 utils.dedup
+    fingerprint: Annotated[str, Field(index=True)] = ""
+    # 自动填写分类的 CategoryRule id，手动填写的分类为空，见 utils.categorize
+    category_rule_id: Annotated[int | None, Field(index=True)] = None
 
     @classmethod
-    def create_records(cls, records: list[dict]):
-        with rx.session() as session:
+    async def create_records(cls, records: list[dict]) -> list["JournalAccount"]:
+        async with db.asession() as session:
+            # 识别结果经过 json 序列化后日期是字符串，用 model_validate 转化为 date
+            new_records = [JournalAccount.model_validate(record) for record in records]
+            session.add_all(new_records)
+            await abump_table_version(session, cls.__tablename__)  # type:ignore
+            await session.commit()  # 提交时会写入自增的 id，asession 提交后实例不会过期
+            return new_records
 
-            new_records = []
+    @classmethod
+    async def get_all_records(cls) -> list[dict]:
+        async with db.asession() as session:
+            records = (await session.exec(select(JournalAccount))).all()
+            # 原始返回值是压缩后的二进制数据，不需要发送给前端
+            return [record.model_dump(exclude={"raw_response"}) for record in records]
 
-            for record in records:
-                new_record = JournalAccount(**record)
-                new_records.append(new_record)
-                session.add(new_record)
 
-            session.commit()
+class ArchivedPeriod(rx.Model, table=True):
+    """已经归档的会计年度，这一年的流水从 journalaccount 移到了单独的归档表，见 utils.archive"""
 
-            for record in new_records:
-                session.refresh(record)
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    year: Annotated[int, Field(unique=True)]  # 会计年度
+    table_name: str  # 归档表的表名
+    row_count: int = 0  # 归档的流水数量
+    archived_datetime: datetime = Field(default_factory=datetime.now)  # 归档时间
 
-            return new_records
 
-    @classmethod
-    def get_all_records(cls) -> list[dict]:
-        with rx.session() as session:
-            records = session.exec(select(JournalAccount)).all()
-            result = [record.model_dump() for record in records]
-            return result
+class Counterparty(rx.Model, table=True):
+    """交易对象，同一个公司的不同写法（包括 OCR 识别错误）都是它的别名，
+    流水通过 payer_id 和 receiver_id 引用交易对象，按交易对象分组和筛选时只需要比较整数"""
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    name: Annotated[str, Field(unique=True)]  # 标准名称
+    tax_id: Annotated[str, Field(index=True)] = ""  # 纳税人识别号
+    accounts: str = ""  # 银行账号，多个账号用英文逗号分隔
+    created_datetime: datetime = Field(default_factory=datetime.now)  # 记录生成时间
+
+
+class CounterpartyAlias(rx.Model, table=True):
+    """交易对象的别名，alias 是 utils.dedup.normalize_party 标准化后的户名"""
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    alias: Annotated[str, Field(unique=True)]
+    counterparty_id: Annotated[int, Field(index=True)]
+
+
+class CategoryRule(rx.Model, table=True):
+    """自动分类规则，设置了的条件全部满足时，流水的分类填写为 category
+
+    多条规则都满足时使用 priority 最小的规则，priority 相同时使用先创建的规则
+    """
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    name: str = ""  # 规则名称
+    category: str  # 满足条件时填写的分类
+    priority: int = 100  # 优先级，数字越小越优先
+    counterparty_id: Annotated[int | None, Field(index=True)] = (
+        None  # 付款方或收款方是这个交易对象
+    )
+    keyword: str = ""  # 项目描述里包含这个关键词
+    min_amount: str = ""  # 金额不小于这个值
+    max_amount: str = ""  # 金额不大于这个值
+    enabled: bool = True
+    created_datetime: datetime = Field(default_factory=datetime.now)  # 记录生成时间
+
+
+class TaxInvoice(rx.Model, table=True):
+    """识别后保存的增值税发票，用于和流水自动对账"""
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    invoice_date: Annotated[date | None, Field(index=True)] = None  # 开票日期
+    invoice_type: str = ""  # 发票类型
+    invoice_code: Annotated[str, Field(index=True)] = ""  # 发票号码
+    buyer_name: str = ""  # 购买方名称
+    seller_name: Annotated[str, Field(index=True)] = ""  # 销售方名称
+    price_included_tax: str = ""  # 价税合计
+    file_url: Annotated[str, Field(index=True)] = ""  # 发票文件链接
+    journal_id: Annotated[int | None, Field(index=True)] = None  # 匹配到的流水 id
+    match_score: float = 0  # 匹配得分，见 utils.reconcile
+    created_datetime: datetime = Field(default_factory=datetime.now)  # 记录生成时间
+
+
+class StoredFile(rx.Model, table=True):
+    """上传目录里的文件，用于清理没有被流水和发票引用的文件，见 utils.storage"""
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    name: Annotated[str, Field(unique=True)]  # 上传目录里的文件名
+    url: str  # 登记时的文件链接，和流水、发票里保存的链接相同
+    size: int = 0  # 文件大小（字节）
+    # 是否被流水或发票引用，被引用过的文件不会被清理
+    referenced: Annotated[bool, Field(index=True)] = False
+    created_datetime: Annotated[datetime, Field(index=True)]  # 文件的修改时间
+    # 压缩后移到回收站的时间，还在上传目录里时为空
+    trashed_datetime: Annotated[datetime | None, Field(index=True)] = None
 
 
 if __name__ == "__main__":
-    print(JournalAccount.get_all_records())
+    import asyncio
+
+    print(asyncio.run(JournalAccount.get_all_records()))
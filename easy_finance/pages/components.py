@@ -31,6 +31,7 @@ class NavBarState(rx.State):
     items: list[NavItem] = [
         NavItem(name="快捷记账", path="/"),
         NavItem(name="账目一览", path="/display"),
+        NavItem(name="分类规则", path="/rules"),
     ]
 
 
@@ -78,3 +79,36 @@ def nav_bar() -> rx.Component:
         bg=rx.color("slate", 2),
         class_name="flex flex-row justify-center items-center w-8/12 h-16 mt-2 rounded-full",
     )
+
+
+def chunked_upload_input(
+    input_id: str, progress_id: str, on_change: rx.EventHandler, loading: bool
+) -> rx.Component:
+    """分片上传的选择文件按钮，文件数量不受 MAX_UPLOAD_FILES 限制，网络中断后可以续传
+
+    Args:
+        input_id (str): 文件选择框的 id
+        progress_id (str): 显示上传进度的元素 id，由 assets/chunked_upload.js 更新
+        on_change (rx.EventHandler): 选择文件后调用的事件，由事件调用 chunked_upload.js 上传文件
+        loading (bool): 是否正在上传
+    """
+    return rx.hstack(
+        rx.script(src="/chunked_upload.js"),
+        rx.el.input(
+            type="file",
+            multiple=True,
+            accept=".jpg,.jpeg,.png,.bmp,.pdf",
+            id=input_id,
+            on_change=on_change,
+            display="none",
+        ),
+        rx.button(
+            "批量上传",
+            loading=loading,
+            on_click=rx.call_script(f"document.getElementById('{input_id}').click()"),
+            variant="outline",
+            color_scheme="gray",
+        ),
+        rx.text("", id=progress_id, size="1"),
+        align="center",
+    )
@@ -1,42 +1,104 @@
+import asyncio
+import json
+import uuid
+from datetime import date, datetime, timedelta
+
 import reflex as rx
+from reflex.utils.format import format_ref
 from reflex_ag_grid import ag_grid
-from ..models import JournalAccount
-from .upload import bank_slip_column_defs
+from reflex_ag_grid.ag_grid import AgGridAPI
+from .. import db
+from ..models import JournalAccount, abump_table_version
+from ..settings import settings
+from ..utils.change_feed import (
+    ChangeEvent,
+    client_connected,
+    publish_changes,
+    subscribe_changes,
+)
+from ..utils.counterparty import counterparty_cache
+from ..utils.dedup import FINGERPRINT_FIELDS, record_fingerprint
+from ..utils.export import (
+    ExportFilter,
+    ExportProgress,
+    download_file,
+    export_journal,
+    submit_export,
+)
+from ..utils.ingest import save_invoice_records
+from ..utils.job_queue import job_queue
+from ..utils.log import logger
+from ..utils.ocr_provider import OCRRecord
+from ..utils.query_cache import cached_journal_records
+from ..utils.request_api import save_upload_file
+from ..utils.storage import StorageQuotaError
+from .upload import MAX_UPLOAD_FILES, bank_slip_column_defs
 from sqlmodel import select
 
 """
 TODO:
-1. 加一个发票上传的功能，上传完以后自动将发票文件的链接拷贝到剪贴板，提示用户可以粘贴
-2. 
+1. 
 
 
 """
 
 
+EXPORT_PROGRESS_INTERVAL = 0.5  # 导出进度的刷新间隔（秒）
+GRID_ID = "ag_grid_basic_editing"
+
+# 用于把其他用户的修改直接应用到前端表格
+grid_api = AgGridAPI(ref=format_ref(GRID_ID))
+
+
 class DisplayState(rx.State):
     """
     向用户展示数据的 State
     """
 
     display_data: list[dict] = []  # 展示的数据
+    start_date: str = ""  # 展示的交易日期范围，为空时只展示还没有归档的流水
+    end_date: str = ""
+    exporting: bool = False  # 是否正在导出
+    export_total: int = 0  # 需要导出的行数
+    export_written: int = 0  # 已经导出的行数
+    # 表格里每一行流水的 id，顺序和前端表格相同，只保存在后端，用于处理单元格修改和其他用户的修改
+    _row_ids: list[int] = []
+    _archived_ids: set[int] = set()  # 表格里已经归档的流水的 id
+    _watching_sid: str = ""  # 正在订阅流水修改的 websocket 连接
 
-    @rx.var
+    @rx.var(cache=True)
     def data(self) -> list[dict]:
         """
-        Ag Grid 组件需要用 computed var 向前端传输数据，用 state var 数据更新会有延迟
+        Ag Grid 组件需要用 computed var 向前端传输数据，用 state var 数据更新会有延迟。
+        只在 display_data 重新加载时才发送给前端，之后的修改通过表格的 applyTransaction 增量更新
 
         Returns: 展示的数据
 
         """
         return self.display_data
 
-    def load_data(self) -> None:
+    async def load_data(self) -> None:
         """
-        用于在页面加载时从数据库中获取数据
+        用于在页面加载时从数据库中获取数据，日期范围包含已经归档的年度时会同时读取归档表，
+        开始日期为空时只读取还没有归档的流水。流水表没有变化时直接使用缓存的查询结果
         """
-        self.display_data = JournalAccount.get_all_records()
+        start_date = date.fromisoformat(self.start_date) if self.start_date else None
+        end_date = date.fromisoformat(self.end_date) if self.end_date else None
+        self.display_data = await cached_journal_records(start_date, end_date)
+        self._row_ids = [row["id"] for row in self.display_data]
+        self._archived_ids = {row["id"] for row in self.display_data if row["archived"]}
 
-    def cell_value_changed(self, row, col_field, new_value) -> None:
+    async def set_date_range(self, form_data: dict):
+        """
+        修改展示的日期范围并重新读取数据
+        Args:
+            form_data (dict): 表单数据，包括 start_date、end_date
+        """
+        self.start_date = form_data.get("start_date", "")
+        self.end_date = form_data.get("end_date", "")
+        await self.load_data()
+
+    async def cell_value_changed(self, row, col_field, new_value):
         """
         实时处理用户对表格内容的修改，并更新到数据库
         Args:
@@ -44,24 +106,325 @@ class DisplayState(rx.State):
             col_field: 修改单元格的列
             new_value: 单元格的更新值
         """
-        self.display_data[row][col_field] = new_value  # 获取更新数据
-        with rx.session() as session:
-            record = session.get(
-                JournalAccount, self.display_data[row]["id"]
+        row_id = self._row_ids[row]
+        if row_id in self._archived_ids:
+            await self.load_data()  # 撤销表格里的修改
+            yield rx.toast.error("已经归档的流水不能修改")
+            return
+
+        if col_field == "trade_date":
+            try:
+                # 表格里的日期是 UTC 时间的 ISO 格式，转换为北京时间的日期
+                utc_date = datetime.fromisoformat(new_value.replace("Z", "+00:00"))
+                new_value = (utc_date + timedelta(hours=8)).date()
+            except (ValueError, AttributeError):
+                await self.load_data()  # 撤销表格里的修改
+                yield rx.toast.error("交易日期不能为空")
+                return
+
+        # 前端表格里已经是修改后的值，不修改 display_data，避免把全部数据重新发送给前端
+        async with db.asession() as session:
+            record = await session.get(
+                JournalAccount, row_id
             )  # 通过id获取更新条目对应的数据库实例
             if record:
                 setattr(record, col_field, new_value)  # 修改数据库内的值
-                session.commit()
+                if col_field == "category":  # 手动填写的分类，重新分类时不会被覆盖
+                    record.category_rule_id = None
+                if col_field in ("payer", "receiver"):  # 户名修改后重新关联交易对象
+                    ids = await asyncio.to_thread(
+                        counterparty_cache.resolve_many, [new_value]
+                    )
+                    setattr(record, f"{col_field}_id", ids.get(new_value))
+                if (
+                    col_field in FINGERPRINT_FIELDS
+                ):  # 指纹用于查重，需要和修改后的值一致
+                    record.fingerprint = record_fingerprint(record.model_dump())
+                await abump_table_version(
+                    session, JournalAccount.__tablename__  # type:ignore
+                )
+                await session.commit()
+                await publish_changes(
+                    "update",
+                    [record.model_dump(exclude={"raw_response"})],
+                    origin=self.router.session.client_token,
+                )
 
         yield rx.toast(
             f"数据更新, 行: {row}, 列: {col_field}, 更新值: {new_value}"
         )  # 向用户发出提示
 
+    def in_date_range(self, row: dict) -> bool:
+        """新增的流水是否在当前展示的日期范围内，日期是 ISO 格式的字符串，可以直接比较"""
+        trade_date = str(row["trade_date"])
+        if self.start_date and trade_date < self.start_date:
+            return False
+        if self.end_date and trade_date > self.end_date:
+            return False
+        return True
+
+    async def apply_change(self, event: ChangeEvent) -> rx.event.EventSpec | None:
+        """
+        把其他用户的修改应用到当前用户的表格
+        Args:
+            event (ChangeEvent): 流水的修改
+
+        Returns:
+            rx.event.EventSpec | None: 更新前端表格的脚本，表格里没有相关的流水时为空
+        """
+        if event.action == "reload":
+            await self.load_data()
+            return None
+
+        known_ids = set(self._row_ids)
+        if event.action == "update":
+            rows = [row for row in event.rows if row["id"] in known_ids]
+            transaction = {"update": rows}
+        else:
+            rows = [
+                row
+                for row in event.rows
+                if row["id"] not in known_ids and self.in_date_range(row)
+            ]
+            self._row_ids.extend(row["id"] for row in rows)  # 新增的行在表格末尾
+            transaction = {"add": rows}
+
+        if not rows:
+            return None
+        return grid_api.apply_transaction(rx.Var(json.dumps(transaction)))
+
+    @rx.background
+    async def watch_changes(self):
+        """
+        订阅其他用户对流水的修改，只把修改的行发送给前端表格，用户断开连接或者刷新页面后停止
+        """
+        async with self:
+            token = self.router.session.client_token
+            sid = self.router.session.session_id
+            if self._watching_sid == sid:  # 同一个连接只订阅一次
+                return
+            self._watching_sid = sid
+
+        try:
+            async for event in subscribe_changes(lambda: client_connected(token, sid)):
+                if event.origin == token:
+                    continue
+                async with self:
+                    script = await self.apply_change(event)
+                if script:
+                    yield script
+        finally:
+            async with self:
+                if self._watching_sid == sid:
+                    self._watching_sid = ""
+
+    @rx.background
+    async def export_data(self, form_data: dict):
+        """按用户填写的条件把数据库里的流水导出为文件，
+        导出在线程池里执行，执行期间定时把进度同步到前端，
+        文件分批写入磁盘，前端通过下载链接获取，不经过 websocket
+
+        Args:
+            form_data (dict): 导出表单的数据，包括 start_date、end_date、category、file_format
+        """
+        async with self:
+            if self.exporting:  # 同一个用户同时只执行一个导出任务
+                return
+            self.exporting = True
+            self.export_total = 0
+            self.export_written = 0
+
+        progress = ExportProgress()
+        error = ""
+        try:
+            export_filter = ExportFilter(
+                start_date=(
+                    date.fromisoformat(form_data["start_date"])
+                    if form_data.get("start_date")
+                    else None
+                ),
+                end_date=(
+                    date.fromisoformat(form_data["end_date"])
+                    if form_data.get("end_date")
+                    else None
+                ),
+                category=form_data.get("category", "").strip(),
+                counterparty=form_data.get("counterparty", "").strip(),
+            )
+            future = submit_export(
+                export_journal,
+                form_data.get("file_format") or "xlsx",
+                export_filter,
+                progress=progress,
+            )
+            while not future.done():
+                await asyncio.wait([future], timeout=EXPORT_PROGRESS_INTERVAL)
+                async with self:
+                    self.export_total = progress.total
+                    self.export_written = progress.written
+            url = future.result()
+        except ValueError as e:
+            logger.error(f"导出失败：{e}")
+            error = str(e)
+        finally:
+            async with self:
+                self.exporting = False
+
+        if error:
+            yield rx.toast.error(f"导出失败：{error}")
+            return
+
+        yield download_file(url)
+
+
+class InvoiceState(rx.State):
+    """
+    上传发票的 State：发票识别完成后保存到数据库，并自动和流水对账，
+    匹配成功的流水会填上发票链接
+    """
+
+    batch_id: str = rx.LocalStorage(
+        "", name="invoice_batch_id"
+    )  # 当前批次的 id，存在浏览器里，刷新页面后可以继续处理
+    up_loading: bool = False
+    job_total: int = 0  # 当前批次的文件总数
+    job_finished: int = 0  # 当前批次已经处理完的文件数
+    tracking: bool = False  # 是否正在跟踪当前批次的进度
+
+    async def handle_upload(self, files: list[rx.UploadFile]):
+        """
+        保存用户上传的发票，并提交到后台任务队列，识别结果由 track_batch 处理
+        Args:
+            files: 用户上传的发票
+
+        """
+        if len(files) > MAX_UPLOAD_FILES:
+            yield rx.toast.error(
+                f"一次最多传{MAX_UPLOAD_FILES}个文件，你传了{len(files)}个"
+            )
+            return
+
+        self.up_loading = True
+        yield
+
+        try:
+            saved_files = []
+            for file in files:
+                upload_data = await file.read()
+                saved_files.append(
+                    (file.filename, save_upload_file(file.filename, upload_data))
+                )
+
+            if not self.batch_id:
+                self.batch_id = uuid.uuid4().hex
+
+            await job_queue.submit(self.batch_id, "invoice", saved_files)
+
+        except (TypeError, StorageQuotaError) as e:
+            yield rx.toast.error(f"系统报错：{e}")
+
+        finally:
+            self.up_loading = False
+
+        yield InvoiceState.track_batch
+
+    @rx.background
+    async def track_batch(self):
+        """
+        在后台轮询当前批次的处理进度，全部识别完成后保存发票并对账
+        """
+        async with self:
+            if self.tracking or not self.batch_id:
+                return
+            self.tracking = True
+            batch_id = self.batch_id
+
+        try:
+            while True:
+                progress = await job_queue.batch_progress(batch_id)
+                async with self:
+                    self.job_total = progress["total"]
+                    self.job_finished = progress["finished"]
+                if progress["finished"] >= progress["total"]:
+                    break
+                await asyncio.sleep(1)
+
+            records = [
+                OCRRecord.from_dict(job.result)
+                for job in progress["jobs"]
+                if job.status == "done"
+            ]
+            invoices = [record for record in records if record.result_type == "invoice"]
+            errors = [
+                f"文件「{job.file_name}」识别失败：{job.error}"
+                for job in progress["jobs"]
+                if job.status == "failed"
+            ]
+            invoice_ids, matched = await save_invoice_records(invoices)
+            await job_queue.store.delete_batch(batch_id)
+
+            async with self:
+                self.batch_id = ""
+                self.job_total = 0
+                self.job_finished = 0
+
+        finally:
+            async with self:
+                self.tracking = False
+
+        for error in errors:
+            yield rx.toast.error(error)
+        yield rx.toast.success(
+            f"保存了 {len(invoice_ids)} 张发票，自动匹配了 {matched} 笔流水",
+            duration=5000,
+        )
+        yield DisplayState.load_data
+
+
+def invoice_upload_zone() -> rx.Component:
+    return rx.upload(
+        rx.cond(
+            InvoiceState.up_loading | InvoiceState.tracking,
+            rx.hstack(
+                rx.spinner(size="2"),
+                rx.cond(
+                    InvoiceState.job_total > 0,
+                    rx.text(
+                        "发票识别进度：",
+                        InvoiceState.job_finished,
+                        "/",
+                        InvoiceState.job_total,
+                        size="1",
+                    ),
+                ),
+                align="center",
+            ),
+            rx.text("上传发票，自动匹配流水", size="1"),
+        ),
+        id="invoice_upload",
+        multiple=True,
+        max_size=settings.upload_max_bytes,
+        border="1px dotted",
+        class_name="rounded-md",
+        padding="8px",
+        accept={
+            "image/png": [".png"],
+            "image/jpeg": [".jpg", ".jpeg"],
+            "image/bmp": [".bmp"],
+            "application/pdf": [".pdf"],
+        },
+        on_drop=InvoiceState.handle_upload(
+            rx.upload_files(upload_id="invoice_upload")
+        ),  # type:ignore
+    )
+
 
 def ag_grid_zone() -> rx.Component:
     return ag_grid(
-        id="ag_grid_basic_editing",
+        id=GRID_ID,
         row_data=DisplayState.data,
+        # 按 id 定位行，用于增量更新，AG Grid 要求行的 id 是字符串
+        get_row_id=rx.Var("(params) => String(params.data.id)").to(rx.EventChain),
         column_defs=bank_slip_column_defs,
         on_cell_value_changed=DisplayState.cell_value_changed,
         width="90vw",
@@ -72,8 +435,72 @@ def ag_grid_zone() -> rx.Component:
     )
 
 
+def date_range_zone() -> rx.Component:
+    return rx.form(
+        rx.hstack(
+            rx.text("展示", size="1"),
+            rx.input(name="start_date", type="date"),
+            rx.text("至", size="1"),
+            rx.input(name="end_date", type="date"),
+            rx.button("查询", type="submit", variant="soft"),
+            rx.text("开始日期为空时只展示还没有归档的流水", size="1"),
+            spacing="2",
+            align="center",
+        ),
+        on_submit=DisplayState.set_date_range,
+    )
+
+
+def export_zone() -> rx.Component:
+    return rx.form(
+        rx.hstack(
+            rx.text("交易日期", size="1"),
+            rx.input(name="start_date", type="date"),
+            rx.text("至", size="1"),
+            rx.input(name="end_date", type="date"),
+            rx.input(name="category", placeholder="分类，留空导出全部"),
+            rx.input(name="counterparty", placeholder="交易对象，留空导出全部"),
+            rx.select(
+                ["xlsx", "csv", "parquet"],
+                name="file_format",
+                default_value="xlsx",
+            ),
+            rx.button(
+                "导出",
+                type="submit",
+                loading=DisplayState.exporting,
+            ),
+            rx.cond(
+                DisplayState.exporting & (DisplayState.export_total > 0),
+                rx.text(
+                    "导出进度：",
+                    DisplayState.export_written,
+                    "/",
+                    DisplayState.export_total,
+                    size="1",
+                ),
+            ),
+            spacing="2",
+            align="center",
+        ),
+        on_submit=DisplayState.export_data,
+    )
+
+
 @rx.page(
-    route="/display", title="财务数据展示-EasyFinance", on_load=DisplayState.load_data
+    route="/display",
+    title="财务数据展示-EasyFinance",
+    on_load=[
+        DisplayState.load_data,
+        DisplayState.watch_changes,  # 实时显示其他用户的修改
+        InvoiceState.track_batch,  # 刷新页面后继续处理之前上传的发票
+    ],
 )
 def display() -> rx.Component:
-    return rx.flex(ag_grid_zone(), justify="center", padding_top="2rem")
+    return rx.vstack(
+        rx.hstack(export_zone(), invoice_upload_zone(), spacing="4", align="center"),
+        date_range_zone(),
+        ag_grid_zone(),
+        align="center",
+        padding_top="2rem",
+    )
@@ -1,11 +1,9 @@
-import os
-
 import reflex as rx
 
+from ..settings import settings
 from .components import nav_bar
-from .upload import upload_and_send
-
-PASSWORD = os.getenv("PASSWORD")
+from .statement import statement_import_zone
+from .upload import UploadState, upload_and_send
 
 
 class PassState(rx.State):
@@ -22,7 +20,7 @@ class PassState(rx.State):
         Returns:
             None | rx.Component: 如果密码正确不返回值，如果密码错误,在前端显示一个小提示
         """
-        if value["password"] == PASSWORD:
+        if value["password"] == settings.password:
             self.check = True
         else:
             self.check = False
@@ -37,6 +35,7 @@ meta = [{"name": "keywords", "content": "发票,银行回单,图片,PDF,识别,
     title="快捷记账-EasyOffice",
     description="自动识别银行回单，并导入到数据库",
     meta=meta,
+    on_load=UploadState.track_batch,  # 刷新页面后继续获取之前上传文件的识别结果
 )
 def index() -> rx.Component:
     """主页面"""
@@ -46,6 +45,7 @@ def index() -> rx.Component:
             rx.vstack(
                 nav_bar(),
                 upload_and_send(),  # 上传银行回单、识别、将结果上传到数据库
+                statement_import_zone(),  # 导入银行导出的对账单，不需要识别
                 width="100vw",
                 spacing="1",
                 align="center",
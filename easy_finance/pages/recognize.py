@@ -1,149 +1,26 @@
 import asyncio
-import io
-import time
-from base64 import b64encode
-from datetime import datetime
-from typing import Generator
+import copy
+import uuid
 
-import polars as pl
 import reflex as rx
 
 
+from ..utils.chunked_upload import upload_script
+from ..utils.export import download_file, export_rows_to_xlsx, submit_export
+from ..utils.job_queue import job_queue
 from ..utils.log import logger
-from ..utils.request_api import request_api
-
-# 银行回单的表头
-BANK_SLIP_COLUMNS: list[dict[str, str]] = [
-    {
-        "title": "文件名",
-        "id": "file_name",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "转账日期",
-        "id": "trans_date",
-        "type": "str",
-        "width": 100,
-    },
-    {
-        "title": "付款人名称",
-        "id": "buyer_name",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "付款人账号",
-        "id": "buyer_account",
-        "type": "str",
-        "width": 250,
-    },
-    {
-        "title": "付款人开户行",
-        "id": "buyer_bank",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "收款人名称",
-        "id": "seller_name",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "收款人账号",
-        "id": "seller_account",
-        "type": "str",
-        "width": 250,
-    },
-    {
-        "title": "收款人开户银行",
-        "id": "seller_bank",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "转账金额",
-        "id": "trans_amount",
-        "type": "str",
-        "width": 100,
-    },
-]
-
-
-# 发票的表头
-INVOICE_COLUMNS: list[dict[str, str]] = [
-    {
-        "title": "文件名",
-        "id": "file_name",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "开票日期",
-        "id": "invoice_date",
-        "type": "str",
-        "width": 100,
-    },
-    {
-        "title": "发票类型",
-        "id": "invoice_type",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "发票号码",
-        "id": "invoice_code",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "购买方名称",
-        "id": "buyer_name",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "购买方统一社会信用代码",
-        "id": "buyer_code",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "销售方名称",
-        "id": "seller_name",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "销售方统一社会信用代码",
-        "id": "seller_code",
-        "type": "str",
-        "width": 200,
-    },
-    {
-        "title": "税额",
-        "id": "tax_amount",
-        "type": "str",
-        "width": 50,
-    },
-    {
-        "title": "不含税价格",
-        "id": "price_excluded_tax",
-        "type": "str",
-        "width": 100,
-    },
-    {
-        "title": "价税合计",
-        "id": "price_included_tax",
-        "type": "str",
-        "width": 100,
-    },
-]
+from ..utils.ocr_provider import OCRRecord
+from ..utils.records import BankSlipRow, InvoiceRow, RecognizedRow
+from ..utils.request_api import save_upload_file
+from ..utils.storage import StorageQuotaError
+from .components import chunked_upload_input
+from .upload import MAX_UPLOAD_FILES
 
+CHUNKED_INPUT_ID = "recognize-chunked"  # 分片上传的文件选择框 id
+CHUNKED_PROGRESS_ID = "recognize-chunked-progress"
 
 test_invoice = [
-    [
+    InvoiceRow(
         "¥27.25.pdf",
         "2024-04-20",
         "电子发票(普通发票)",
@@ -155,8 +32,8 @@ test_invoice = [
         "3.13",
         "24.12",
         "27.25",
-    ],
-    [
+    ),
+    InvoiceRow(
         "¥29.60.pdf",
         "2024-05-25",
         "电子发票(普通发票)",
@@ -168,11 +45,11 @@ test_invoice = [
         "3.41",
         "26.19",
         "29.60",
-    ],
+    ),
 ]
 
 test_bank_slip = [
-    [
+    BankSlipRow(
         "北京银行.jpeg",
         "2024-09-03",
         "银联商务股份有限公司",
@@ -182,8 +59,8 @@ test_bank_slip = [
         "未识别",
         "北京银行密云支行",
         "6229.00",
-    ],
-    [
+    ),
+    BankSlipRow(
         "91491726191886_.pic.jpg",
         "2024-09-13",
         "北京有一家科技有限公司",
@@ -193,17 +70,13 @@ test_bank_slip = [
         "866182028512344123121",
         "招商银行股份有限公司上海浦东支行",
         "10000.00",
-    ],
+    ),
 ]
 
-bank_slip_data_now = [[]]
-
-invoice_data_now = [[]]
-
 
 class UploadFile(rx.State):
-    bank_slips_data: rx.Field[list[list[str]]] = rx.field([])  # 存储银行回单数据
-    invoice_data: rx.Field[list[list[str]]] = rx.field([])  # 存储发票数据
+    _bank_slips: list[BankSlipRow] = []  # 存储银行回单数据，只保存在后端
+    _invoices: list[InvoiceRow] = []  # 存储发票数据，只保存在后端
     upload_loading: rx.Field[bool] = rx.field(False)  # 判断 dropzone 是否等待的状态判断
     download_loading: rx.Field[bool] = rx.field(
         False
@@ -212,30 +85,38 @@ class UploadFile(rx.State):
     bank_slips_notification: rx.Field[bool] = rx.field(False)
     invoice_notification: rx.Field[bool] = rx.field(False)
     test_mode: rx.Field[bool] = rx.field(False)  # 测试模式，默认为 False
-    original_bank_slips_data: list[list[str]] = []  # 用于测试摸下保存原有数据
-    original_invoice_data: list[list[str]] = []  # 用于测试摸下保存原有数据
+    _original_bank_slips: list[BankSlipRow] = []  # 用于测试摸下保存原有数据
+    _original_invoices: list[InvoiceRow] = []  # 用于测试摸下保存原有数据
+    batch_id: str = rx.LocalStorage("")  # 当前批次的 id，刷新页面后可以继续获取识别结果
+    loaded_jobs: list[str] = []  # 已经加入表格或已经提示过错误的任务 id
+    tracking: bool = False  # 是否正在跟踪当前批次的进度
     # TODO 目前 Literal 类型存在 bug，等修复后将 mode 改为 Literal 类型
 
     # 将 state 需要经常用到的方法和属性抽象出一个配置列表，通过固定的方法获取当前 state 的识别，并执行相应的操作
     MODE_CONFIG = {
         "bank_slip": {
-            "data_attr": "bank_slips_data",
-            "columns": BANK_SLIP_COLUMNS,
+            "data_attr": "_bank_slips",
+            "row_type": BankSlipRow,
+            "columns": [column.to_data_editor() for column in BankSlipRow.COLUMNS],
             "notification_attr": "bank_slips_notification",
             "filename_tag": "银行回单",
         },
         "invoice": {
-            "data_attr": "invoice_data",
-            "columns": INVOICE_COLUMNS,
+            "data_attr": "_invoices",
+            "row_type": InvoiceRow,
+            "columns": [column.to_data_editor() for column in InvoiceRow.COLUMNS],
             "notification_attr": "invoice_notification",
             "filename_tag": "增值税发票",
         },
     }
 
+    def _current_rows(self) -> list[RecognizedRow]:
+        return getattr(self, self.MODE_CONFIG[self.mode]["data_attr"])
+
     @rx.var
     def get_current_data(self) -> list[list[str]]:
-        """获取当前 mode 选单下对应的数据"""
-        return getattr(self, self.MODE_CONFIG[self.mode]["data_attr"])
+        """获取当前 mode 选单下对应的数据，识别结果只在这里转化为前端表格使用的列表"""
+        return [row.to_list() for row in self._current_rows()]
 
     @rx.var
     def get_current_columns(self) -> list[list[str]]:
@@ -245,73 +126,50 @@ class UploadFile(rx.State):
     @rx.var
     def data_is_exists(self) -> bool:
         """这是一个 computed var，用于检查当前mode 选单下对应的 state var 是否存在数据，如果存在数据，则返回 True，否则返回 False。"""
-        return bool(self.invoice_data or self.bank_slips_data)
+        return bool(self._invoices or self._bank_slips)
 
     @rx.event
     def go_test(self, test_mode: bool):
         if test_mode:
             # 进入测试模式
             if not self.test_mode:  # 只在首次进入测试模式时保存原始数据
-                self.original_bank_slips_data = self.bank_slips_data.copy()
-                self.original_invoice_data = self.invoice_data.copy()
-            self.bank_slips_data = test_bank_slip
-            self.invoice_data = test_invoice
+                self._original_bank_slips = self._bank_slips.copy()
+                self._original_invoices = self._invoices.copy()
+            # 复制一份，用户在演示模式下编辑表格不会修改 test_bank_slip 和 test_invoice
+            self._bank_slips = [copy.copy(row) for row in test_bank_slip]
+            self._invoices = [copy.copy(row) for row in test_invoice]
         else:
             # 退出测试模式
-            self.bank_slips_data = self.original_bank_slips_data
-            self.invoice_data = self.original_invoice_data
+            self._bank_slips = self._original_bank_slips
+            self._invoices = self._original_invoices
 
         self.test_mode = test_mode
 
-    async def uni_request(self, file: rx.UploadFile) -> None:
-        """处理单个银行回单识别和发票识别的请求：
-        1. 将上传文件的文件名插入到识别结果的第一位
-        2. 识别新增数据的类型，并将数据插入到对应数据集
-        Args:
-            file (rx.UploadFile): 上传的文件
+    def add_record(self, file_name: str, record: OCRRecord) -> None:
+        """把一个识别结果插入到对应票据类型的数据集：
+        1. 将上传文件的文件名和识别结果转化为对应票据类型的一行
+        2. 将这一行插入到对应数据集
 
-        Returns:
-            list[str]: 插入文件名后的识别结果
+        Args:
+            file_name (str): 上传的文件名
+            record (OCRRecord): 识别结果
         """
-        try:
-            filename = file.filename  # 提取文件名
-            file_content = await file.read()
-            if not file_content:
-                raise ValueError(f"文件 {filename} 是空的")  # 检查文件内容是否正常上传
-            file_base64 = b64encode(file_content).decode(
-                "utf-8"
-            )  # 将接收的文件批量转化为base64编码
-            resp = await request_api(file_base64)
-            if not resp or "result_type" not in resp or "result_data" not in resp:
-                raise ValueError(
-                    f"API 返回了无效的响应: {resp}"
-                )  # 检查 API 是否正常返回内容
-            logger.info(f"正在处理文件：{filename}")
-            result_type: str = resp["result_type"]  # 获取文件类型
-            result_data: list[str] = resp["result_data"]  # 获取文件数据
-            result_data.insert(0, filename)  # 在文件数据中插入文件名
-            logger.info(
-                f"""文件「{filename}」处理结果\n
-                result_type：{result_type}\n
-                result_data:{result_data}"""
-            )
-            current_data: list[list[str]] = getattr(
-                self, self.MODE_CONFIG[result_type]["data_attr"]
-            )  # 获取当前文件类型对应的数据集
-
-            current_data.append(result_data)
-            setattr(
-                self, self.MODE_CONFIG[result_type]["data_attr"], current_data
-            )  # 将新增数据加入到数据集中
-
-            setattr(self, self.MODE_CONFIG[result_type]["notification_attr"], True)
-        except Exception as e:
-            logger.error(f"解析文件「{filename}」过程中遇到错误：{e}。")
-            raise ValueError(f"解析文件「{filename}」过程中遇到错误：{e}。")
+        config = self.MODE_CONFIG[record.result_type]
+        result_data = config["row_type"].from_record(file_name, record)
+        logger.info(
+            f"""文件「{file_name}」处理结果\n
+            result_type：{record.result_type}\n
+            result_data:{result_data}"""
+        )
+        # 获取当前文件类型对应的数据集，并将新增数据加入到数据集中
+        getattr(self, config["data_attr"]).append(result_data)
+
+        setattr(self, self.MODE_CONFIG[record.result_type]["notification_attr"], True)
 
     @rx.event
     async def handle_upload(self, files: list[rx.UploadFile]):
-        """用户上传文件后的处理函数，将文件转换为base64编码，将编码后的文件传递给相应的上游 api 处理，返回格式化后的处理结果
+        """用户上传文件后的处理函数，将文件保存后提交到后台任务队列，由服务商自动判断票据类型，
+        识别结果由 track_batch 获取
 
         Args:
             files (list[rx.UploadFile]): 文件列表，可以是一个文件也可以是多个文件
@@ -319,25 +177,116 @@ class UploadFile(rx.State):
         Returns:
             AsyncGenerator[None, Any]: 没有输出，只会通过 yield 更新两次页面状态，第一次是将 loading 设置为 True，第二次是将 loading 设置为 False。
         """
+        self.upload_loading = True  # 接收到文件后，更新 loading状态
+        self.test_mode = False
+        yield
 
-        # 批量调用 api 接口
+        saved_files = []
+        errors = []
         try:
-            self.upload_loading = True  # 接收到文件后，更新 loading状态
-            self.test_mode = False
-            yield
-            start_time = time.time()
-            tasks = [self.uni_request(file) for file in files]
-            await asyncio.gather(*tasks)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            logger.info(
-                f"函数 handle_upload 处理{len(files)}个文件,用时：{elapsed_time:.5f}s"
-            )  # 计算函数运行时间
-        except Exception as e:  # 检查异常
-            yield rx.window_alert(f"{e}\n其他文件将正常解析。")
+            for file in files:
+                try:
+                    file_content = await file.read()
+                    if not file_content:
+                        raise ValueError(
+                            f"文件 {file.filename} 是空的"
+                        )  # 检查文件内容是否正常上传
+                    saved_files.append(
+                        (file.filename, save_upload_file(file.filename, file_content))
+                    )
+                except (ValueError, TypeError, StorageQuotaError) as e:
+                    errors.append(f"解析文件「{file.filename}」过程中遇到错误：{e}。")
+
+            if saved_files:
+                if not self.batch_id:
+                    self.batch_id = uuid.uuid4().hex
+                await job_queue.submit(self.batch_id, "auto", saved_files)
         finally:
             self.upload_loading = False  # 文件上传结束，更新 loading 状态
 
+        if errors:
+            yield rx.window_alert("\n".join(errors) + "\n其他文件将正常解析。")
+
+        yield UploadFile.track_batch
+
+    @rx.event
+    def start_chunked_upload(self, _value: str):
+        """选择文件后由浏览器分片上传，每个文件上传完成后由服务器提交到后台任务队列"""
+        self.test_mode = False
+        if not self.batch_id:
+            self.batch_id = uuid.uuid4().hex
+        self.upload_loading = True
+        return rx.call_script(
+            upload_script(CHUNKED_INPUT_ID, self.batch_id, "auto", CHUNKED_PROGRESS_ID),
+            callback=UploadFile.finish_chunked_upload,
+        )
+
+    @rx.event
+    def finish_chunked_upload(self, result: dict):
+        """分片上传结束后提示上传失败的文件，并开始获取识别结果
+
+        Args:
+            result (dict): assets/chunked_upload.js 返回的上传结果
+        """
+        self.upload_loading = False
+        if result["failed"]:
+            yield rx.window_alert("\n".join(result["failed"]))
+        yield UploadFile.track_batch
+
+    @rx.background
+    async def track_batch(self):
+        """在后台轮询当前批次的处理进度，把新完成的识别结果加入对应的数据集"""
+        async with self:
+            if self.tracking or not self.batch_id:
+                return
+            self.tracking = True
+            batch_id = self.batch_id
+
+        try:
+            while True:
+                progress = await job_queue.batch_progress(batch_id)
+                errors = []
+
+                async with self:
+                    for job in progress["jobs"]:
+                        if job.id in self.loaded_jobs:
+                            continue
+                        self.loaded_jobs.append(job.id)
+                        if job.status == "done":
+                            self.add_record(
+                                job.file_name, OCRRecord.from_dict(job.result)
+                            )
+                        elif job.status == "failed":
+                            errors.append(
+                                f"解析文件「{job.file_name}」过程中遇到错误：{job.error}。"
+                            )
+
+                if errors:
+                    yield rx.window_alert("\n".join(errors))
+
+                if progress["finished"] >= progress["total"]:
+                    async with self:
+                        # 分片上传结束前还会有文件加入这个批次；普通上传在事件里提交任务，
+                        # 拿到锁后再检查一次任务数量，就不会漏掉刚刚加入的任务
+                        latest = await job_queue.batch_progress(batch_id)
+                        finished = (
+                            not self.upload_loading
+                            and latest["total"] == progress["total"]
+                        )
+                        if finished:
+                            # 识别结果已经全部加入数据集，清空当前批次
+                            self.batch_id = ""
+                            self.loaded_jobs = []
+                    if finished:
+                        await job_queue.store.delete_batch(batch_id)
+                        return
+
+                await asyncio.sleep(1)
+
+        finally:
+            async with self:
+                self.tracking = False
+
     @rx.event
     def get_edited_data(self, pos: tuple[int, int], val):
         """处理页面表格更新的函数，将更新的数据存储在对应选单的数据集中，这样用户编辑后页面的数据也能同步更新。
@@ -346,41 +295,41 @@ class UploadFile(rx.State):
             pos (tuple[int, int]): 表格的位置信息，是一个二维元组
             val (_type_): 用户输入位置的单元格对象，应该是 reflex 自定义的一个类，类似字典，val["data"] 是用户输入的值
         """
-        current_data = self.get_current_data
+        current_rows = self._current_rows()
         col, row = pos
-        current_data[row][col] = val["data"]
-        setattr(self, self.MODE_CONFIG[self.mode]["data_attr"], current_data)
+        edited = current_rows[row]
+        edited.set_cell(col, val["data"])
+        # 修改的是列表里的对象，需要重新赋值，state 才会知道数据集发生了变化
+        current_rows[row] = edited
 
-    @rx.event
-    def download_to_excel(self) -> Generator:
-        """将 bank_slips_date 或 invoice_data 内的信息下载为 excel 表
+    @rx.background
+    async def download_to_excel(self):
+        """将当前选单的识别结果下载为 excel 表，
+        excel 文件在导出线程池里生成，生成期间不会阻塞其他事件
 
         Yields:
-            Generator: yield 一个 rx.download 事件，将数据下载为 excel 表
+            yield 一个 rx.download 事件，将数据下载为 excel 表
         """
-        self.download_loading = True  # 将下载按钮的状态切换为 loading
-        yield
-
-        data = [
-            item for item in self.get_current_data
-        ]  # 获取当前选单的数据,要注意， 作为 state 的属性，他们并不是真正的列表，而是一个 reflex 定义的特殊对象（reflex.vars.sequence.ToArrayOperation），所以需要通过 item 的方式提取出来。
-
-        df = pl.DataFrame(
-            data,
-            schema=[
-                column["title"] for column in self.MODE_CONFIG[self.mode]["columns"]
-            ],
-            orient="row",
-        )
+        async with self:
+            self.download_loading = True  # 将下载按钮的状态切换为 loading
+            data = [
+                row.to_list() for row in self._current_rows()
+            ]  # 获取当前选单的数据，转化为导出 excel 使用的列表
+            file_tag = self.MODE_CONFIG[self.mode][
+                "filename_tag"
+            ]  # 文件名格式：增值税发票/银行回单-时间字符串
+            headers = self.MODE_CONFIG[self.mode]["row_type"].headers()
 
-        file_name = f"{self.MODE_CONFIG[self.mode]["filename_tag"]}-{datetime.now().strftime("%Y%m%d%H%M%S") }"  # 文件名格式：增值税发票/银行回单-时间字符串
-
-        buffer = io.BytesIO()  # 生成一个 BytesIO 对象，用于存储 excel 文件
-        df.write_excel(buffer)  # 将 excel 文件写入 BytesIO 对象
-
-        self.download_loading = False  # 文件准备结束，结束下载按钮的 loading 状态
+        try:
+            # 文件写入上传目录，前端通过下载链接获取，不用把整个文件通过 websocket 发送给前端
+            url = await submit_export(export_rows_to_xlsx, file_tag, headers, data)
+        finally:
+            async with self:
+                self.download_loading = (
+                    False  # 文件准备结束，结束下载按钮的 loading 状态
+                )
 
-        yield rx.download(data=buffer.getvalue(), filename=f"{file_name}.xlsx")
+        yield download_file(url)
 
     @rx.event
     def set_notification_false(self):
@@ -468,7 +417,7 @@ def upload_zone(
             "image/webp": [".webp"],
             "application/pdf": [".pdf"],
         },
-        max_files=10,
+        max_files=MAX_UPLOAD_FILES,
         disabled=is_loading,
         no_keyboard=True,
         on_drop=UploadFile.handle_upload(
@@ -635,6 +584,13 @@ def recognize_page() -> rx.Component:
     return rx.vstack(
         test_mode_for_recognize(),
         recognize_title(),
+        # 分片上传的按钮只放一个，桌面端和移动端共用，避免页面上出现重复的 id
+        chunked_upload_input(
+            CHUNKED_INPUT_ID,
+            CHUNKED_PROGRESS_ID,
+            UploadFile.start_chunked_upload,
+            UploadFile.upload_loading,
+        ),
         # ------------------ 桌面端显示----------------------
         rx.desktop_only(
             rx.hstack(
@@ -653,7 +609,7 @@ def recognize_page() -> rx.Component:
                         hint_text=[
                             "将发票或银行回单文件拖入框内",
                             "支持文件格式：.jpg、.jpeg、.png、.pdf",
-                            "一次最多上传10个文件，可分批多次上传",
+                            f"一次最多上传{MAX_UPLOAD_FILES}个文件，更多文件请点击“批量上传”",
                         ],
                     ),
                 ),
@@ -687,7 +643,7 @@ def recognize_page() -> rx.Component:
                         hint_text=[
                             "将发票或银行回单文件拖入框内",
                             "支持文件格式：.jpg、.jpeg、.png、.pdf",
-                            "一次最多上传10个文件，可分批多次上传",
+                            f"一次最多上传{MAX_UPLOAD_FILES}个文件，更多文件请点击“批量上传”",
                         ],
                     ),
                 ),
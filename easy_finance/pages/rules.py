@@ -0,0 +1,190 @@
+import asyncio
+
+import reflex as rx
+from sqlmodel import select
+
+from .. import db
+from ..models import CategoryRule
+from ..utils.categorize import (
+    delete_rule,
+    recategorize_ledger,
+    rule_hit_stats,
+    save_rule,
+)
+from ..utils.change_feed import publish_changes
+from ..utils.counterparty import counterparty_cache
+from .components import nav_bar
+from .upload import CATEGORY_OPTIONS
+
+
+class RuleState(rx.State):
+    """管理自动分类规则的 State"""
+
+    rules: list[dict] = []  # 所有规则，包括交易对象名称和命中的流水数量
+    recategorizing: bool = False  # 是否正在重新分类
+
+    async def load_rules(self) -> None:
+        """从数据库读取规则和每条规则命中的流水数量"""
+        hits = await rule_hit_stats()
+        async with db.asession() as session:
+            rules = (
+                await session.exec(
+                    select(CategoryRule).order_by(
+                        CategoryRule.priority, CategoryRule.id  # type:ignore
+                    )
+                )
+            ).all()
+        self.rules = [
+            {
+                **rule.model_dump(exclude={"created_datetime"}),
+                "counterparty": (
+                    counterparty_cache.get_name(rule.counterparty_id)
+                    if rule.counterparty_id is not None
+                    else ""
+                ),
+                "hits": hits.get(rule.id, 0),  # type:ignore
+            }
+            for rule in rules
+        ]
+
+    async def add_rule(self, form_data: dict):
+        """
+        新建规则
+        Args:
+            form_data (dict): 表单数据，包括 name、category、priority、counterparty、
+                keyword、min_amount、max_amount
+
+        """
+        counterparty = form_data.get("counterparty", "").strip()
+        try:
+            counterparty_ids = (
+                await asyncio.to_thread(counterparty_cache.resolve_many, [counterparty])
+                if counterparty
+                else {}
+            )
+            await asyncio.to_thread(
+                save_rule,
+                CategoryRule(
+                    name=form_data.get("name", "").strip(),
+                    category=form_data.get("category", "").strip(),
+                    priority=int(form_data.get("priority") or 100),
+                    counterparty_id=counterparty_ids.get(counterparty),
+                    keyword=form_data.get("keyword", "").strip(),
+                    min_amount=form_data.get("min_amount", "").strip(),
+                    max_amount=form_data.get("max_amount", "").strip(),
+                ),
+            )
+        except ValueError as e:
+            return rx.toast.error(f"保存规则失败：{e}")
+        await self.load_rules()
+
+    async def remove_rule(self, rule_id: int) -> None:
+        await asyncio.to_thread(delete_rule, rule_id)
+        await self.load_rules()
+
+    @rx.background
+    async def recategorize(self):
+        """用当前的规则重新给整个账本分类，在线程里执行，不阻塞事件循环"""
+        async with self:
+            if self.recategorizing:
+                return
+            self.recategorizing = True
+
+        try:
+            result = await asyncio.to_thread(recategorize_ledger)
+        finally:
+            async with self:
+                self.recategorizing = False
+                await self.load_rules()
+
+        if result.updated:
+            await publish_changes("reload")
+        yield rx.toast.success(
+            f"检查了 {result.scanned} 条流水，修改了 {result.updated} 条的分类",
+            duration=5000,
+        )
+
+
+def rule_form() -> rx.Component:
+    return rx.form(
+        rx.hstack(
+            rx.input(name="name", placeholder="规则名称"),
+            rx.select(CATEGORY_OPTIONS, name="category", placeholder="分类"),
+            rx.input(name="counterparty", placeholder="交易对象"),
+            rx.input(name="keyword", placeholder="项目描述关键词"),
+            rx.input(name="min_amount", placeholder="最小金额"),
+            rx.input(name="max_amount", placeholder="最大金额"),
+            rx.input(name="priority", placeholder="优先级，越小越优先", type="number"),
+            rx.button("新建规则", type="submit"),
+            spacing="2",
+            align="center",
+        ),
+        on_submit=RuleState.add_rule,
+        reset_on_submit=True,
+    )
+
+
+def render_rule(rule: dict) -> rx.Component:
+    return rx.table.row(
+        rx.table.cell(rule["priority"]),
+        rx.table.cell(rule["name"]),
+        rx.table.cell(rule["category"]),
+        rx.table.cell(rule["counterparty"]),
+        rx.table.cell(rule["keyword"]),
+        rx.table.cell(rule["min_amount"], " ~ ", rule["max_amount"]),
+        rx.table.cell(rule["hits"]),
+        rx.table.cell(
+            rx.button(
+                "删除",
+                size="1",
+                variant="soft",
+                color_scheme="red",
+                on_click=RuleState.remove_rule(rule["id"]),
+            )
+        ),
+    )
+
+
+def rule_table() -> rx.Component:
+    return rx.table.root(
+        rx.table.header(
+            rx.table.row(
+                *(
+                    rx.table.column_header_cell(title)
+                    for title in (
+                        "优先级",
+                        "名称",
+                        "分类",
+                        "交易对象",
+                        "关键词",
+                        "金额范围",
+                        "命中流水",
+                        "",
+                    )
+                )
+            )
+        ),
+        rx.table.body(rx.foreach(RuleState.rules, render_rule)),
+        width="90vw",
+    )
+
+
+@rx.page(
+    route="/rules",
+    title="分类规则-EasyFinance",
+    on_load=RuleState.load_rules,
+)
+def rules() -> rx.Component:
+    return rx.vstack(
+        nav_bar(),
+        rule_form(),
+        rx.button(
+            "按规则重新分类账本",
+            on_click=RuleState.recategorize,
+            loading=RuleState.recategorizing,
+        ),
+        rx.text("手动填写的分类不会被覆盖", size="1"),
+        rule_table(),
+        align="center",
+        spacing="3",
+    )
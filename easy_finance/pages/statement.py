@@ -0,0 +1,120 @@
+import asyncio
+import tempfile
+from pathlib import Path
+
+import reflex as rx
+
+from ..utils.change_feed import publish_changes
+from ..utils.log import logger
+from ..utils.statement import BANK_PROFILES, STATEMENT_EXTENSIONS, import_statement
+
+
+class StatementState(rx.State):
+    """导入银行对账单的 State"""
+
+    profile: str = "generic"  # 对账单格式，BANK_PROFILES 的 key
+    account_name: str = ""  # 对账单所属账户的户名
+    importing: bool = False
+
+    async def handle_upload(self, files: list[rx.UploadFile]):
+        """
+        导入用户上传的对账单，文件先保存到临时目录，导入在线程里执行，不阻塞事件循环
+        Args:
+            files: 用户上传的对账单
+
+        """
+        if not self.account_name.strip():
+            yield rx.toast.error("请先填写对账单所属账户的户名")
+            return
+
+        self.importing = True
+        yield
+
+        profile = BANK_PROFILES[self.profile]
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                for file in files:
+                    path = Path(temp_dir) / f"statement{Path(file.filename).suffix}"
+                    path.write_bytes(await file.read())
+
+                    try:
+                        result = await asyncio.to_thread(
+                            import_statement, path, profile, self.account_name.strip()
+                        )
+                    except (TypeError, ValueError) as e:
+                        logger.error(f"导入对账单「{file.filename}」失败：{e}")
+                        yield rx.toast.error(f"「{file.filename}」导入失败：{e}")
+                        continue
+
+                    if result.inserted:
+                        await publish_changes("reload")
+                    yield rx.toast.success(
+                        f"「{file.filename}」共 {result.total} 笔交易，"
+                        f"导入 {result.inserted} 笔，"
+                        f"已存在 {result.duplicated} 笔，"
+                        f"无法识别 {result.invalid} 笔",
+                        duration=5000,
+                    )
+        finally:
+            self.importing = False
+
+
+def statement_import_zone() -> rx.Component:
+    return rx.vstack(
+        rx.hstack(
+            rx.select.root(
+                rx.select.trigger(),
+                rx.select.content(
+                    *(
+                        rx.select.item(profile.name, value=key)
+                        for key, profile in BANK_PROFILES.items()
+                    )
+                ),
+                value=StatementState.profile,
+                on_change=StatementState.set_profile,
+            ),
+            rx.input(
+                placeholder="对账单所属账户的户名",
+                value=StatementState.account_name,
+                on_change=StatementState.set_account_name,
+            ),
+            spacing="2",
+            align="center",
+        ),
+        rx.upload(
+            rx.cond(
+                StatementState.importing,
+                rx.spinner(size="3"),
+                rx.vstack(
+                    rx.text("导入银行对账单：点击方框，或将文件拖入框内", size="1"),
+                    rx.text(
+                        f"支持 {' '.join(STATEMENT_EXTENSIONS)} 文件，不需要识别",
+                        size="1",
+                    ),
+                    spacing="1",
+                    align="center",
+                ),
+            ),
+            id="statement_upload",
+            multiple=True,
+            border="1px dotted",
+            class_name="rounded-md",
+            width="90vw",
+            height="80px",
+            padding="0px",
+            display="flex",
+            justify_content="center",
+            align_items="center",
+            accept={
+                "text/csv": [".csv"],
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": [
+                    ".xlsx"
+                ],
+            },
+            on_drop=StatementState.handle_upload(
+                rx.upload_files(upload_id="statement_upload")
+            ),  # type:ignore
+        ),
+        align="center",
+        spacing="2",
+    )
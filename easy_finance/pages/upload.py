@@ -1,15 +1,50 @@
+import asyncio
+import uuid
+
 import reflex as rx
 
-from ..utils.request_api import request_api
+from ..settings import settings
+from ..utils.categorize import apply_rules
+from ..utils.chunked_upload import upload_script
+from ..utils.dedup import flag_duplicates
+from ..utils.ingest import save_journal_drafts
+from ..utils.job_queue import job_queue
+from ..utils.ocr_provider import OCRRecord
+from ..utils.records import JOURNAL_COLUMNS, JournalDraft
+from ..utils.request_api import save_upload_file
+from ..utils.storage import StorageQuotaError
+from ..utils.watch_folder import WATCH_BATCH_ID
+from .components import chunked_upload_input
 from reflex_ag_grid import ag_grid
-from ..models import JournalAccount
 from datetime import datetime, timedelta
 
+MAX_UPLOAD_FILES = 100  # 拖入上传区一次最多上传的文件数量，分片上传不受这个限制
+CHUNKED_INPUT_ID = "upload-chunked"  # 分片上传的文件选择框 id
+CHUNKED_PROGRESS_ID = "upload-chunked-progress"
+CATEGORY_OPTIONS = [
+    "搜索广告",
+    "营销推广",
+    "外包劳务",
+    "技术服务",
+    "物业支出",
+    "财务分红",
+    "其他支出",
+]  # 分类的可选值
+
 
 class UploadState(rx.State):
 
     up_loading: bool = False
-    upload_data: list[dict] = []
+    _drafts: list[JournalDraft] = (
+        []
+    )  # 识别出的流水，只保存在后端，发送给前端时才转化为字典
+    batch_id: str = rx.LocalStorage(
+        ""
+    )  # 当前批次的 id，存在浏览器里，刷新页面后可以继续获取识别结果
+    job_total: int = 0  # 当前批次的文件总数
+    job_finished: int = 0  # 当前批次已经处理完的文件数
+    loaded_jobs: list[str] = []  # 已经加入表格或已经提示过错误的任务 id
+    tracking: bool = False  # 是否正在跟踪当前批次的进度
 
     @rx.var
     def data(self) -> list[dict]:
@@ -18,34 +53,150 @@ class UploadState(rx.State):
         Returns: 用户上传的数据
 
         """
-        return self.upload_data
+        return [draft.to_dict() for draft in self._drafts]
 
-    async def handle_upload(self, files: list[rx.UploadFile]) -> None:
+    async def handle_upload(self, files: list[rx.UploadFile]):
         """
-        调用百度云的api，上传用户传入的文件，将返回的数据赋值给 self.upload_data
+        保存用户上传的文件，并提交到后台任务队列，识别结果由 track_batch 获取
         Args:
             files: 用户上传的文件
 
         """
-        self.up_loading = True  # 显示加载状态
+        if len(files) > MAX_UPLOAD_FILES:
+            yield rx.toast.error(
+                f"一次最多传{MAX_UPLOAD_FILES}个文件，你传了{len(files)}个"
+            )
+            return
 
+        self.up_loading = True  # 显示加载状态
         yield
 
-        if len(files) > 5:
-            yield rx.toast.error(f"一次最多传5个文件，你传了{len(files)}个")
+        try:
+            saved_files = []
+            for file in files:
+                upload_data = await file.read()
+                saved_files.append(
+                    (file.filename, save_upload_file(file.filename, upload_data))
+                )
 
-        else:
-            try:
-                # print(len(files))
-                # print([file.filename for file in files])
-                # await asyncio.sleep(2)
-                resp_list = [await request_api(file=f, mode="bank_slip") for f in files]
-                self.upload_data.extend(resp_list)
-            except ValueError as e:
-                yield rx.toast.error(f"系统报错：{e}")
+            if not self.batch_id:
+                self.batch_id = uuid.uuid4().hex
+
+            await job_queue.submit(self.batch_id, "bank_slip", saved_files)
+
+        except (TypeError, StorageQuotaError) as e:
+            yield rx.toast.error(f"系统报错：{e}")
+
+        finally:
+            self.up_loading = False
+
+        yield UploadState.track_batch
+
+    def start_chunked_upload(self, _value: str):
+        """选择文件后由浏览器分片上传，每个文件上传完成后由服务器提交到后台任务队列"""
+        if not self.batch_id:
+            self.batch_id = uuid.uuid4().hex
+        self.up_loading = True
+        return rx.call_script(
+            upload_script(
+                CHUNKED_INPUT_ID, self.batch_id, "bank_slip", CHUNKED_PROGRESS_ID
+            ),
+            callback=UploadState.finish_chunked_upload,
+        )
+
+    def finish_chunked_upload(self, result: dict):
+        """
+        分片上传结束后提示上传结果，并开始获取识别结果
+        Args:
+            result: assets/chunked_upload.js 返回的上传结果
+        """
+        self.up_loading = False
+        if result["uploaded"]:
+            yield rx.toast.success(f"上传了 {result['uploaded']} 个文件")
+        if result["skipped"]:
+            yield rx.toast.info(f"{result['skipped']} 个文件之前已经上传过")
+        for error in result["failed"]:
+            yield rx.toast.error(error)
+        yield UploadState.track_batch
+
+    @rx.background
+    async def track_batch(self):
+        """
+        在后台轮询当前批次的处理进度，把新完成的识别结果加入表格，
+        页面加载时也会调用，这样刷新页面后仍然能拿到之前上传文件的识别结果
+        """
+        async with self:
+            if self.tracking or not self.batch_id:
+                return
+            self.tracking = True
+
+        try:
+            while True:
+                async with self:
+                    batch_id = self.batch_id
+                if not batch_id:
+                    return
+
+                progress = await job_queue.batch_progress(batch_id)
+                errors = []
+                rows_to_check: list[dict] = []
 
-            finally:
-                self.up_loading = False
+                async with self:
+                    if batch_id != self.batch_id:  # 数据已经上传，批次已经清空
+                        return
+
+                    self.job_total = progress["total"]
+                    self.job_finished = progress["finished"]
+                    row_count = len(self._drafts)
+
+                    for job in progress["jobs"]:
+                        if job.id in self.loaded_jobs:
+                            continue
+                        if job.status == "done":
+                            self._drafts.append(
+                                JournalDraft.from_record(
+                                    OCRRecord.from_dict(job.result)
+                                )
+                            )
+                            self.loaded_jobs.append(job.id)
+                        elif job.status == "failed":
+                            self.loaded_jobs.append(job.id)
+                            errors.append(
+                                f"文件「{job.file_name}」识别失败：{job.error}"
+                            )
+                    if len(self._drafts) > row_count:
+                        rows_to_check = [draft.to_dict() for draft in self._drafts]
+
+                if rows_to_check:
+                    # 有新的识别结果时，重新检查表格里的流水是否和数据库或者表格里的其他流水重复，
+                    # 并按分类规则给还没有分类的流水填写分类
+                    flags = await asyncio.to_thread(flag_duplicates, rows_to_check)
+                    categorized = await asyncio.to_thread(apply_rules, rows_to_check)
+                    async with self:
+                        if batch_id == self.batch_id and len(self._drafts) == len(
+                            flags
+                        ):
+                            for index, (draft, flag, new_row) in enumerate(
+                                zip(self._drafts, flags, categorized)
+                            ):
+                                draft.duplicate = flag
+                                if not draft.category:  # 不覆盖用户刚刚填写的分类
+                                    draft.category = new_row["category"]
+                                    draft.category_rule_id = new_row["category_rule_id"]
+                                # 修改的是列表里的对象，需要重新赋值，state 才会知道表格发生了变化
+                                self._drafts[index] = draft
+
+                for error in errors:
+                    yield rx.toast.error(error)
+
+                if progress["finished"] >= progress["total"]:
+                    return
+
+                await asyncio.sleep(1)
+
+        finally:
+            async with self:
+                self.tracking = False
 
     def cell_value_changed(self, row, col_field, new_value) -> None:
         """
@@ -57,6 +208,8 @@ class UploadState(rx.State):
 
         """
 
+        draft = self._drafts[row]
+
         if col_field == "trade_date":
 
             try:
@@ -64,71 +217,96 @@ class UploadState(rx.State):
                 utc_date = datetime.fromisoformat(new_value.replace("Z", "+00:00"))
                 local_date = utc_date + timedelta(hours=8)
                 formatted_date = local_date.strftime("%Y-%m-%d")
-                self.upload_data[row][col_field] = formatted_date
+                draft.set_cell(col_field, formatted_date)
 
             except (ValueError, AttributeError):
                 formatted_date = ""
-                self.upload_data[row][col_field] = formatted_date
+                draft.set_cell(col_field, formatted_date)
 
         else:
-            self.upload_data[row][col_field] = new_value
+            draft.set_cell(col_field, new_value)
+            if col_field == "category":  # 手动填写的分类，重新分类时不会被覆盖
+                draft.category_rule_id = None
+
+        # 修改的是列表里的对象，需要重新赋值，state 才会知道表格发生了变化
+        self._drafts[row] = draft
+
+    async def load_watched_files(self):
+        """
+        把扫描文件夹里已经识别完的文件（每次最多 MAX_UPLOAD_FILES 个）移到当前批次，
+        识别结果由 track_batch 加入表格
+        """
+        if not self.batch_id:
+            self.batch_id = uuid.uuid4().hex
+        moved = await job_queue.store.move_finished(
+            WATCH_BATCH_ID, self.batch_id, MAX_UPLOAD_FILES
+        )
+        if not moved:
+            yield rx.toast.info("扫描文件夹里没有新的识别结果")
+            return
+        yield rx.toast.success(f"导入了 {moved} 个扫描文件的识别结果")
+        yield UploadState.track_batch
+
+    async def clear_batch(self, batch_id: str) -> None:
+        """从任务队列中删除已经入库的批次"""
+        await job_queue.store.delete_batch(batch_id)
 
-    def send_to_database(self) -> None:
+    async def send_to_database(self):
         """
-        将数据上传到数据库,刷新 upload_data，清空前端表格
+        将数据上传到数据库,清空表格里的流水和前端表格
         如果用户上传空数据会警告
         """
 
-        if self.upload_data:
+        if self._drafts:
+
+            try:
+                result = await save_journal_drafts(
+                    list(self._drafts), origin=self.router.session.client_token
+                )
+            except ValueError as e:
+                yield rx.toast.error(f"数据不完整：{e}")
+                return
+            if result.matched:
+                yield rx.toast.success(f"{result.matched} 笔流水自动匹配到了发票")
+            if result.skipped:
+                yield rx.toast.warning(f"跳过了 {result.skipped} 条重复的流水")
+            self._drafts = []
 
-            JournalAccount.create_records(records=self.upload_data)
-            self.upload_data = []
+            # 识别结果已经入库，清空当前批次
+            if self.batch_id:
+                yield UploadState.clear_batch(self.batch_id)
+            self.batch_id = ""
+            self.loaded_jobs = []
+            self.job_total = 0
+            self.job_finished = 0
 
         else:
             yield rx.toast.error("数据为空！", duration=2000)
 
 
-bank_slip_column_defs = [
-    ag_grid.column_def(
-        field="trade_date",
-        header_name="交易日期",
-        cell_data_type="date",
-        editable=True,
-        filter=ag_grid.filters.date,
-        cell_editor=ag_grid.editors.date,
-    ),
-    ag_grid.column_def(
-        field="description",
-        header_name="项目描述",
-        cell_data_type="text",
-        editable=True,
-        filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
-    ),
-    ag_grid.column_def(
-        field="additional_info",
-        header_name="备注",
-        cell_data_type="text",
-        editable=True,
-        filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
-    ),
-    ag_grid.column_def(
-        field="amount",
-        header_name="金额",
-        cell_data_type="number",
-        editable=True,
-        filter=ag_grid.filters.number,
-        cell_editor=ag_grid.editors.number,
-    ),
-    ag_grid.column_def(
-        field="category",
-        header_name="分类",
-        cell_data_type="text",
-        editable=True,
-        filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
-        header_tooltip="""
+# 不同类型的单元格使用的筛选器和编辑器
+CELL_TYPE_PROPS = {
+    "text": {
+        "cell_data_type": "text",
+        "filter": ag_grid.filters.text,
+        "cell_editor": ag_grid.editors.text,
+    },
+    "date": {
+        "cell_data_type": "date",
+        "filter": ag_grid.filters.date,
+        "cell_editor": ag_grid.editors.date,
+    },
+    "number": {
+        "cell_data_type": "number",
+        "filter": ag_grid.filters.number,
+        "cell_editor": ag_grid.editors.number,
+    },
+}
+
+# 个别列额外的属性
+COLUMN_EXTRA_PROPS = {
+    "category": {
+        "header_tooltip": """
                 搜索广告:
                 营销推广:
                 外包劳务:
@@ -137,50 +315,37 @@ bank_slip_column_defs = [
                 财务分红:
                 其他支出:
         """,
-        cell_editor_params={
-            "values": [
-                "搜索广告",
-                "营销推广",
-                "外包劳务",
-                "技术服务",
-                "物业支出",
-                "财务分红",
-                "其他支出",
-            ]
-        },
-    ),
-    ag_grid.column_def(
-        field="payer",
-        header_name="付款方",
-        cell_data_type="text",
-        editable=True,
-        filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
-    ),
-    ag_grid.column_def(
-        field="receiver",
-        header_name="收款方",
-        cell_data_type="text",
-        editable=True,
-        filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
-    ),
+        "cell_editor_params": {"values": CATEGORY_OPTIONS},
+    },
+}
+
+# 列的字段和表头由 JOURNAL_COLUMNS 统一定义，upload 和 display 页面共用
+bank_slip_column_defs = [
     ag_grid.column_def(
-        field="bank_slip_url",
-        header_name="银行回单",
-        cell_data_type="text",
+        field=column.field,
+        header_name=column.title,
         editable=True,
-        filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
-    ),
+        **CELL_TYPE_PROPS[column.cell_type],
+        **COLUMN_EXTRA_PROPS.get(column.field, {}),
+    )
+    for column in JOURNAL_COLUMNS
+]
+
+
+# 上传页面的表格在最前面多一列重复检查的结果
+upload_column_defs = [
     ag_grid.column_def(
-        field="tax_invoice_url",
-        header_name="发票",
+        field="duplicate",
+        header_name="重复检查",
         cell_data_type="text",
-        editable=True,
+        editable=False,
         filter=ag_grid.filters.text,
-        cell_editor=ag_grid.editors.text,
+        header_tooltip="""
+                重复: 数据库或表格里已经有相同的流水，上传时会跳过
+                疑似重复: 日期和金额相同，户名只差一个字，请人工确认
+        """,
     ),
+    *bank_slip_column_defs,
 ]
 
 
@@ -189,7 +354,7 @@ def ag_grid_zone() -> rx.Component:
         ag_grid(
             id="ag_grid_basic_editing",
             row_data=UploadState.data,
-            column_defs=bank_slip_column_defs,
+            column_defs=upload_column_defs,
             on_cell_value_changed=UploadState.cell_value_changed,
             width="90vw",
             height="60vh",
@@ -213,7 +378,20 @@ def upload_zone() -> rx.Component:
             rx.vstack(
                 rx.text("点击方框，或将文件拖入框内", size="1"),
                 rx.text("支持 .jpg .jpeg .png .bmp .pdf 文件", size="1"),
-                rx.text("最多同时上传5个文件，单文件最大5mb", size="1"),
+                rx.text(
+                    f"最多同时上传{MAX_UPLOAD_FILES}个文件，单文件最大5mb", size="1"
+                ),
+                rx.text("文件更多或者网络不稳定时，请点击下方的“批量上传”", size="1"),
+                rx.cond(
+                    UploadState.job_total > 0,
+                    rx.text(
+                        "识别进度：",
+                        UploadState.job_finished,
+                        "/",
+                        UploadState.job_total,
+                        size="1",
+                    ),
+                ),
                 spacing="1",
                 height="100%",
                 justify="center",
@@ -223,7 +401,7 @@ def upload_zone() -> rx.Component:
         id="upload1",
         multiple=True,
         # max_files=5, # Reflex 给的这个参数似乎不能限制前端上传的文件数量，所以我采用了后端验证的方式
-        max_size=5000000,  # 百度api最大文件限制 8mb
+        max_size=settings.upload_max_bytes,  # 百度api最大文件限制 8mb
         border=f"1px dotted",
         class_name="rounded-md",
         margin_top="10px",
@@ -246,11 +424,30 @@ def upload_and_send() -> rx.Component:
     return rx.vstack(
         upload_zone(),
         ag_grid_zone(),
-        rx.button(
-            "上传数据",
-            on_click=UploadState.send_to_database,
-            color=rx.color("slate", 2),
-            bg=rx.color("slate", 12),
+        rx.hstack(
+            chunked_upload_input(
+                CHUNKED_INPUT_ID,
+                CHUNKED_PROGRESS_ID,
+                UploadState.start_chunked_upload,
+                UploadState.up_loading,
+            ),
+            rx.button(
+                "上传数据",
+                on_click=UploadState.send_to_database,
+                color=rx.color("slate", 2),
+                bg=rx.color("slate", 12),
+            ),
+            # 配置了扫描文件夹时才显示
+            (
+                rx.button(
+                    "导入扫描文件",
+                    on_click=UploadState.load_watched_files,
+                    variant="outline",
+                    color_scheme="gray",
+                )
+                if settings.watch_dir
+                else rx.fragment()
+            ),
         ),
         width="100%",
         align="center",
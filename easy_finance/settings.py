@@ -0,0 +1,145 @@
+import os
+from dataclasses import dataclass, field
+from typing import Callable, TypeVar
+
+from dotenv import load_dotenv
+
+"""
+应用配置
+
+所有环境变量（包括 .env 文件）只在这里读取一次，其他模块通过 settings 使用配置，
+不需要各自调用 load_dotenv 和 os.getenv。
+
+数据库地址 DB_URL 和 Redis 地址 REDIS_URL 由 rxconfig.py 传给 reflex，
+rxconfig.py 在导入本项目之前加载，所以单独读取这两个环境变量
+"""
+
+load_dotenv()
+
+T = TypeVar("T")
+
+
+def env(name: str, default: T, cast: Callable[[str], T] = str) -> T:  # type:ignore
+    """读取环境变量，没有设置时使用默认值"""
+
+    def factory() -> T:
+        value = os.getenv(name)
+        return default if value is None else cast(value)
+
+    return field(default_factory=factory)
+
+
+@dataclass(frozen=True)
+class Settings:
+    # 网站
+    back_end: str | None = env("BACK_END", None)  # 后端地址，用于生成文件链接
+    password: str | None = env("PASSWORD", None)  # 进入网站的密码
+
+    # 数据库连接池，见 easy_finance/db.py
+    db_pool_size: int = env("DB_POOL_SIZE", 5, int)  # 连接池保持的连接数量
+    # 连接池满了以后最多再打开的连接数量
+    db_max_overflow: int = env("DB_MAX_OVERFLOW", 10, int)
+    db_pool_recycle: int = env("DB_POOL_RECYCLE", 1800, int)  # 连接的最长使用时间（秒）
+
+    # 日志
+    log_level: str = env("LOG_LEVEL", "INFO", str.upper)  # 日志级别
+    log_file: str = env("LOG_FILE", "./EasyFinance.log")  # 日志文件路径
+    # 为空时按文件大小切割，否则按时间切割，例如 "midnight"、"H"
+    log_rotate_when: str = env("LOG_ROTATE_WHEN", "")
+    # 单个日志文件最大体积
+    log_max_bytes: int = env("LOG_MAX_BYTES", 10 * 1024 * 1024, int)
+    log_backup_count: int = env("LOG_BACKUP_COUNT", 5, int)  # 保留的历史日志文件数量
+    # 记录 API 返回内容时的最大字符数
+    log_payload_max_chars: int = env("LOG_PAYLOAD_MAX_CHARS", 500, int)
+    # 记录 API 返回内容的采样率，0 表示从不记录，1 表示每次都记录
+    log_payload_sample_rate: float = env("LOG_PAYLOAD_SAMPLE_RATE", 0.1, float)
+
+    # 百度 OCR 的密钥参数
+    baidu_api_key: str | None = env("APIKEY", None)
+    baidu_secret_key: str | None = env("SECRETKEY", None)
+    baidu_qps: float = env("BAIDU_QPS", 2.0, float)  # 百度账号的 QPS 配额
+
+    # 腾讯云 OCR 的密钥参数
+    tencent_secret_id: str | None = env("TENCENT_SECRET_ID", None)
+    tencent_secret_key: str | None = env("TENCENT_SECRET_KEY", None)
+    tencent_region: str = env("TENCENT_REGION", "ap-beijing")
+    # 腾讯云api限制，最高 QPS 为 5，默认每秒最多发出3个请求
+    tencent_qps: float = env("TENCENT_QPS", 3.0, float)
+
+    # 单次 OCR 请求的超时时间（秒）
+    ocr_timeout: float = env("OCR_TIMEOUT", 15.0, float)
+    # 请求超过这个时间没有返回时再发一个对冲请求，0 表示不使用对冲请求（会产生额外的调用费用）
+    ocr_hedge_delay: float = env("OCR_HEDGE_DELAY", 0.0, float)
+    # 识别结果缓存的有效期（秒），同一个文件再次上传时直接使用缓存，不再调用 OCR 接口，0 表示不缓存
+    ocr_cache_ttl: float = env("OCR_CACHE_TTL", 30 * 24 * 3600.0, float)
+
+    # 后台识别任务
+    job_db_path: str = env("JOB_DB_PATH", "./jobs.db")  # 任务队列数据库的路径
+    job_workers: int = env("JOB_WORKERS", 3, int)  # 同时处理任务的 worker 数量
+    # 队列为空时的轮询间隔（秒）
+    job_poll_interval: float = env("JOB_POLL_INTERVAL", 1.0, float)
+    # running 状态超过这个时间（秒）没有完成的任务，认为处理它的进程已经退出，重新处理
+    job_lease_seconds: float = env("JOB_LEASE_SECONDS", 600.0, float)
+    # 每个任务最多处理的次数，超过后标记为失败，避免一个会让进程崩溃的文件被反复处理
+    job_max_attempts: int = env("JOB_MAX_ATTEMPTS", 3, int)
+    # 只在一个进程里运行的后台任务（扫描文件夹、清理上传目录）的租约时间（秒），
+    # 持有租约的进程退出后，其他进程最多等这么久接手
+    singleton_lease_seconds: float = env("SINGLETON_LEASE_SECONDS", 30.0, float)
+
+    # 分片上传，见 utils/chunked_upload.py
+    # 单个文件的最大体积，百度 OCR 接口最大支持 8mb 的文件
+    upload_max_bytes: int = env("UPLOAD_MAX_BYTES", 8 * 1024 * 1024, int)
+    # 浏览器每次发送的分片大小
+    upload_chunk_size: int = env("UPLOAD_CHUNK_SIZE", 1024 * 1024, int)
+    # 没有上传完的文件保留的时间（小时），过期后需要重新上传
+    upload_expire_hours: float = env("UPLOAD_EXPIRE_HOURS", 24.0, float)
+
+    # 上传目录的清理和容量，见 utils/storage.py
+    # 没有被流水和发票引用的文件保留的天数，超过后移到回收站
+    storage_grace_days: float = env("STORAGE_GRACE_DAYS", 7.0, float)
+    # 压缩后的文件在回收站保留的天数，0 表示不使用回收站，直接删除
+    storage_trash_days: float = env("STORAGE_TRASH_DAYS", 30.0, float)
+    # 回收站的路径，为空时使用上传目录旁边的 uploaded_files_trash
+    storage_trash_dir: str | None = env("STORAGE_TRASH_DIR", None)
+    # 上传目录和回收站最多占用的空间（字节），超过后拒绝新上传的文件，0 表示不限制
+    storage_quota_bytes: int = env("STORAGE_QUOTA_BYTES", 0, int)
+    # 占用空间达到容量的这个比例时在日志里报警
+    storage_alert_ratio: float = env("STORAGE_ALERT_RATIO", 0.9, float)
+    # 清理上传目录的间隔（秒）
+    storage_sweep_interval: float = env("STORAGE_SWEEP_INTERVAL", 3600.0, float)
+    # 导出文件的保留天数，超过后在清理上传目录时删除，需要时会重新导出
+    storage_export_days: float = env("STORAGE_EXPORT_DAYS", 1.0, float)
+
+    # 扫描文件夹，见 utils/watch_folder.py
+    watch_dir: str | None = env("WATCH_DIR", None)  # 为空时不启动扫描文件夹的服务
+    watch_mode: str = env("WATCH_MODE", "bank_slip")  # 扫描文件的识别模式
+    # 文件大小和修改时间在这段时间（秒）内没有变化才认为已经写完
+    watch_debounce: float = env("WATCH_DEBOUNCE", 2.0, float)
+    # 没有 inotify 时扫描文件夹的间隔（秒），有 inotify 时也会按这个间隔补充扫描一次
+    watch_poll_interval: float = env("WATCH_POLL_INTERVAL", 5.0, float)
+    # 任务队列里最多有多少个还没有识别完的扫描文件，超过后暂停提交
+    watch_max_pending: int = env("WATCH_MAX_PENDING", 100, int)
+
+    # 发票和流水对账
+    # 流水日期和开票日期最多相差的天数，先付款后开票、先开票后付款都算，至少为 1
+    reconcile_date_window_days: int = env("RECONCILE_DATE_WINDOW_DAYS", 60, int)
+    # 低于这个得分的不匹配
+    reconcile_min_score: float = env("RECONCILE_MIN_SCORE", 0.6, float)
+    # 户名对不上的发票和流水按 (金额, 日期桶) 组合时，一个桶里最多的组合数量，超过的桶不参与模糊匹配
+    reconcile_max_pairs_per_key: int = env("RECONCILE_MAX_PAIRS_PER_KEY", 10000, int)
+
+    # 导出
+    # 每次从数据库读取的行数
+    export_chunk_size: int = env("EXPORT_CHUNK_SIZE", 2000, int)
+    export_workers: int = env("EXPORT_WORKERS", 2, int)  # 同时执行的导出任务数量
+
+    # 多个后端进程共享的 Redis，为空时使用进程内的存储，见 utils/shared_store.py
+    redis_url: str | None = env("REDIS_URL", None)
+    # 查询结果缓存占用的最大内存（字节），见 utils/query_cache.py
+    query_cache_max_bytes: int = env("QUERY_CACHE_MAX_BYTES", 64 * 1024 * 1024, int)
+
+    # 启动时导入模块的耗时上限（毫秒），见 utils/startup_bench.py
+    startup_import_budget_ms: float = env("STARTUP_IMPORT_BUDGET_MS", 4000.0, float)
+
+
+settings = Settings()
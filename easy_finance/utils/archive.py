@@ -0,0 +1,328 @@
+import argparse
+import time
+from datetime import date
+from typing import Callable, Iterable
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import (
+    Column,
+    Connection,
+    Index,
+    MetaData,
+    Table,
+    delete,
+    func,
+    insert,
+    inspect,
+    null,
+    text,
+    union_all,
+)
+from sqlmodel import select
+
+from .. import db
+from ..models import ArchivedPeriod, JournalAccount, bump_table_version
+from .log import logger
+
+ARCHIVE_TABLE_PREFIX = (
+    "journalaccount_"  # 归档表的表名是前缀加年份，例如 journalaccount_2023
+)
+
+# 归档表不属于 SQLModel 的 metadata，不会被 reflex db makemigrations 识别为需要迁移的表
+archive_metadata = MetaData()
+
+# 查询流水时的筛选条件：接收一个表（当前表或者归档表），返回这个表上的条件
+Conditions = Callable[[Table], Iterable]
+
+
+def active_table() -> Table:
+    return JournalAccount.__table__  # type:ignore
+
+
+def archive_table(year: int) -> Table:
+    """归档表的定义
+
+    已经存在的归档表从数据库里读取表结构，归档之后 JournalAccount 增加的字段，旧的归档表里没有；
+    新建的归档表和 JournalAccount 的字段相同，但只有交易日期和文件链接的索引，归档后的数据很少修改，
+    不需要当前表那么多索引，文件链接的索引用于清理上传目录时查找被引用的文件
+    """
+    name = f"{ARCHIVE_TABLE_PREFIX}{year}"
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+
+    engine = db.get_engine()
+    if inspect(engine).has_table(name):
+        return Table(name, archive_metadata, autoload_with=engine)
+
+    return Table(
+        name,
+        archive_metadata,
+        *(
+            Column(column.name, column.type, primary_key=column.primary_key)
+            for column in active_table().columns
+        ),
+        Index(f"ix_{name}_trade_date", "trade_date"),
+        Index(f"ix_{name}_bank_slip_url", "bank_slip_url"),
+        Index(f"ix_{name}_tax_invoice_url", "tax_invoice_url"),
+    )
+
+
+def archived_years() -> list[int]:
+    """已经归档的年份，从小到大排列"""
+    with db.session() as session:
+        return list(
+            session.exec(
+                select(ArchivedPeriod.year).order_by(ArchivedPeriod.year)
+            ).all()
+        )
+
+
+async def aarchived_years() -> list[int]:
+    """archived_years 的异步版本"""
+    async with db.asession() as session:
+        return list(
+            (
+                await session.exec(
+                    select(ArchivedPeriod.year).order_by(ArchivedPeriod.year)
+                )
+            ).all()
+        )
+
+
+def journal_partitions(
+    start_date: date | None = None,
+    end_date: date | None = None,
+    years: list[int] | None = None,
+) -> list[Table]:
+    """查询日期范围内的流水需要用到的表：当前表始终需要，归档表只在年份和日期范围重叠时才需要
+
+    Args:
+        years (list[int] | None): 已经归档的年份，为空时从数据库读取
+    """
+    partitions = [active_table()]
+    for year in archived_years() if years is None else years:
+        if start_date and year < start_date.year:
+            continue
+        if end_date and year > end_date.year:
+            continue
+        partitions.append(archive_table(year))
+    return partitions
+
+
+def select_partition(
+    table: Table,
+    columns: list[str],
+    start_date: date | None = None,
+    end_date: date | None = None,
+):
+    """查询一个表里日期范围内的流水，旧的归档表里没有的字段查询结果为 NULL"""
+    query = select(
+        *(
+            table.c[column] if column in table.c else null().label(column)
+            for column in columns
+        )
+    )
+    if start_date:
+        query = query.where(table.c.trade_date >= start_date)
+    if end_date:
+        query = query.where(table.c.trade_date <= end_date)
+    return query
+
+
+def select_journal(
+    columns: Iterable[str],
+    start_date: date | None = None,
+    end_date: date | None = None,
+    conditions: Conditions | None = None,
+):
+    """查询日期范围内的流水，只涉及当前表时是普通的 select，涉及归档表时是所有表的 union all
+
+    Args:
+        columns (Iterable[str]): 查询的字段名
+        start_date (date | None): 交易日期的开始日期（包含）
+        end_date (date | None): 交易日期的结束日期（包含）
+        conditions (Conditions | None): 其他筛选条件
+
+    Returns:
+        Select | CompoundSelect: 可以直接执行，也可以用 .subquery() 作为子查询继续筛选和排序
+    """
+    columns = list(columns)
+    selects = []
+    for table in journal_partitions(start_date, end_date):
+        query = select_partition(table, columns, start_date, end_date)
+        if conditions:
+            query = query.where(*conditions(table))
+        selects.append(query)
+    return selects[0] if len(selects) == 1 else union_all(*selects)
+
+
+async def load_journal_records(
+    start_date: date | None = None, end_date: date | None = None
+) -> list[dict]:
+    """读取日期范围内的流水，用于前端展示，归档表里的流水带有 archived 标记
+
+    Args:
+        start_date (date | None): 交易日期的开始日期（包含），为空时只读取还没有归档的流水，
+            包括归档后重新导入的、日期在已归档年度里的流水
+        end_date (date | None): 交易日期的结束日期（包含）
+
+    Returns:
+        list[dict]: JournalAccount 的字段（不包括 raw_response），加上 archived
+    """
+    columns = [
+        column.name
+        for column in active_table().columns
+        if column.name != "raw_response"
+    ]
+    tables = (
+        [active_table()]
+        if start_date is None
+        else journal_partitions(start_date, end_date, await aarchived_years())
+    )
+    records = []
+    async with db.asession() as session:
+        for table in tables:
+            query = select_partition(table, columns, start_date, end_date)
+            archived = table is not active_table()
+            result = await session.execute(query.order_by(table.c.id))
+            records.extend(
+                {**row._mapping, "archived": archived} for row in result.all()
+            )
+    return records
+
+
+def year_range(year: int) -> tuple[date, date]:
+    return date(year, 1, 1), date(year, 12, 31)
+
+
+def ensure_autoincrement(connection: Connection) -> None:
+    """SQLite 的 journalaccount 表没有 AUTOINCREMENT 时重建这张表
+
+    没有 AUTOINCREMENT 时，新记录的 id 是当前最大 id 加一，归档移走了 id 最大的流水之后，
+    新流水会复用归档流水的 id，发票的 journal_id 会指向错误的流水，恢复归档时 id 也会冲突。
+    JournalAccount 已经设置了 sqlite_autoincrement，但 reflex db makemigrations 不会为已有的表生成这个修改，
+    所以在第一次归档前重建一次，重建时保留所有数据和索引
+    """
+    if connection.dialect.name != "sqlite":
+        return  # PostgreSQL 的序列不会复用 id
+    table_name = active_table().name
+    create_sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": table_name},
+    ).scalar_one()
+    if "AUTOINCREMENT" in create_sql.upper():
+        return
+
+    logger.info(f"重建 {table_name} 表，避免归档后新流水复用归档流水的 id")
+    operations = Operations(MigrationContext.configure(connection))
+    with operations.batch_alter_table(
+        table_name, recreate="always", table_kwargs={"sqlite_autoincrement": True}
+    ):
+        pass
+
+
+def archive_year(year: int) -> int:
+    """把一个已经结束的会计年度的流水移到归档表
+
+    年度已经归档过时（例如之后又导入了这一年的对账单），把当前表里剩下的这一年的流水也移过去
+
+    Args:
+        year (int): 会计年度，必须早于今年
+
+    Returns:
+        int: 这次移动的流水数量
+    """
+    if year >= date.today().year:
+        raise ValueError(f"{year} 年还没有结束，不能归档")
+
+    start_time = time.time()
+    start_date, end_date = year_range(year)
+    source = active_table()
+    table = archive_table(year)
+    columns = [column.name for column in table.columns if column.name in source.c]
+    in_year = (source.c.trade_date >= start_date, source.c.trade_date <= end_date)
+
+    with db.session() as session:
+        connection = session.connection()
+        ensure_autoincrement(connection)
+        archive_metadata.create_all(connection, tables=[table])
+        moved = connection.execute(
+            insert(table).from_select(
+                columns,
+                select(*(source.c[column] for column in columns)).where(*in_year),
+            )
+        ).rowcount
+        connection.execute(delete(source).where(*in_year))
+
+        period = session.exec(
+            select(ArchivedPeriod).where(ArchivedPeriod.year == year)
+        ).first()
+        if period is None:
+            period = ArchivedPeriod(year=year, table_name=table.name)
+        period.row_count += moved
+        session.add(period)
+        bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+        session.commit()
+
+    logger.info(
+        f"归档了 {year} 年的 {moved} 条流水，用时：{time.time() - start_time:.2f}s"
+    )
+    return moved
+
+
+def restore_year(year: int) -> int:
+    """把归档的会计年度移回当前表，并删除归档表
+
+    Returns:
+        int: 移回的流水数量
+    """
+    source = active_table()
+    with db.session() as session:
+        period = session.exec(
+            select(ArchivedPeriod).where(ArchivedPeriod.year == year)
+        ).first()
+        if period is None:
+            raise ValueError(f"{year} 年没有归档")
+
+        table = archive_table(year)
+        conflicts = session.execute(
+            select(func.count())
+            .select_from(table)
+            .where(table.c.id.in_(select(source.c.id)))
+        ).scalar_one()
+        if conflicts:
+            raise ValueError(f"{year} 年有 {conflicts} 条归档流水的 id 和当前表重复")
+
+        connection = session.connection()
+        columns = [column.name for column in table.columns if column.name in source.c]
+        restored = connection.execute(
+            insert(source).from_select(
+                columns, select(*(table.c[column] for column in columns))
+            )
+        ).rowcount
+        table.drop(connection)
+        session.delete(period)
+        bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+        session.commit()
+
+    archive_metadata.remove(table)
+    logger.info(f"{year} 年的 {restored} 条流水已经移回当前表")
+    return restored
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.archive 2023
+    parser = argparse.ArgumentParser(description="归档或恢复会计年度的流水")
+    parser.add_argument("years", type=int, nargs="+", help="会计年度")
+    parser.add_argument("--restore", action="store_true", help="把归档的流水移回当前表")
+    args = parser.parse_args()
+    for archive_year_arg in args.years:
+        if args.restore:
+            print(
+                f"{archive_year_arg} 年：移回 {restore_year(archive_year_arg)} 条流水"
+            )
+        else:
+            print(
+                f"{archive_year_arg} 年：归档 {archive_year(archive_year_arg)} 条流水"
+            )
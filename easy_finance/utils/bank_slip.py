@@ -1,5 +1,6 @@
 import re
 from datetime import date, datetime
+from functools import lru_cache
 
 from .log import logger
 
@@ -14,6 +15,76 @@ AMOUNT_KEYWORDS = {"金额", "小写"}
 AMOUNT_EX_KEYWORD = "大写"
 AMOUNT_PATTERN = re.compile(r"[^\d.]")
 
+# get_bank_slip_data 返回值中各字段的 id，顺序和返回值一致
+BANK_SLIP_FIELDS = (
+    "trans_date",
+    "buyer_name",
+    "buyer_account",
+    "buyer_bank",
+    "seller_name",
+    "seller_account",
+    "seller_bank",
+    "trans_amount",
+)
+
+
+DATE_TRANS_TABLE = str.maketrans("", "", DATE_TO_REMOVE)
+
+# 字段名里所有关键词组成的正则，一次扫描就能找出字段名包含的全部关键词
+FIELD_KEYWORD_PATTERN = re.compile(
+    "|".join(
+        map(
+            re.escape,
+            {
+                BUYER_KEYWORD,
+                SELLER_KEYWORD,
+                ACCOUNT_KEYWORD,
+                BANK_KEYWORD,
+                AMOUNT_EX_KEYWORD,
+                *NAME_KEYWORDS,
+                *DATE_KEYWORDS,
+                *AMOUNT_KEYWORDS,
+            },
+        )
+    )
+)
+
+
+@lru_cache(maxsize=4096)
+def classify_field_name(name: str) -> tuple[str, ...]:
+    """判断回单里的一个字段名对应 BANK_SLIP_FIELDS 里的哪些字段，
+    同一个字段名可能对应多个字段（例如 "付款人开户行账号"），
+    回单的字段名种类有限，所以结果按字段名缓存，每个字段名只需要判断一次
+
+    Args:
+        name (str): 回单里的字段名，也就是 api 返回值里的 Name
+
+    Returns:
+        tuple[str, ...]: 对应的字段 id
+    """
+    keywords = set(FIELD_KEYWORD_PATTERN.findall(name))
+    slots = []
+
+    if keywords & DATE_KEYWORDS:
+        slots.append("trans_date")
+
+    is_name = bool(keywords & NAME_KEYWORDS) and not (
+        keywords & {ACCOUNT_KEYWORD, BANK_KEYWORD}
+    )
+    for keyword, prefix in ((BUYER_KEYWORD, "buyer"), (SELLER_KEYWORD, "seller")):
+        if keyword in keywords:
+            if is_name:
+                slots.append(f"{prefix}_name")
+            if ACCOUNT_KEYWORD in keywords:
+                slots.append(f"{prefix}_account")
+            if BANK_KEYWORD in keywords:
+                slots.append(f"{prefix}_bank")
+
+    if keywords & AMOUNT_KEYWORDS and AMOUNT_EX_KEYWORD not in keywords:
+        slots.append("trans_amount")
+
+    return tuple(slots)
+
 
 def parse_date(date_string: str) -> str:
     """将银行回单内的日期时间字符串转化为纯数字格式
@@ -25,8 +96,16 @@ def parse_date(date_string: str) -> str:
     Returns:
         str: 纯数字的日期字符串
     """
-    trans_table = str.maketrans("", "", DATE_TO_REMOVE)
-    return date_string.translate(trans_table)
+    return date_string.translate(DATE_TRANS_TABLE)
+
+
+def parse_date_value(date_string: str) -> date:
+    """将回单里的日期时间字符串转化为 date，无法解析时抛出 ValueError"""
+    date_num = parse_date(date_string)[:8]
+    try:
+        return date.fromisoformat(date_num)
+    except ValueError:
+        return datetime.strptime(date_num, "%Y%m%d").date()
 
 
 def extract_datetime(bank_slip_info: list[dict]) -> str | None:
@@ -42,13 +121,11 @@ def extract_datetime(bank_slip_info: list[dict]) -> str | None:
         logger.warning("当前处理的 bank_slip_info 为 None")
         return None
 
-    date_values: list[date] = []
-    for info in bank_slip_info:
-        if any(keyword in info["Name"] for keyword in DATE_KEYWORDS):
-            parsed_date = datetime.strptime(
-                parse_date(info["Value"])[:8], "%Y%m%d"
-            ).date()
-            date_values.append(parsed_date)
+    date_values: list[date] = [
+        parse_date_value(info["Value"])
+        for info in bank_slip_info
+        if "trans_date" in classify_field_name(info["Name"])
+    ]
     if not date_values:
         logger.warning("没有在当前处理的 bank_slip_info 找到时间值")
         return None
@@ -100,120 +177,193 @@ def get_bank_slip_data(bank_slip_info: list[dict]) -> list[str]:
 
     """
 
-    # 初始化所有字段，所有字段值都是 None
-    (
-        buyer_name,
-        buyer_account,
-        buyer_bank,
-        seller_name,
-        seller_account,
-        seller_bank,
-        trans_amount,
-        trans_date,
-    ) = [None] * 8
-
-    # 提取发票内的时间信息
-    trans_date = extract_datetime(bank_slip_info)
-
-    for info in bank_slip_info:  # type:ignore
-        # 提取付款方信息
-        if BUYER_KEYWORD in info["Name"]:
-            # 付款人名称
-            if (
-                not buyer_name
-                and any(keyword in info["Name"] for keyword in NAME_KEYWORDS)
-                and all(
-                    keyword not in info["Name"]
-                    for keyword in {ACCOUNT_KEYWORD, BANK_KEYWORD}
-                )
-            ):
-                buyer_name = info["Value"]
-            # 付款人账号
-            if not buyer_account and ACCOUNT_KEYWORD in info["Name"]:
-                buyer_account = info["Value"]
-            # 付款人银行
-            if not buyer_bank and BANK_KEYWORD in info["Name"]:
-                buyer_bank = info["Value"]
-
-        # 提取收款方信息
-        if SELLER_KEYWORD in info["Name"]:
-            # 收款人名称
-            if (
-                not seller_name
-                and any(keyword in info["Name"] for keyword in NAME_KEYWORDS)
-                and all(
-                    keyword not in info["Name"]
-                    for keyword in {ACCOUNT_KEYWORD, BANK_KEYWORD}
-                )
-            ):
-                seller_name = info["Value"]
-            # 收款人账号
-            if not seller_account and ACCOUNT_KEYWORD in info["Name"]:
-                seller_account = info["Value"]
-            # 收款人银行
-            if not seller_bank and BANK_KEYWORD in info["Name"]:
-                seller_bank = info["Value"]
-
-        # 提取回单金额
-        if (
-            not trans_amount
-            and any(keyword in info["Name"] for keyword in AMOUNT_KEYWORDS)
-            and AMOUNT_EX_KEYWORD not in info["Name"]
-        ):
-            extracted = extract_amount(info["Value"])
-            if extracted:  # 只有当提取出非空字符串时才赋值
-                trans_amount = extracted
-
-        if all(
-            {
-                buyer_name,
-                buyer_account,
-                buyer_bank,
-                seller_name,
-                seller_account,
-                seller_bank,
-                trans_amount,
-                trans_date,
-            }
-        ):
-            break
+    if not bank_slip_info:
+        logger.warning("当前处理的 bank_slip_info 为 None")
+
+    # 所有字段的初始值都是 None
+    slots: dict[str, str | None] = dict.fromkeys(BANK_SLIP_FIELDS)
+    date_values: list[date] = []
+
+    # 只遍历一次回单字段，每个字段名只需要查一次 classify_field_name 的缓存
+    for info in bank_slip_info or []:
+        for slot in classify_field_name(info["Name"]):
+            if slot == "trans_date":
+                # 回单里可能有多个日期，取最早的一个
+                date_values.append(parse_date_value(info["Value"]))
+            elif slot == "trans_amount":
+                if not slots[slot]:
+                    extracted = extract_amount(info["Value"])
+                    if extracted:  # 只有当提取出非空字符串时才赋值
+                        slots[slot] = extracted
+            elif not slots[slot]:
+                slots[slot] = info["Value"]
+
+    if date_values:
+        slots["trans_date"] = min(date_values).strftime("%Y-%m-%d")
+    elif bank_slip_info:
+        logger.warning("没有在当前处理的 bank_slip_info 找到时间值")
 
     # 通过统计 None 的数量来判断
-    none_count = sum(
-        [
-            1
-            for item in [
-                buyer_name,
-                buyer_account,
-                buyer_bank,
-                seller_name,
-                seller_account,
-                seller_bank,
-                trans_amount,
-                trans_date,
-            ]
-            if item is None
-        ]
-    )
+    none_count = sum(1 for value in slots.values() if value is None)
 
     if none_count >= 5:
         raise TypeError("文件可能不是发票或银行回单")
 
     # 整理信息
-    bank_slip_data = list(
-        map(
-            parse_none,
-            [
-                trans_date,
-                buyer_name,
-                buyer_account,
-                buyer_bank,
-                seller_name,
-                seller_account,
-                seller_bank,
-                trans_amount,
-            ],
-        )
-    )
+    bank_slip_data = list(map(parse_none, slots.values()))
 
     return bank_slip_data
+
+
+if __name__ == "__main__":
+    # 微基准测试：用几千张随机生成的回单比较 get_bank_slip_data 和原来逐个关键词判断的实现
+    # 运行方式：python -m easy_finance.utils.bank_slip
+    import random
+    import timeit
+
+    FIELD_NAME_VARIANTS = [
+        ["付款人名称", "付款方户名", "付款人"],
+        ["付款人账号", "付款账号"],
+        ["付款人开户行", "付款银行", "付款人开户银行"],
+        ["收款人名称", "收款方户名", "收款人"],
+        ["收款人账号", "收款账号"],
+        ["收款人开户行", "收款银行", "收款人开户银行"],
+        ["金额(小写)", "小写金额", "交易金额"],
+        ["金额(大写)", "大写金额"],
+        ["交易日期", "记账日期", "交易时间"],
+        ["摘要", "用途", "附言", "交易流水号", "回单编号", "币种", "打印次数"],
+    ]
+
+    def random_slip() -> list[dict]:
+        slip = [
+            {"Name": random.choice(variants), "Value": f"值{random.randint(0, 999)}"}
+            for variants in FIELD_NAME_VARIANTS
+        ]
+        for info in slip:
+            if "trans_date" in classify_field_name(info["Name"]):
+                info["Value"] = (
+                    f"2024年{random.randint(1, 12):02d}月{random.randint(1, 28):02d}日"
+                )
+            elif "trans_amount" in classify_field_name(info["Name"]):
+                info["Value"] = f"¥{random.randint(1, 100000):,}.00"
+        random.shuffle(slip)
+        return slip
+
+    def legacy_extract_datetime(bank_slip_info: list[dict]) -> str | None:
+        """原来的实现：每个字段都用 any() 判断关键词，每次都重新生成 trans table"""
+        date_values: list[date] = []
+        for info in bank_slip_info:
+            if any(keyword in info["Name"] for keyword in DATE_KEYWORDS):
+                trans_table = str.maketrans("", "", DATE_TO_REMOVE)
+                parsed_date = datetime.strptime(
+                    info["Value"].translate(trans_table)[:8], "%Y%m%d"
+                ).date()
+                date_values.append(parsed_date)
+        if not date_values:
+            return None
+        return min(date_values).strftime("%Y-%m-%d")
+
+    def legacy_get_bank_slip_data(bank_slip_info: list[dict]) -> list[str]:
+        """原来的实现：每个字段都用 any()/all() 重新判断所有关键词"""
+        (
+            buyer_name,
+            buyer_account,
+            buyer_bank,
+            seller_name,
+            seller_account,
+            seller_bank,
+            trans_amount,
+        ) = [None] * 7
+        trans_date = legacy_extract_datetime(bank_slip_info)
+
+        for info in bank_slip_info:
+            if BUYER_KEYWORD in info["Name"]:
+                if (
+                    not buyer_name
+                    and any(keyword in info["Name"] for keyword in NAME_KEYWORDS)
+                    and all(
+                        keyword not in info["Name"]
+                        for keyword in {ACCOUNT_KEYWORD, BANK_KEYWORD}
+                    )
+                ):
+                    buyer_name = info["Value"]
+                if not buyer_account and ACCOUNT_KEYWORD in info["Name"]:
+                    buyer_account = info["Value"]
+                if not buyer_bank and BANK_KEYWORD in info["Name"]:
+                    buyer_bank = info["Value"]
+
+            if SELLER_KEYWORD in info["Name"]:
+                if (
+                    not seller_name
+                    and any(keyword in info["Name"] for keyword in NAME_KEYWORDS)
+                    and all(
+                        keyword not in info["Name"]
+                        for keyword in {ACCOUNT_KEYWORD, BANK_KEYWORD}
+                    )
+                ):
+                    seller_name = info["Value"]
+                if not seller_account and ACCOUNT_KEYWORD in info["Name"]:
+                    seller_account = info["Value"]
+                if not seller_bank and BANK_KEYWORD in info["Name"]:
+                    seller_bank = info["Value"]
+
+            if (
+                not trans_amount
+                and any(keyword in info["Name"] for keyword in AMOUNT_KEYWORDS)
+                and AMOUNT_EX_KEYWORD not in info["Name"]
+            ):
+                extracted = extract_amount(info["Value"])
+                if extracted:
+                    trans_amount = extracted
+
+            if all(
+                {
+                    buyer_name,
+                    buyer_account,
+                    buyer_bank,
+                    seller_name,
+                    seller_account,
+                    seller_bank,
+                    trans_amount,
+                    trans_date,
+                }
+            ):
+                break
+
+        values = [
+            trans_date,
+            buyer_name,
+            buyer_account,
+            buyer_bank,
+            seller_name,
+            seller_account,
+            seller_bank,
+            trans_amount,
+        ]
+        if sum(1 for item in values if item is None) >= 5:
+            raise TypeError("文件可能不是发票或银行回单")
+        return list(map(parse_none, values))
+
+    def benchmark(function) -> float:
+        return min(
+            timeit.repeat(
+                lambda: [function(slip) for slip in corpus], number=1, repeat=5
+            )
+        )
+
+    random.seed(0)
+    corpus = [random_slip() for _ in range(5000)]
+    assert all(
+        get_bank_slip_data(slip) == legacy_get_bank_slip_data(slip) for slip in corpus
+    ), "新旧实现的结果不一致"
+
+    legacy_seconds = benchmark(legacy_get_bank_slip_data)
+    seconds = benchmark(get_bank_slip_data)
+    for label, elapsed in (("原实现", legacy_seconds), ("新实现", seconds)):
+        print(
+            f"{label}：{len(corpus)} 张回单用时 {elapsed * 1000:.1f}ms，"
+            f"平均每张 {elapsed / len(corpus) * 1e6:.1f}µs"
+        )
+    print(
+        f"提速 {legacy_seconds / seconds:.1f} 倍，字段名缓存：{classify_field_name.cache_info()}"
+    )
@@ -0,0 +1,312 @@
+from typing import TYPE_CHECKING, Sequence
+
+import polars as pl
+
+from .bank_slip import BANK_SLIP_FIELDS, get_bank_slip_data
+from .invoice import INVOICE_FIELDS
+from .request_api import FULL_WIDTH_CHARS, HALF_WIDTH_CHARS
+
+if TYPE_CHECKING:
+    from .ocr_provider import OCRRecord
+
+DATE_TO_REMOVE_PATTERN = r"[-/\\.:：年月日时秒分\s]"
+AMOUNT_TO_REMOVE_PATTERN = r"[^\d.]"
+
+AMOUNT_DTYPE = pl.Decimal(precision=18, scale=2)
+
+# 各服务商原始返回值的字段名和 BANK_SLIP_FIELDS / INVOICE_FIELDS 的对应关系，
+# 腾讯云的银行回单是 [{"Name": ..., "Value": ...}] 格式，字段名不固定，由 get_bank_slip_data 提取
+RAW_COLUMNS: dict[tuple[str, str], dict[str, str]] = {
+    # 百度银行回单接口（bank_receipt_new）
+    ("baidu", "bank_slip"): {
+        "交易日期": "trans_date",
+        "付款人户名": "buyer_name",
+        "付款人账号": "buyer_account",
+        "付款人开户银行": "buyer_bank",
+        "收款人户名": "seller_name",
+        "收款人账号": "seller_account",
+        "收款人开户银行": "seller_bank",
+        "小写金额": "trans_amount",
+    },
+    # 百度增值税发票接口（vat_invoice）
+    ("baidu", "invoice"): {
+        "InvoiceDate": "invoice_date",
+        "InvoiceType": "invoice_type",
+        "InvoiceNum": "invoice_code",
+        "PurchaserName": "buyer_name",
+        "PurchaserRegisterNum": "buyer_code",
+        "SellerName": "seller_name",
+        "SellerRegisterNum": "seller_code",
+        "TotalTax": "tax_amount",
+        "TotalAmount": "price_excluded_tax",
+        "AmountInFiguers": "price_included_tax",
+    },
+    # 腾讯云通用票据识别的增值税发票
+    ("tencent", "invoice"): {
+        "Date": "invoice_date",
+        "Title": "invoice_type",
+        "Number": "invoice_code",
+        "Buyer": "buyer_name",
+        "BuyerTaxID": "buyer_code",
+        "Seller": "seller_name",
+        "SellerTaxID": "seller_code",
+        "Tax": "tax_amount",
+        "PretaxAmount": "price_excluded_tax",
+        "Total": "price_included_tax",
+    },
+}
+
+# 银行回单的字段 id 和 JournalAccount 字段的对应关系
+BANK_SLIP_JOURNAL_COLUMNS = {
+    "trans_date": "trade_date",
+    "trans_amount": "amount",
+    "buyer_name": "payer",
+    "buyer_account": "payer_account",
+    "buyer_bank": "payer_bank",
+    "seller_name": "receiver",
+    "seller_account": "receiver_account",
+    "seller_bank": "receiver_bank",
+}
+# 入库时必须有值的流水字段
+JOURNAL_REQUIRED_COLUMNS = ["trade_date", "amount", "payer", "receiver"]
+INVOICE_AMOUNT_COLUMNS = ["tax_amount", "price_excluded_tax", "price_included_tax"]
+
+
+def normalize_text(expr: pl.Expr) -> pl.Expr:
+    """全角转半角，去掉所有空白字符"""
+    return (
+        expr.str.replace_many(FULL_WIDTH_CHARS, HALF_WIDTH_CHARS)
+        .str.replace_all(r"\s+", "")
+        .replace("", None)
+    )
+
+
+def parse_date_expr(expr: pl.Expr) -> pl.Expr:
+    """和 bank_slip.parse_date 的逻辑一致：删除日期里的分隔符，取前 8 位数字转化为日期，无法解析时为 null"""
+    return (
+        expr.str.replace_all(DATE_TO_REMOVE_PATTERN, "")
+        .str.slice(0, 8)
+        .str.strptime(pl.Date, "%Y%m%d", strict=False)
+    )
+
+
+def parse_amount_expr(expr: pl.Expr) -> pl.Expr:
+    """和 bank_slip.extract_amount 的逻辑一致：只保留数字和小数点，转化为 Decimal，无法解析时为 null"""
+    return (
+        expr.str.replace_all(AMOUNT_TO_REMOVE_PATTERN, "")
+        .replace("", None)
+        .cast(AMOUNT_DTYPE, strict=False)
+    )
+
+
+def raw_fields(record: "OCRRecord") -> dict[str, str | None]:
+    """取出一条识别记录的原始返回值里还没有清洗的字段值
+
+    Args:
+        record (OCRRecord): 识别记录，按 provider 和 result_type 选择字段名的对应关系
+
+    Returns:
+        dict[str, str | None]: 字段 id 是 BANK_SLIP_FIELDS 或 INVOICE_FIELDS
+    """
+    raw = record.raw
+    if record.provider == "tencent":
+        items = raw.get("MixedInvoiceItems") or []
+        if not items or items[0].get("Code") != "OK":
+            raise ValueError("原始返回值里没有识别出票据")
+        sub_type = items[0]["SubType"]
+        words = items[0]["SingleInvoiceInfos"][sub_type]
+        if record.result_type == "bank_slip":
+            values = get_bank_slip_data(words["OtherInvoiceListItems"])
+            return dict(zip(BANK_SLIP_FIELDS, values))
+    else:
+        words = raw["words_result"]
+
+    columns = RAW_COLUMNS.get((record.provider, record.result_type))
+    if columns is None:
+        raise ValueError(f"不支持 {record.provider} 的 {record.result_type}")
+
+    def get_word(value) -> str | None:
+        # 百度银行回单接口的字段值是 [{"word": ...}] 格式
+        if isinstance(value, list):
+            return value[0]["word"] if value else None
+        return value
+
+    return {field: get_word(words.get(key)) for key, field in columns.items()}
+
+
+def words_results_to_frame(
+    records: Sequence["OCRRecord"], field_ids: Sequence[str]
+) -> pl.DataFrame:
+    """把多条识别记录的原始返回值合并成一个 DataFrame，每条记录是一行，行的顺序和 records 一致
+
+    Args:
+        records (Sequence[OCRRecord]): 百度或者腾讯云的识别记录，可以混在一起
+        field_ids (Sequence[str]): BANK_SLIP_FIELDS 或 INVOICE_FIELDS
+
+    Returns:
+        pl.DataFrame: 所有列都是字符串类型，"未识别" 转化为 null，
+        raw_error 列是原始返回值无法解析的原因
+    """
+    columns: dict[str, list[str | None]] = {field: [] for field in field_ids}
+    raw_errors: list[str | None] = []
+    for record in records:
+        try:
+            values = raw_fields(record)
+            raw_errors.append(None)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            values = {}
+            raw_errors.append(f"原始返回值无法解析：{e}")
+        for field in field_ids:
+            value = values.get(field)
+            columns[field].append(None if value == "未识别" else value)
+
+    return pl.DataFrame(
+        {**columns, "raw_error": raw_errors},
+        schema={column: pl.String for column in [*field_ids, "raw_error"]},
+    )
+
+
+def clean_journal_frame(frame: pl.LazyFrame) -> pl.LazyFrame:
+    """清洗流水字段：trade_date 转化为 Date，amount 转化为 Decimal，其他字符串列全角转半角、去掉空白，
+    并生成 error 列（已有的 raw_error 优先）和 is_valid 列"""
+    schema = frame.collect_schema()
+    text_columns = [
+        column
+        for column, dtype in schema.items()
+        if dtype == pl.String and column not in ("trade_date", "amount", "raw_error")
+    ]
+    error = validate_exprs(JOURNAL_REQUIRED_COLUMNS)
+    if "raw_error" in schema:
+        error = pl.coalesce(pl.col("raw_error"), error).alias("error")
+    return (
+        frame.with_columns(
+            parse_date_expr(normalize_text(pl.col("trade_date").cast(pl.String))),
+            parse_amount_expr(normalize_text(pl.col("amount").cast(pl.String))),
+            *(normalize_text(pl.col(column)) for column in text_columns),
+        )
+        .with_columns(error)
+        .with_columns(is_valid=pl.col("error").is_null())
+    )
+
+
+def process_bank_slips(records: Sequence["OCRRecord"]) -> pl.DataFrame:
+    """批量整理银行回单的原始返回值，所有清洗和校验都是向量化的表达式
+
+    Args:
+        records (Sequence[OCRRecord]): 银行回单的识别记录，其他类型的记录 error 列不为空
+
+    Returns:
+        pl.DataFrame: 包含以下列：
+        trade_date（Date）、amount（Decimal）、payer、payer_account、payer_bank、
+        receiver、receiver_account、receiver_bank、
+        is_valid（是否可以直接入库）、error（无法入库的原因）
+    """
+    frame = words_results_to_frame(records, BANK_SLIP_FIELDS).with_columns(
+        raw_error=pl.when(
+            pl.Series([record.result_type == "bank_slip" for record in records])
+        )
+        .then(pl.col("raw_error"))
+        .otherwise(pl.lit("不是银行回单"))
+    )
+    return (
+        clean_journal_frame(frame.lazy().rename(BANK_SLIP_JOURNAL_COLUMNS))
+        .drop("raw_error")
+        .collect()
+    )
+
+
+def process_invoices(records: Sequence["OCRRecord"]) -> pl.DataFrame:
+    """批量整理增值税发票的原始返回值
+
+    Args:
+        records (Sequence[OCRRecord]): 增值税发票的识别记录
+
+    Returns:
+        pl.DataFrame: 列名和 INVOICE_FIELDS 一致，日期是 Date，金额是 Decimal，
+        另外包含 is_valid 和 error 两列
+    """
+    text_columns = [
+        column
+        for column in INVOICE_FIELDS
+        if column != "invoice_date" and column not in INVOICE_AMOUNT_COLUMNS
+    ]
+    return (
+        words_results_to_frame(records, INVOICE_FIELDS)
+        .lazy()
+        .with_columns(
+            parse_date_expr(normalize_text(pl.col("invoice_date"))),
+            *(
+                parse_amount_expr(normalize_text(pl.col(column)))
+                for column in INVOICE_AMOUNT_COLUMNS
+            ),
+            *(normalize_text(pl.col(column)) for column in text_columns),
+        )
+        .with_columns(
+            pl.coalesce(
+                pl.col("raw_error"),
+                validate_exprs(["invoice_date", "invoice_code", "price_included_tax"]),
+            ).alias("error")
+        )
+        .with_columns(is_valid=pl.col("error").is_null())
+        .drop("raw_error")
+        .collect()
+    )
+
+
+def journals_to_frame(journals: list[dict]) -> pl.DataFrame:
+    """用和 process_bank_slips 相同的表达式清洗待入库的流水（例如 upload 页面表格里修改过的值）
+
+    Args:
+        journals (list[dict]): JournalAccount 字段组成的字典，只使用日期、金额、付款方和收款方
+
+    Returns:
+        pl.DataFrame: trade_date（Date）、amount（Decimal）、payer、receiver、is_valid、error
+    """
+    frame = pl.DataFrame(
+        {
+            column: [
+                str(journal[column]) if journal.get(column) else None
+                for journal in journals
+            ]
+            for column in JOURNAL_REQUIRED_COLUMNS
+        },
+        schema={column: pl.String for column in JOURNAL_REQUIRED_COLUMNS},
+    )
+    return clean_journal_frame(frame.lazy()).collect()
+
+
+def validate_exprs(required_columns: list[str]) -> pl.Expr:
+    """生成 error 列：列出所有为空的必填字段，全部字段都有值时为 null"""
+    return (
+        pl.concat_str(
+            [
+                pl.when(pl.col(column).is_null()).then(pl.lit(f"{column} 未识别"))
+                for column in required_columns
+            ],
+            separator="；",
+            ignore_nulls=True,
+        )
+        .alias("error")
+        .replace("", None)
+    )
+
+
+def frame_to_journal_records(df: pl.DataFrame) -> list[dict]:
+    """把 process_bank_slips 或 journals_to_frame 的结果中可以入库的行转化为 JournalAccount 使用的字典
+
+    Args:
+        df (pl.DataFrame): process_bank_slips 或 journals_to_frame 的返回值
+
+    Returns:
+        list[dict]: trade_date（date）、amount（str）、payer、receiver
+    """
+    return (
+        df.filter(pl.col("is_valid"))
+        .select(
+            "trade_date",
+            pl.col("amount").cast(pl.String),
+            "payer",
+            "receiver",
+        )
+        .to_dicts()
+    )
@@ -0,0 +1,367 @@
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import func, or_, update
+from sqlmodel import select
+
+from .. import db
+from ..models import CategoryRule, JournalAccount, bump_table_version, get_table_version
+from .counterparty import counterparty_cache
+from .dedup import WIDTH_TRANS_TABLE, normalize_amount
+from .log import logger
+
+INF = float("inf")
+
+
+def normalize_keyword(text: str | None) -> str:
+    """关键词和项目描述的标准化：全角转半角、字母转为大写"""
+    if not text:
+        return ""
+    return text.translate(WIDTH_TRANS_TABLE).upper()
+
+
+def amount_cents(amount: str | Decimal | None) -> int | None:
+    """金额转化为以分为单位的整数，无法转化时返回 None"""
+    try:
+        return int(Decimal(normalize_amount(amount)) * 100)
+    except InvalidOperation:
+        return None
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    """预处理后的 CategoryRule，金额转化为分，关键词已经标准化"""
+
+    id: int
+    category: str
+    rank: tuple[int, int]  # (priority, id)，越小越优先
+    counterparty_id: int | None
+    keyword: str
+    min_cents: float
+    max_cents: float
+
+    @classmethod
+    def from_rule(cls, rule: CategoryRule) -> "CompiledRule":
+        min_cents = amount_cents(rule.min_amount) if rule.min_amount else -INF
+        max_cents = amount_cents(rule.max_amount) if rule.max_amount else INF
+        if min_cents is None or max_cents is None:
+            raise ValueError(f"规则「{rule.name}」的金额范围不是有效的数字")
+        return cls(
+            id=rule.id,  # type:ignore
+            category=rule.category,
+            rank=(rule.priority, rule.id),  # type:ignore
+            counterparty_id=rule.counterparty_id,
+            keyword=normalize_keyword(rule.keyword),
+            min_cents=min_cents,
+            max_cents=max_cents,
+        )
+
+    @property
+    def has_amount_range(self) -> bool:
+        return self.min_cents != -INF or self.max_cents != INF
+
+    def matches(
+        self,
+        party_ids: tuple[int | None, int | None],
+        description: str,
+        cents: int | None,
+    ) -> bool:
+        if self.counterparty_id is not None and self.counterparty_id not in party_ids:
+            return False
+        if self.keyword and self.keyword not in description:
+            return False
+        if self.has_amount_range and (
+            cents is None or not self.min_cents <= cents <= self.max_cents
+        ):
+            return False
+        return True
+
+
+@dataclass
+class RuleIndex:
+    """把所有启用的规则编译成索引，一条流水只需要查找和它相关的少数几条规则：
+
+    1. 设置了交易对象的规则按交易对象 id 放进字典
+    2. 只设置了关键词的规则放进关键词前缀树，扫描一遍项目描述就能找到包含的所有关键词
+    3. 只设置了金额范围的规则，把所有范围的端点排序，切分成互不重叠的区间，
+       预先算好每个区间优先级最高的规则，查找时二分定位金额所在的区间
+
+    分类 N 条流水的时间只和 N 有关，和规则的数量无关
+    """
+
+    rules: list[CompiledRule] = field(default_factory=list)
+    _by_counterparty: dict[int, list[CompiledRule]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+    _keyword_trie: dict = field(default_factory=dict)
+    _bounds: list[float] = field(default_factory=list)
+    _segment_rules: list[CompiledRule | None] = field(default_factory=list)
+
+    # 前缀树节点里保存规则列表的 key，不会和单个字符冲突
+    RULES_KEY = "rules"
+
+    @classmethod
+    def compile(cls, rules: list[CategoryRule]) -> "RuleIndex":
+        index = cls(rules=[CompiledRule.from_rule(rule) for rule in rules])
+        amount_rules = []
+        for rule in index.rules:
+            if rule.counterparty_id is not None:
+                index._by_counterparty[rule.counterparty_id].append(rule)
+            elif rule.keyword:
+                node = index._keyword_trie
+                for char in rule.keyword:
+                    node = node.setdefault(char, {})
+                node.setdefault(cls.RULES_KEY, []).append(rule)
+            else:
+                amount_rules.append(rule)
+
+        if amount_rules:
+            index._bounds = sorted(
+                {rule.min_cents for rule in amount_rules}
+                | {rule.max_cents + 1 for rule in amount_rules}
+            )
+            for start in index._bounds[:-1]:
+                covering = [
+                    rule
+                    for rule in amount_rules
+                    if rule.min_cents <= start <= rule.max_cents
+                ]
+                index._segment_rules.append(
+                    min(covering, key=lambda rule: rule.rank) if covering else None
+                )
+        return index
+
+    def _keyword_candidates(self, description: str) -> list[CompiledRule]:
+        candidates = []
+        for start in range(len(description)):
+            node = self._keyword_trie
+            for char in description[start:]:
+                node = node.get(char)
+                if node is None:
+                    break
+                candidates.extend(node.get(self.RULES_KEY, ()))
+        return candidates
+
+    def _amount_candidate(self, cents: int | None) -> CompiledRule | None:
+        if cents is None or not self._bounds:
+            return None
+        position = bisect_right(self._bounds, cents) - 1
+        if 0 <= position < len(self._segment_rules):
+            return self._segment_rules[position]
+        return None
+
+    def match(self, record: dict) -> CompiledRule | None:
+        """找到流水满足的优先级最高的规则，没有满足的规则时返回 None"""
+        if not self.rules:
+            return None
+
+        party_ids = (record.get("payer_id"), record.get("receiver_id"))
+        if self._by_counterparty and party_ids == (None, None):
+            # 还没有入库的流水只有户名，只查询缓存，不新建交易对象
+            party_ids = (
+                counterparty_cache.lookup(record.get("payer") or ""),
+                counterparty_cache.lookup(record.get("receiver") or ""),
+            )
+        description = normalize_keyword(record.get("description"))
+        cents = amount_cents(record.get("amount"))
+
+        candidates = [
+            *self._by_counterparty.get(party_ids[0], ()),  # type:ignore
+            *(
+                self._by_counterparty.get(party_ids[1], ())  # type:ignore
+                if party_ids[1] != party_ids[0]
+                else ()
+            ),
+            *self._keyword_candidates(description),
+        ]
+        best = self._amount_candidate(cents)
+        for rule in candidates:
+            if (best is None or rule.rank < best.rank) and rule.matches(
+                party_ids, description, cents
+            ):
+                best = rule
+        return best
+
+
+_index_lock = threading.Lock()
+_cached_index: tuple[int, RuleIndex] | None = None  # (规则表的版本号, 编译后的索引)
+
+
+def get_rule_index() -> RuleIndex:
+    """获取编译后的规则索引，规则表的版本号变化后重新编译"""
+    global _cached_index
+    version = get_table_version(CategoryRule.__tablename__)  # type:ignore
+    with _index_lock:
+        if _cached_index is None or _cached_index[0] != version:
+            with db.session() as session:
+                rules = session.exec(
+                    select(CategoryRule).where(
+                        CategoryRule.enabled.is_(True)  # type:ignore
+                    )
+                ).all()
+            _cached_index = (version, RuleIndex.compile(list(rules)))
+        return _cached_index[1]
+
+
+def save_rule(rule: CategoryRule) -> CategoryRule:
+    """新建或修改规则，金额范围无效或者没有设置任何条件时抛出 ValueError"""
+    if not rule.category.strip():
+        raise ValueError("请填写分类")
+    if (
+        rule.counterparty_id is None
+        and not rule.keyword
+        and not (rule.min_amount or rule.max_amount)
+    ):
+        raise ValueError("请至少设置交易对象、关键词、金额范围中的一个条件")
+    compiled = CompiledRule.from_rule(rule)
+    if compiled.min_cents > compiled.max_cents:
+        raise ValueError("最小金额不能大于最大金额")
+
+    with db.session() as session:
+        session.add(rule)
+        bump_table_version(session, CategoryRule.__tablename__)  # type:ignore
+        session.commit()
+        session.refresh(rule)
+    return rule
+
+
+def delete_rule(rule_id: int) -> None:
+    """删除规则，已经按这条规则填写的分类保留，重新分类时才会改变"""
+    with db.session() as session:
+        rule = session.get(CategoryRule, rule_id)
+        if rule:
+            session.delete(rule)
+            bump_table_version(session, CategoryRule.__tablename__)  # type:ignore
+            session.commit()
+
+
+def apply_rules(records: list[dict], overwrite: bool = False) -> list[dict]:
+    """给流水填写分类，返回新的字典，records 本身不变
+
+    Args:
+        records (list[dict]): JournalAccount 字段组成的字典
+        overwrite (bool): 是否覆盖按规则填写过的分类，手动填写的分类始终保留
+
+    Returns:
+        list[dict]: 填写了 category 和 category_rule_id 的字典
+    """
+    index = get_rule_index()
+    result = []
+    for record in records:
+        manual = record.get("category") and record.get("category_rule_id") is None
+        if manual or (record.get("category") and not overwrite):
+            result.append(record)
+            continue
+        rule = index.match(record)
+        result.append(
+            {
+                **record,
+                "category": rule.category if rule else "",
+                "category_rule_id": rule.id if rule else None,
+            }
+        )
+    return result
+
+
+@dataclass
+class RecategorizeResult:
+    """一次重新分类的统计结果"""
+
+    scanned: int = 0  # 检查的流水数量（手动填写分类的流水不会检查）
+    updated: int = 0  # 分类发生变化的流水数量
+    hits: Counter = field(default_factory=Counter)  # 规则 id → 命中的流水数量
+
+
+def recategorize_ledger(chunk_size: int = 5000) -> RecategorizeResult:
+    """用当前的规则重新给整个账本分类，手动填写的分类不会被覆盖
+
+    Returns:
+        RecategorizeResult: 统计结果
+    """
+    start_time = time.time()
+    result = RecategorizeResult()
+    index = get_rule_index()
+
+    last_id = 0
+    while True:
+        with db.session() as session:
+            rows = session.exec(
+                select(
+                    JournalAccount.id,
+                    JournalAccount.description,
+                    JournalAccount.amount,
+                    JournalAccount.payer_id,
+                    JournalAccount.receiver_id,
+                    JournalAccount.category,
+                    JournalAccount.category_rule_id,
+                )
+                .where(
+                    JournalAccount.id > last_id,  # type:ignore
+                    or_(
+                        JournalAccount.category == "",
+                        JournalAccount.category_rule_id.is_not(None),  # type:ignore
+                    ),
+                )
+                .order_by(JournalAccount.id)  # type:ignore
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            result.scanned += len(rows)
+
+            changes = []
+            for row in rows:
+                rule = index.match(row._mapping)  # type:ignore
+                if rule:
+                    result.hits[rule.id] += 1
+                new_values = (
+                    rule.category if rule else "",
+                    rule.id if rule else None,
+                )
+                if new_values != (row.category, row.category_rule_id):
+                    changes.append(
+                        {
+                            "id": row.id,
+                            "category": new_values[0],
+                            "category_rule_id": new_values[1],
+                        }
+                    )
+
+            if changes:
+                session.execute(update(JournalAccount), changes)
+                bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+                session.commit()
+                result.updated += len(changes)
+
+    logger.info(
+        f"重新分类完成，检查了 {result.scanned} 条流水，修改了 {result.updated} 条，"
+        f"用时：{time.time() - start_time:.2f}s"
+    )
+    return result
+
+
+async def rule_hit_stats() -> dict[int, int]:
+    """每条规则当前分类的流水数量
+
+    Returns:
+        dict[int, int]: 规则 id → 流水数量
+    """
+    async with db.asession() as session:
+        result = await session.execute(
+            select(JournalAccount.category_rule_id, func.count())
+            .where(JournalAccount.category_rule_id.is_not(None))  # type:ignore
+            .group_by(JournalAccount.category_rule_id)
+        )
+        return {rule_id: count for rule_id, count in result.all()}
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.categorize
+    recategorize_result = recategorize_ledger()
+    for rule_id, count in recategorize_result.hits.most_common():
+        print(f"规则 {rule_id}：{count} 条流水")
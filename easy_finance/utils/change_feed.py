@@ -0,0 +1,104 @@
+import asyncio
+import json
+from contextlib import suppress
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, Callable, Literal
+
+from reflex import constants
+
+from .log import logger
+from .shared_store import get_shared_store
+
+"""
+流水修改的消息频道
+
+写操作把修改的流水发布到频道里，每个打开了 /display 的用户订阅这个频道，
+收到消息后只把修改的行发送给前端表格，不需要重新加载全部数据。
+配置了 Redis 时消息通过 Redis 的 pub/sub 发送，不同后端进程里的用户也能收到
+"""
+
+JOURNAL_CHANNEL = "journal_changes"
+CONNECTION_CHECK_INTERVAL = 5  # 检查用户是否还在线的间隔（秒）
+
+# add：新增的流水，update：修改的流水，reload：批量修改（重新分类、对账、导入对账单等），
+# 需要重新加载全部数据
+ChangeAction = Literal["add", "update", "reload"]
+
+
+@dataclass
+class ChangeEvent:
+    action: ChangeAction
+    rows: list[dict] = field(default_factory=list)  # 修改后的流水，reload 时为空
+    origin: str = ""  # 发出修改的用户的 client token，这个用户的表格已经是最新的
+
+    def encode(self) -> bytes:
+        # 日期等类型和 reflex 序列化的结果一样转化为字符串
+        return json.dumps(asdict(self), ensure_ascii=False, default=str).encode("utf-8")
+
+    @classmethod
+    def decode(cls, data: bytes) -> "ChangeEvent":
+        return cls(**json.loads(data))
+
+
+async def publish_changes(
+    action: ChangeAction, rows: list[dict] | None = None, origin: str = ""
+) -> None:
+    """发布流水的修改，发布失败只记录日志，不影响已经完成的写操作
+
+    Args:
+        action (ChangeAction): 修改的类型
+        rows (list[dict] | None): 修改后的流水，JournalAccount 的字段（不包括 raw_response）
+        origin (str): 发出修改的用户的 client token
+    """
+    rows = [{**row, "archived": False} for row in rows or []]
+    try:
+        await get_shared_store().publish(
+            JOURNAL_CHANNEL, ChangeEvent(action, rows, origin).encode()
+        )
+    except Exception as e:
+        logger.error(f"发布流水修改失败：{e}", extra={"action": action})
+
+
+def client_connected(token: str, sid: str) -> bool:
+    """用户的 websocket 连接是否还在当前进程里，刷新页面后 sid 会改变"""
+    # prerequisites 会导入 alembic、httpx 等模块，启动时不需要
+    from reflex.utils import prerequisites
+
+    app = getattr(prerequisites.get_app(), constants.CompileVars.APP)
+    return app.event_namespace.token_to_sid.get(token) == sid
+
+
+async def subscribe_changes(
+    still_listening: Callable[[], bool],
+) -> AsyncIterator[ChangeEvent]:
+    """订阅流水的修改，still_listening 返回 False 时停止
+
+    Args:
+        still_listening (Callable[[], bool]): 每隔 CONNECTION_CHECK_INTERVAL 秒检查一次，
+            一般用于检查用户是否已经断开连接
+
+    Yields:
+        ChangeEvent: 流水的修改，丢失了消息时是 reload
+    """
+    messages = get_shared_store().subscribe(JOURNAL_CHANNEL)
+    # 等待下一条消息的任务，超时后继续等待同一个任务，不会丢失消息
+    next_message = asyncio.ensure_future(anext(messages))
+    try:
+        while still_listening():
+            done, _ = await asyncio.wait(
+                {next_message}, timeout=CONNECTION_CHECK_INTERVAL
+            )
+            if not done:
+                continue
+            message = next_message.result()
+            next_message = asyncio.ensure_future(anext(messages))
+            yield (
+                ChangeEvent("reload")
+                if message is None
+                else ChangeEvent.decode(message)
+            )
+    finally:
+        next_message.cancel()
+        with suppress(asyncio.CancelledError, StopAsyncIteration):
+            await next_message
+        await messages.aclose()
@@ -0,0 +1,406 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import re
+import time
+import uuid
+import weakref
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import AsyncIterator, get_args
+
+import reflex as rx
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from reflex.config import get_config
+from starlette.requests import ClientDisconnect
+
+from ..settings import settings
+from .job_queue import JobQueue, job_queue
+from .log import logger
+from .ocr_provider import RecognizeMode
+from .request_api import new_upload_filename, recognize_filetype
+from .storage import StorageQuotaError, storage_manager
+
+"""
+分片上传
+
+rx.upload 在一个请求里发送所有文件，网络中断后只能全部重新上传，文件多的时候很容易失败。
+这里参考 tus 协议实现了一个可以断点续传的上传接口，前端的实现见 assets/chunked_upload.js：
+
+1. POST /api/uploads 创建上传，参数是批次 id、识别模式、文件名、大小和整个文件的 sha256，
+   同一个批次里的同一个文件总是得到同一个上传 id，已经上传完的文件不会重复上传
+2. GET /api/uploads/{id} 查询已经收到的字节数
+3. PATCH /api/uploads/{id} 从 Upload-Offset 开始追加一个分片，Upload-Checksum 是分片的 sha256，
+   分片边接收边写入磁盘，校验失败或者连接中断时丢弃这个分片，客户端从原来的位置重新发送
+4. 最后一个分片写入后校验整个文件的 sha256，把文件移到上传目录，提交到后台识别任务队列，
+   识别结果和 rx.upload 上传的文件一样由页面的 track_batch 获取
+
+跨域请求读不到自定义的响应头，所以 tus 放在响应头里的 Upload-Offset 放在 JSON 里返回
+"""
+
+PARTIAL_DIR_NAME = ".partial"  # 没有上传完的文件保存在上传目录的这个子文件夹里
+CHUNK_MAX_BYTES = 8 * 1024 * 1024  # 单个分片的最大体积
+CLEANUP_INTERVAL = 3600  # 清理过期上传的间隔（秒）
+UPLOAD_ENDPOINT = "/api/uploads"
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+CHECKSUM_MISMATCH = 460  # tus 协议里校验失败的状态码
+
+
+class UploadError(Exception):
+    """上传请求不符合要求，offset 是服务器上已经收到的字节数，客户端从这里继续上传"""
+
+    def __init__(self, status_code: int, detail: str, offset: int | None = None):
+        self.status_code = status_code
+        self.detail = detail
+        self.offset = offset
+        super().__init__(detail)
+
+
+@dataclass
+class UploadSession:
+    id: str
+    batch_id: str
+    mode: str
+    file_name: str  # 用户上传时的文件名
+    size: int  # 文件的总字节数
+    sha256: str = ""  # 整个文件的 sha256，浏览器不支持计算时为空
+    created_at: float = 0.0
+    stored_name: str = ""  # 上传完成后保存到上传目录的文件名
+
+    @property
+    def completed(self) -> bool:
+        return bool(self.stored_name)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as file_object:
+        while data := file_object.read(1024 * 1024):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def parse_checksum(header: str | None) -> bytes | None:
+    """解析 Upload-Checksum 请求头，格式是 "sha256 <base64>"，没有这个请求头时返回 None"""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(" ")
+    if algorithm.lower() != "sha256":
+        raise UploadError(400, f"不支持的校验算法：{algorithm}")
+    try:
+        return base64.b64decode(value, validate=True)
+    except binascii.Error:
+        raise UploadError(400, "Upload-Checksum 格式错误")
+
+
+class UploadStore:
+    """没有上传完的文件和上传信息保存在磁盘上，后端重启后也可以继续上传"""
+
+    def __init__(
+        self,
+        directory: Path | None = None,
+        queue: JobQueue = job_queue,
+        max_bytes: int = settings.upload_max_bytes,
+        expire_seconds: float = settings.upload_expire_hours * 3600,
+    ):
+        self._directory = directory
+        self.queue = queue
+        self.max_bytes = max_bytes
+        self.expire_seconds = expire_seconds
+        self._last_cleanup = 0.0
+        # 同一个上传的请求依次处理，不用的锁会被自动回收
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = (
+            weakref.WeakValueDictionary()
+        )
+
+    @property
+    def directory(self) -> Path:
+        if self._directory is None:
+            self._directory = rx.get_upload_dir() / PARTIAL_DIR_NAME
+        self._directory.mkdir(parents=True, exist_ok=True)
+        return self._directory
+
+    def _lock(self, upload_id: str) -> asyncio.Lock:
+        lock = self._locks.get(upload_id)
+        if lock is None:
+            lock = self._locks[upload_id] = asyncio.Lock()
+        return lock
+
+    def _info_path(self, upload_id: str) -> Path:
+        return self.directory / f"{upload_id}.json"
+
+    def _part_path(self, upload_id: str) -> Path:
+        return self.directory / f"{upload_id}.part"
+
+    def _load(self, upload_id: str) -> UploadSession | None:
+        if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+            return None
+        try:
+            return UploadSession(
+                **json.loads(self._info_path(upload_id).read_text("utf-8"))
+            )
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            return None
+
+    def _save(self, session: UploadSession) -> None:
+        # 先写临时文件再替换，进程中断时不会留下写了一半的上传信息
+        temp_path = self._info_path(session.id).with_suffix(".tmp")
+        temp_path.write_text(json.dumps(asdict(session), ensure_ascii=False), "utf-8")
+        temp_path.replace(self._info_path(session.id))
+
+    def offset(self, session: UploadSession) -> int:
+        """服务器上已经收到的字节数"""
+        if session.completed:
+            return session.size
+        try:
+            return self._part_path(session.id).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    async def get(self, upload_id: str) -> UploadSession:
+        session = await asyncio.to_thread(self._load, upload_id)
+        if session is None:
+            raise UploadError(404, "上传不存在或者已经过期")
+        return session
+
+    async def create(
+        self, batch_id: str, mode: str, file_name: str, size: int, sha256: str = ""
+    ) -> UploadSession:
+        """创建一个上传，同一个批次里 sha256 相同的文件返回之前创建的上传"""
+        if not batch_id:
+            raise UploadError(400, "缺少批次 id")
+        if mode not in get_args(RecognizeMode):
+            raise UploadError(400, f"未知的识别模式：{mode}")
+        try:
+            recognize_filetype(file_name)
+        except TypeError:
+            raise UploadError(400, f"不支持的文件类型：{file_name}")
+        if size <= 0:
+            raise UploadError(400, f"文件「{file_name}」是空的")
+        if size > self.max_bytes:
+            raise UploadError(
+                413, f"文件「{file_name}」超过 {self.max_bytes // 1024 // 1024}mb"
+            )
+        sha256 = sha256.lower()
+        if sha256 and not SHA256_PATTERN.fullmatch(sha256):
+            raise UploadError(400, "sha256 格式错误")
+
+        await self.cleanup_expired()
+
+        upload_id = (
+            hashlib.sha256(f"{batch_id}:{sha256}".encode()).hexdigest()[:32]
+            if sha256
+            else uuid.uuid4().hex
+        )
+        async with self._lock(upload_id):
+            session = await asyncio.to_thread(self._load, upload_id)
+            if session is None or session.size != size:
+                try:
+                    storage_manager.reserve(size)
+                except StorageQuotaError as e:
+                    raise UploadError(507, str(e))
+                session = UploadSession(
+                    upload_id, batch_id, mode, file_name, size, sha256, time.time()
+                )
+                await asyncio.to_thread(self._save, session)
+        return session
+
+    async def append(
+        self,
+        upload_id: str,
+        offset: int,
+        chunks: AsyncIterator[bytes],
+        checksum: str | None = None,
+    ) -> UploadSession:
+        """从 offset 开始写入一个分片，写入最后一个分片后完成上传
+
+        Args:
+            upload_id (str): 上传 id
+            offset (int): 分片在文件里的起始位置，必须等于服务器上已经收到的字节数
+            chunks (AsyncIterator[bytes]): 分片内容，边接收边写入磁盘
+            checksum (str | None): Upload-Checksum 请求头
+
+        Returns:
+            UploadSession: 写入后的上传信息
+        """
+        expected = parse_checksum(checksum)
+        async with self._lock(upload_id):
+            session = await self.get(upload_id)
+            current = await asyncio.to_thread(self.offset, session)
+            if session.completed or offset != current:
+                raise UploadError(409, "上传位置和服务器不一致", current)
+
+            digest = hashlib.sha256()
+            received = 0
+            part_path = self._part_path(upload_id)
+            file_object = await asyncio.to_thread(part_path.open, "ab")
+            try:
+                async for data in chunks:
+                    received += len(data)
+                    if received > CHUNK_MAX_BYTES or offset + received > session.size:
+                        raise UploadError(413, "分片超过文件大小", offset)
+                    digest.update(data)
+                    await asyncio.to_thread(file_object.write, data)
+                if expected is not None and digest.digest() != expected:
+                    raise UploadError(CHECKSUM_MISMATCH, "分片校验失败", offset)
+            except BaseException:
+                # 校验失败或者连接中断，丢弃这个分片已经写入的内容，客户端从 offset 重新发送
+                file_object.flush()
+                file_object.truncate(offset)
+                raise
+            finally:
+                file_object.close()
+
+            if offset + received == session.size:
+                await self._complete(session)
+            return session
+
+    async def _complete(self, session: UploadSession) -> None:
+        """校验整个文件，移到上传目录后提交到后台识别任务队列"""
+        part_path = self._part_path(session.id)
+        if session.sha256:
+            if await asyncio.to_thread(file_sha256, part_path) != session.sha256:
+                await asyncio.to_thread(part_path.unlink)
+                raise UploadError(CHECKSUM_MISMATCH, "文件校验失败，需要重新上传", 0)
+
+        stored_name = new_upload_filename(session.file_name)
+        await asyncio.to_thread(part_path.replace, rx.get_upload_dir() / stored_name)
+        # 先提交再保存上传信息，保存前中断时客户端会重新上传，不会漏掉这个文件
+        await self.queue.submit(
+            session.batch_id, session.mode, [(session.file_name, stored_name)]
+        )
+        session.stored_name = stored_name
+        await asyncio.to_thread(self._save, session)
+        logger.info(
+            f"文件「{session.file_name}」分片上传完成",
+            extra={"batch_id": session.batch_id, "size": session.size},
+        )
+
+    async def delete(self, upload_id: str) -> None:
+        """取消上传，删除已经收到的内容"""
+        async with self._lock(upload_id):
+            session = await self.get(upload_id)
+            await asyncio.to_thread(self._remove, session.id)
+
+    def _remove(self, upload_id: str) -> None:
+        self._part_path(upload_id).unlink(missing_ok=True)
+        self._info_path(upload_id).unlink(missing_ok=True)
+
+    def _remove_expired(self, now: float) -> int:
+        removed = 0
+        for info_path in self.directory.glob("*.json"):
+            session = self._load(info_path.stem)
+            if session is None or now - session.created_at > self.expire_seconds:
+                self._remove(info_path.stem)
+                removed += 1
+        return removed
+
+    async def cleanup_expired(self) -> None:
+        """删除过期的上传，每 CLEANUP_INTERVAL 秒最多执行一次"""
+        now = time.time()
+        if now - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        removed = await asyncio.to_thread(self._remove_expired, now)
+        if removed:
+            logger.info(f"删除了 {removed} 个过期的分片上传")
+
+
+upload_store = UploadStore()
+
+
+class CreateUploadRequest(BaseModel):
+    batch_id: str
+    mode: str
+    file_name: str
+    size: int
+    sha256: str = ""
+
+
+def upload_response(session: UploadSession, status_code: int = 200) -> JSONResponse:
+    return JSONResponse(
+        {
+            "id": session.id,
+            "offset": upload_store.offset(session),
+            "size": session.size,
+            "completed": session.completed,
+        },
+        status_code=status_code,
+    )
+
+
+def error_response(error: UploadError) -> JSONResponse:
+    return JSONResponse(
+        {"detail": error.detail, "offset": error.offset},
+        status_code=error.status_code,
+    )
+
+
+router = APIRouter(prefix=UPLOAD_ENDPOINT)
+
+
+@router.post("")
+async def create_upload(body: CreateUploadRequest) -> JSONResponse:
+    try:
+        session = await upload_store.create(
+            body.batch_id, body.mode, body.file_name, body.size, body.sha256
+        )
+    except UploadError as e:
+        return error_response(e)
+    return upload_response(session, 201)
+
+
+@router.get("/{upload_id}")
+async def get_upload(upload_id: str) -> JSONResponse:
+    try:
+        session = await upload_store.get(upload_id)
+    except UploadError as e:
+        return error_response(e)
+    return upload_response(session)
+
+
+@router.patch("/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request) -> JSONResponse:
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        return error_response(UploadError(400, "缺少 Upload-Offset"))
+    try:
+        session = await upload_store.append(
+            upload_id,
+            offset,
+            request.stream(),
+            request.headers.get("upload-checksum"),
+        )
+    except UploadError as e:
+        return error_response(e)
+    except ClientDisconnect:
+        return error_response(UploadError(400, "连接中断", offset))
+    return upload_response(session)
+
+
+@router.delete("/{upload_id}")
+async def delete_upload(upload_id: str) -> JSONResponse:
+    try:
+        await upload_store.delete(upload_id)
+    except UploadError as e:
+        return error_response(e)
+    return JSONResponse({"id": upload_id})
+
+
+def upload_script(input_id: str, batch_id: str, mode: str, progress_id: str) -> str:
+    """生成调用 assets/chunked_upload.js 上传文件选择框里所有文件的 js 代码"""
+    options = {
+        "endpoint": f"{get_config().api_url}{UPLOAD_ENDPOINT}",
+        "batchId": batch_id,
+        "mode": mode,
+        "chunkSize": settings.upload_chunk_size,
+        "maxBytes": settings.upload_max_bytes,
+        "progressId": progress_id,
+    }
+    return f"window.easyFinanceUpload({json.dumps(input_id)}, {json.dumps(options)})"
@@ -0,0 +1,377 @@
+import asyncio
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable
+
+from sqlalchemy import Table, false, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+
+from .. import db
+from ..models import Counterparty, CounterpartyAlias, JournalAccount, bump_table_version
+from .dedup import normalize_party, within_one_edit
+from .log import logger
+
+# 标准化后的户名至少有这么长时才做模糊匹配，
+# 个人姓名（例如 "张三" 和 "张四"）只差一个字也是不同的人
+MIN_FUZZY_LENGTH = 6
+# 纳税人识别号和银行账号里只保留数字和字母
+IDENTIFIER_NOISE_PATTERN = re.compile(r"[^0-9A-Za-z]")
+
+# 户名 → (纳税人识别号, 银行账号)，见 OCRRecord.to_counterparties
+Identifiers = dict[str, tuple[str, str]]
+
+
+def normalize_identifier(value: str | None) -> str:
+    """纳税人识别号和银行账号标准化：去掉空格和符号，字母转为大写"""
+    return IDENTIFIER_NOISE_PATTERN.sub("", value or "").upper()
+
+
+def deletion_neighbours(alias: str) -> set[str]:
+    """alias 本身和删掉任意一个字后的字符串，编辑距离不超过 1 的两个字符串的删除邻域一定有交集"""
+    return {alias} | {alias[:i] + alias[i + 1 :] for i in range(len(alias))}
+
+
+class CounterpartyCache:
+    """别名 → 交易对象 id 的内存缓存
+
+    1. 应用启动时由 warm 从数据库加载所有别名
+    2. resolve 先查缓存，没有命中时再按 "只差一个字" 模糊匹配已有的交易对象，
+       只有纳税人识别号或者银行账号也相同时才合并（"上海一二科技" 和 "上海一三科技" 可能是两家公司），
+       没有匹配到就新建交易对象，新的别名会同时写入数据库和缓存
+    3. 票据上识别出的纳税人识别号和银行账号会补充到交易对象上，供以后的模糊匹配使用
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aliases: dict[str, int] = {}  # 标准化后的别名 → 交易对象 id
+        self._names: dict[int, str] = {}  # 交易对象 id → 标准名称
+        self._tax_ids: dict[int, str] = {}  # 交易对象 id → 纳税人识别号
+        self._accounts: dict[int, set[str]] = {}  # 交易对象 id → 银行账号
+        # 删除邻域索引：别名本身和删掉任意一个字后的字符串 → 别名，
+        # 只差一个字的两个别名至少有一个共同的 key，模糊匹配时不需要和所有别名比较
+        self._neighbours: dict[str, list[str]] = defaultdict(list)
+        self.warmed = False
+
+    def _add_alias(self, alias: str, counterparty_id: int) -> None:
+        if alias not in self._aliases:
+            self._aliases[alias] = counterparty_id
+            # 比 MIN_FUZZY_LENGTH 短两个字以上的别名不会被模糊匹配到
+            if len(alias) >= MIN_FUZZY_LENGTH - 1:
+                for key in deletion_neighbours(alias):
+                    self._neighbours[key].append(alias)
+
+    def warm(self) -> None:
+        """从数据库加载所有交易对象和别名"""
+        start_time = time.time()
+        with db.session() as session:
+            counterparties = session.exec(
+                select(
+                    Counterparty.id,
+                    Counterparty.name,
+                    Counterparty.tax_id,
+                    Counterparty.accounts,
+                )
+            ).all()
+            aliases = session.exec(
+                select(CounterpartyAlias.alias, CounterpartyAlias.counterparty_id)
+            ).all()
+
+        with self._lock:
+            self._aliases.clear()
+            self._neighbours.clear()
+            self._names = {row.id: row.name for row in counterparties}
+            self._tax_ids = {row.id: row.tax_id for row in counterparties}
+            self._accounts = {
+                row.id: set(filter(None, row.accounts.split(",")))
+                for row in counterparties
+            }
+            for alias, counterparty_id in aliases:
+                self._add_alias(alias, counterparty_id)
+            self.warmed = True
+
+        logger.info(
+            f"加载了 {len(self._names)} 个交易对象和 {len(self._aliases)} 个别名，"
+            f"用时：{time.time() - start_time:.2f}s"
+        )
+
+    def get_name(self, counterparty_id: int) -> str:
+        return self._names.get(counterparty_id, "")
+
+    def lookup(self, name: str) -> int | None:
+        """只查缓存，不会新建交易对象，用于筛选"""
+        if not self.warmed:
+            self.warm()
+        return self._aliases.get(normalize_party(name))
+
+    def _fuzzy_lookup(self, alias: str, tax_id: str, account: str) -> int | None:
+        """找到和 alias 只差一个字，并且纳税人识别号或者银行账号相同的交易对象"""
+        # 没有纳税人识别号和银行账号时不会合并，不需要查找
+        if len(alias) < MIN_FUZZY_LENGTH or not (tax_id or account):
+            return None
+        candidates = {
+            candidate
+            for key in deletion_neighbours(alias)
+            for candidate in self._neighbours.get(key, ())
+        }
+        similar = None
+        for candidate in candidates:
+            if not within_one_edit(alias, candidate):
+                continue
+            counterparty_id = self._aliases[candidate]
+            if (tax_id and self._tax_ids.get(counterparty_id) == tax_id) or (
+                account and account in self._accounts.get(counterparty_id, ())
+            ):
+                return counterparty_id
+            similar = counterparty_id
+        if similar is not None:
+            logger.info(
+                f"「{alias}」和交易对象「{self._names.get(similar)}」只差一个字，"
+                "但纳税人识别号和银行账号都对不上，作为新的交易对象，需要人工确认是否合并",
+                extra={"counterparty_id": similar},
+            )
+        return None
+
+    def resolve_many(
+        self, names: Iterable[str | None], identifiers: Identifiers | None = None
+    ) -> dict[str, int]:
+        """把户名转化为交易对象 id，缓存里没有的户名会写入数据库
+
+        Args:
+            names (Iterable[str | None]): 户名，空值会被忽略
+            identifiers (Identifiers | None): 票据上识别出的纳税人识别号和银行账号，
+                用于模糊匹配，并补充到交易对象上
+
+        Returns:
+            dict[str, int]: 户名 → 交易对象 id
+        """
+        names = set(names)
+        identifiers = {
+            name: (normalize_identifier(tax_id), normalize_identifier(account))
+            for name, (tax_id, account) in (identifiers or {}).items()
+        }
+        try:
+            return self._resolve(names, identifiers)
+        except IntegrityError:
+            # 多个后端进程同时写入了同一个别名，重新加载缓存后再试一次，这次会读到其他进程写入的别名
+            logger.info("交易对象别名已经被其他进程写入，重新加载缓存")
+            return self._resolve(names, identifiers)
+
+    def _new_identifiers(
+        self, result: dict[str, int], identifiers: Identifiers
+    ) -> dict[int, tuple[str, str]]:
+        """交易对象 id → 还没有记录的 (纳税人识别号, 银行账号)"""
+        updates = {}
+        for name, counterparty_id in result.items():
+            tax_id, account = identifiers.get(name, ("", ""))
+            if self._tax_ids.get(counterparty_id):  # 已经有的纳税人识别号不会被覆盖
+                tax_id = ""
+            if account in self._accounts.get(counterparty_id, ()):
+                account = ""
+            if tax_id or account:
+                updates[counterparty_id] = (tax_id, account)
+        return updates
+
+    def _resolve(
+        self, names: set[str | None], identifiers: Identifiers
+    ) -> dict[str, int]:
+        if not self.warmed:
+            self.warm()
+
+        result: dict[str, int] = {}
+        with self._lock:
+            pending: dict[str, list[str]] = defaultdict(list)  # 新别名 → 原始户名
+            for name in names:
+                alias = normalize_party(name)
+                if not alias:
+                    continue
+                if alias in self._aliases:
+                    result[name] = self._aliases[alias]  # type:ignore
+                else:
+                    pending[alias].append(name)  # type:ignore
+
+            if not pending and not self._new_identifiers(result, identifiers):
+                return result
+
+            try:
+                self._save_aliases(pending, result, identifiers)
+            except Exception:
+                # 数据库写入失败时，缓存里可能已经有没保存的别名，下次使用前重新加载
+                self.warmed = False
+                raise
+
+        return result
+
+    def _save_aliases(
+        self,
+        pending: dict[str, list[str]],
+        result: dict[str, int],
+        identifiers: Identifiers,
+    ) -> None:
+        """新建别名（必要时新建交易对象），结果写入 result，并补充交易对象的纳税人识别号和银行账号"""
+        with db.session() as session:
+            matched: dict[str, int] = {}  # 模糊匹配到已有交易对象的新别名
+            created: dict[str, Counterparty] = {}  # 需要新建交易对象的新别名
+            for alias, raw_names in pending.items():
+                found = [identifiers.get(name, ("", "")) for name in raw_names]
+                tax_id = next((tax_id for tax_id, _ in found if tax_id), "")
+                account = next((account for _, account in found if account), "")
+                counterparty_id = self._fuzzy_lookup(alias, tax_id, account)
+                if counterparty_id is None:
+                    created[alias] = Counterparty(name=raw_names[0].strip())
+                else:
+                    matched[alias] = counterparty_id
+
+            # 新建的交易对象一次性写入，不需要每个都单独 flush
+            session.add_all(created.values())
+            session.flush()
+            for alias, counterparty in created.items():
+                self._names[counterparty.id] = counterparty.name  # type:ignore
+                matched[alias] = counterparty.id  # type:ignore
+
+            session.add_all(
+                CounterpartyAlias(alias=alias, counterparty_id=counterparty_id)
+                for alias, counterparty_id in matched.items()
+            )
+            for alias, counterparty_id in matched.items():
+                self._add_alias(alias, counterparty_id)
+                for name in pending[alias]:
+                    result[name] = counterparty_id
+
+            updates = []
+            for counterparty_id, (tax_id, account) in self._new_identifiers(
+                result, identifiers
+            ).items():
+                if tax_id:
+                    self._tax_ids[counterparty_id] = tax_id
+                if account:
+                    self._accounts.setdefault(counterparty_id, set()).add(account)
+                updates.append(
+                    {
+                        "id": counterparty_id,
+                        "tax_id": self._tax_ids.get(counterparty_id, ""),
+                        "accounts": ",".join(
+                            sorted(self._accounts.get(counterparty_id, ()))
+                        ),
+                    }
+                )
+            if updates:
+                # 按主键批量更新
+                session.execute(update(Counterparty), updates)
+            session.commit()
+
+
+counterparty_cache = CounterpartyCache()
+
+
+def assign_counterparty_ids(
+    records: list[dict], identifiers: Identifiers | None = None
+) -> list[dict]:
+    """给待入库的流水加上 payer_id 和 receiver_id
+
+    Args:
+        records (list[dict]): JournalAccount 字段组成的字典
+        identifiers (Identifiers | None): 银行回单上识别出的银行账号等信息，见 CounterpartyCache.resolve_many
+
+    Returns:
+        list[dict]: 加上了 payer_id 和 receiver_id 的字典
+    """
+    ids = counterparty_cache.resolve_many(
+        [record.get("payer") for record in records]
+        + [record.get("receiver") for record in records],
+        identifiers,
+    )
+    return [
+        {
+            **record,
+            "payer_id": ids.get(record.get("payer")),  # type:ignore
+            "receiver_id": ids.get(record.get("receiver")),  # type:ignore
+        }
+        for record in records
+    ]
+
+
+def counterparty_filter(name: str, table: Table | None = None):
+    """按交易对象筛选流水的条件，同一个交易对象的所有别名都会被筛选出来
+
+    Args:
+        name (str): 交易对象的任意一个别名
+        table (Table | None): 流水所在的表，默认是 journalaccount，也可以是归档表
+
+    Returns:
+        付款方或者收款方是这个交易对象的 where 条件，交易对象不存在时返回永远为假的条件
+    """
+    columns = (
+        table if table is not None else JournalAccount.__table__
+    ).c  # type:ignore
+    counterparty_id = counterparty_cache.lookup(name)
+    if counterparty_id is None:
+        return false()
+    return or_(
+        columns.payer_id == counterparty_id,
+        columns.receiver_id == counterparty_id,
+    )
+
+
+async def warm_counterparty_cache() -> None:
+    """应用启动时预热缓存，作为 reflex 的 lifespan task 运行"""
+    await asyncio.to_thread(counterparty_cache.warm)
+
+
+def migrate_counterparties(chunk_size: int = 5000) -> int:
+    """给还没有 payer_id 或 receiver_id 的历史流水关联交易对象
+
+    Returns:
+        int: 更新的流水数量
+    """
+    start_time = time.time()
+    updated = 0
+    last_id = 0
+    while True:
+        with db.session() as session:
+            rows = session.exec(
+                select(JournalAccount.id, JournalAccount.payer, JournalAccount.receiver)
+                .where(
+                    JournalAccount.id > last_id,  # type:ignore
+                    or_(
+                        JournalAccount.payer_id.is_(None),  # type:ignore
+                        JournalAccount.receiver_id.is_(None),  # type:ignore
+                    ),
+                )
+                .order_by(JournalAccount.id)  # type:ignore
+                .limit(chunk_size)
+            ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        ids = counterparty_cache.resolve_many(
+            [row.payer for row in rows] + [row.receiver for row in rows]
+        )
+        with db.session() as session:
+            session.execute(
+                update(JournalAccount),
+                [
+                    {
+                        "id": row.id,
+                        "payer_id": ids.get(row.payer),
+                        "receiver_id": ids.get(row.receiver),
+                    }
+                    for row in rows
+                ],
+            )
+            bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+            session.commit()
+        updated += len(rows)
+
+    logger.info(
+        f"关联了 {updated} 条流水的交易对象，用时：{time.time() - start_time:.2f}s"
+    )
+    return updated
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.counterparty
+    migrate_counterparties()
@@ -0,0 +1,344 @@
+import hashlib
+import re
+import time
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from typing import Iterable, Literal
+
+from sqlalchemy import update
+from sqlmodel import select
+
+from .. import db
+from ..models import JournalAccount, bump_table_version
+from .archive import (
+    active_table,
+    aarchived_years,
+    journal_partitions,
+    select_journal,
+    select_partition,
+)
+from .log import logger
+from .request_api import FULL_WIDTH_CHARS, HALF_WIDTH_CHARS
+
+DuplicateFlag = Literal["", "重复", "疑似重复"]
+
+# 参与计算指纹的字段，修改这些字段时需要重新计算 JournalAccount.fingerprint
+FINGERPRINT_FIELDS = ("trade_date", "amount", "payer", "receiver")
+
+WIDTH_TRANS_TABLE = str.maketrans(dict(zip(FULL_WIDTH_CHARS, HALF_WIDTH_CHARS)))
+# 户名里的空白和括号、标点不参与比较，OCR 经常把全角括号识别成半角括号，或者多识别出空格
+PARTY_NOISE_PATTERN = re.compile(r"[\s()\[\]{}<>.,;:'\"·、，。；：“”‘’《》【】]")
+
+
+def normalize_party(name: str | None) -> str:
+    """户名标准化：全角转半角、去掉空白和标点、字母转为大写"""
+    if not name:
+        return ""
+    return PARTY_NOISE_PATTERN.sub("", name.translate(WIDTH_TRANS_TABLE)).upper()
+
+
+def normalize_amount(amount: str | Decimal | None) -> str:
+    """金额标准化为两位小数的字符串，"1,000" "1000.0" "1000.00" 都会转化为 "1000.00" """
+    if amount is None or amount == "":
+        return ""
+    try:
+        return str(
+            Decimal(str(amount).translate(WIDTH_TRANS_TABLE).replace(",", "")).quantize(
+                Decimal("0.01")
+            )
+        )
+    except InvalidOperation:
+        return str(amount).strip()
+
+
+def normalize_date(trade_date: date | str | None) -> str:
+    if not trade_date:
+        return ""
+    return trade_date if isinstance(trade_date, str) else trade_date.isoformat()
+
+
+def fingerprint(
+    trade_date: date | str | None,
+    amount: str | Decimal | None,
+    payer: str | None,
+    receiver: str | None,
+) -> str:
+    """一笔流水的指纹，日期、金额、付款方和收款方标准化后相同的流水指纹相同
+
+    账号不参与计算：JournalAccount 没有保存账号，银行对账单里一般也只有对方户名，
+    加入账号后，同一笔交易的银行回单和对账单记录就无法匹配
+
+    Returns:
+        str: 32 位的十六进制字符串
+    """
+    key = "|".join(
+        (
+            normalize_date(trade_date),
+            normalize_amount(amount),
+            normalize_party(payer),
+            normalize_party(receiver),
+        )
+    )
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def record_fingerprint(record: dict) -> str:
+    """JournalAccount 字段组成的字典的指纹"""
+    return fingerprint(
+        record.get("trade_date"),
+        record.get("amount"),
+        record.get("payer"),
+        record.get("receiver"),
+    )
+
+
+def within_one_edit(a: str, b: str) -> bool:
+    """判断两个字符串的编辑距离（Levenshtein）是否不超过 1，只需要扫描一遍，不需要计算完整的距离矩阵"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            if len(a) == len(b):
+                return a[i + 1 :] == b[i + 1 :]  # 替换一个字符
+            return a[i:] == b[i + 1 :]  # 插入一个字符
+    return True  # 只差最后一个字符
+
+
+def is_fuzzy_match(record: dict, candidate: dict) -> bool:
+    """日期和金额相同时，付款方和收款方的差别都不超过一个字符，认为是同一笔流水"""
+    return within_one_edit(
+        normalize_party(record.get("payer")), normalize_party(candidate.get("payer"))
+    ) and within_one_edit(
+        normalize_party(record.get("receiver")),
+        normalize_party(candidate.get("receiver")),
+    )
+
+
+def block_key(record: dict) -> tuple[str, str]:
+    """模糊匹配的分块依据：只有日期和金额都相同的流水才需要比较户名"""
+    return normalize_date(record.get("trade_date")), normalize_amount(
+        record.get("amount")
+    )
+
+
+def load_candidates(records: list[dict]) -> dict[tuple[str, str], list[dict]]:
+    """从数据库读取和 records 日期相同的流水，按 (日期, 金额) 分块
+
+    Args:
+        records (list[dict]): 需要检查的流水
+
+    Returns:
+        dict[tuple[str, str], list[dict]]: 分块后的已有流水
+    """
+    dates: set[date] = set()
+    invalid = 0
+    for trade_date, _ in map(block_key, records):
+        if not trade_date:
+            continue
+        try:
+            dates.add(date.fromisoformat(trade_date))
+        except ValueError:
+            # 日期无法解析的流水没有可以比较的已有流水，只和同一批里的流水比较
+            invalid += 1
+    if invalid:
+        logger.warning(f"{invalid} 条流水的日期无法解析，跳过和数据库里已有流水的比较")
+    if not dates:
+        return {}
+
+    # 日期属于已经归档的年度时，同时查询归档表
+    query = select_journal(
+        ["id", "trade_date", "amount", "payer", "receiver", "fingerprint"],
+        min(dates),
+        max(dates),
+        lambda table: [table.c.trade_date.in_(dates)],
+    )
+    with db.session() as session:
+        rows = session.execute(query).all()
+
+    blocks = defaultdict(list)
+    for row in rows:
+        candidate = dict(row._mapping)
+        blocks[block_key(candidate)].append(candidate)
+    return blocks
+
+
+def flag_duplicates(records: list[dict]) -> list[DuplicateFlag]:
+    """检查待入库的流水是否已经在数据库里，或者在 records 里出现过
+
+    Args:
+        records (list[dict]): 待入库的流水
+
+    Returns:
+        list[DuplicateFlag]: 和 records 一一对应，"重复" 表示指纹完全相同，
+        "疑似重复" 表示日期和金额相同、户名只差一个字符（一般是 OCR 识别错误），"" 表示没有重复
+    """
+    blocks = load_candidates(records)
+    flags: list[DuplicateFlag] = []
+
+    for record in records:
+        key = block_key(record)
+        record_fp = record_fingerprint(record)
+        candidates = blocks.get(key, [])
+
+        if any(
+            (candidate.get("fingerprint") or record_fingerprint(candidate)) == record_fp
+            for candidate in candidates
+        ):
+            flags.append("重复")
+        elif any(is_fuzzy_match(record, candidate) for candidate in candidates):
+            flags.append("疑似重复")
+        else:
+            flags.append("")
+
+        # 同一批里后出现的相同流水也要标记出来
+        blocks.setdefault(key, []).append({**record, "fingerprint": record_fp})
+
+    return flags
+
+
+async def existing_fingerprints(
+    fingerprints: Iterable[str], trade_dates: Iterable[date | str]
+) -> set[str]:
+    """查询哪些指纹已经存在于数据库里，使用 fingerprint 列的索引
+
+    Args:
+        fingerprints (Iterable[str]): 需要查询的指纹
+        trade_dates (Iterable[date | str]): 这些流水的交易日期，日期属于已经归档的年度时，同时查询归档表
+    """
+    fingerprints = list(set(fingerprints))
+    dates = [
+        date.fromisoformat(trade_date) if isinstance(trade_date, str) else trade_date
+        for trade_date in trade_dates
+        if trade_date
+    ]
+    if not fingerprints:
+        return set()
+
+    partitions = (
+        journal_partitions(min(dates), max(dates), await aarchived_years())
+        if dates
+        else [active_table()]
+    )
+    found = set()
+    async with db.asession() as session:
+        for start in range(0, len(fingerprints), 500):  # SQLite 对参数数量有限制
+            for table in partitions:
+                if "fingerprint" not in table.c:  # 指纹出现之前归档的表
+                    continue
+                result = await session.execute(
+                    select_partition(table, ["fingerprint"]).where(
+                        table.c.fingerprint.in_(fingerprints[start : start + 500])
+                    )
+                )
+                found.update(result.scalars().all())
+    return found
+
+
+def find_ledger_duplicates(chunk_size: int = 5000) -> list[list[int]]:
+    """扫描整个账本，找出重复和疑似重复的流水
+
+    按 (日期, 金额) 分块后只在块内比较，块一般只有一两条流水，几十万条流水也可以很快完成
+
+    Returns:
+        list[list[int]]: 每一组重复流水的 id
+    """
+    start_time = time.time()
+    blocks: dict[tuple[str, str], list[dict]] = defaultdict(list)
+
+    last_id = 0
+    while True:
+        with db.session() as session:
+            rows = session.exec(
+                select(
+                    JournalAccount.id,
+                    JournalAccount.trade_date,
+                    JournalAccount.amount,
+                    JournalAccount.payer,
+                    JournalAccount.receiver,
+                )
+                .where(JournalAccount.id > last_id)  # type:ignore
+                .order_by(JournalAccount.id)  # type:ignore
+                .limit(chunk_size)
+            ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        for row in rows:
+            record = dict(row._mapping)
+            blocks[block_key(record)].append(record)
+
+    groups = []
+    for block in blocks.values():
+        if len(block) < 2:
+            continue
+        # 块内用并查集把互相匹配的流水合并为一组
+        parent = list(range(len(block)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(block)):
+            for j in range(i + 1, len(block)):
+                if is_fuzzy_match(block[i], block[j]):
+                    parent[find(j)] = find(i)
+
+        members = defaultdict(list)
+        for i, record in enumerate(block):
+            members[find(i)].append(record["id"])
+        groups.extend(ids for ids in members.values() if len(ids) > 1)
+
+    logger.info(
+        f"扫描重复流水完成，共 {len(groups)} 组，用时：{time.time() - start_time:.2f}s"
+    )
+    return groups
+
+
+def backfill_fingerprints(chunk_size: int = 5000) -> int:
+    """给还没有指纹的历史流水计算指纹
+
+    Returns:
+        int: 更新的流水数量
+    """
+    updated = 0
+    while True:
+        with db.session() as session:
+            rows = session.exec(
+                select(
+                    JournalAccount.id,
+                    JournalAccount.trade_date,
+                    JournalAccount.amount,
+                    JournalAccount.payer,
+                    JournalAccount.receiver,
+                )
+                .where(JournalAccount.fingerprint == "")
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            session.execute(
+                update(JournalAccount),
+                [
+                    {"id": row.id, "fingerprint": record_fingerprint(row._mapping)}
+                    for row in rows
+                ],
+            )
+            bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+            session.commit()
+        updated += len(rows)
+    return updated
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.dedup
+    print(f"补充了 {backfill_fingerprints()} 条流水的指纹")
+    for ids in find_ledger_duplicates():
+        print("重复流水：", ids)
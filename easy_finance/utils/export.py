@@ -0,0 +1,351 @@
+import asyncio
+import csv
+import functools
+import hashlib
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Literal
+
+import reflex as rx
+from sqlalchemy import Table
+from sqlmodel import func, select
+
+from .. import db
+from ..models import JournalAccount, get_table_version
+from ..settings import settings
+from .archive import select_journal
+from .counterparty import counterparty_filter
+from .log import logger
+from .records import JOURNAL_COLUMNS
+from .request_api import generate_random_string, get_file_url
+
+ExportFormat = Literal["xlsx", "csv", "parquet"]
+
+EXPORT_DIR_NAME = "exports"  # 导出文件保存在上传目录下的这个子目录里
+
+# 导出任务在线程池里执行，超过 EXPORT_WORKERS 的任务会排队
+export_executor = ThreadPoolExecutor(
+    max_workers=settings.export_workers, thread_name_prefix="export"
+)
+
+# 导出的字段和表头，和页面上的流水表格一致，另外加上编号和记录生成时间
+EXPORT_COLUMNS: dict[str, str] = {
+    "id": "编号",
+    **{column.field: column.title for column in JOURNAL_COLUMNS},
+    "created_datetime": "记录生成时间",
+}
+
+
+@dataclass
+class ExportFilter:
+    """导出条件，为空的条件不参与筛选"""
+
+    start_date: date | None = None  # 交易日期的开始日期（包含）
+    end_date: date | None = None  # 交易日期的结束日期（包含）
+    category: str = ""  # 分类
+    counterparty: str = ""  # 交易对象的任意一个别名，付款方或收款方是它的流水都会导出
+
+    def conditions(self, table: Table) -> list:
+        """日期以外的条件，日期范围由 select_journal 处理，用来决定需要查询哪些归档表"""
+        conditions = []
+        if self.category:
+            conditions.append(table.c.category == self.category)
+        if self.counterparty:
+            conditions.append(counterparty_filter(self.counterparty, table))
+        return conditions
+
+    def select(self, columns: Iterable[str]):
+        """查询符合条件的流水，日期范围包含已经归档的年度时会同时查询归档表"""
+        return select_journal(
+            columns, self.start_date, self.end_date, self.conditions
+        ).subquery("journal")
+
+    def cache_key(self, file_format: str) -> str:
+        """导出条件和格式的哈希值，用于给导出文件命名"""
+        payload = json.dumps(
+            {**asdict(self), "file_format": file_format}, default=str, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+@dataclass
+class ExportProgress:
+    """导出进度，由导出线程更新，前端的后台任务读取"""
+
+    total: int = 0  # 需要导出的行数
+    written: int = 0  # 已经写入的行数
+
+
+def iter_journal_rows(
+    export_filter: ExportFilter, chunk_size: int = settings.export_chunk_size
+) -> Iterator[list[tuple]]:
+    """按 id 分页读取符合条件的流水，每页使用单独的 session，内存里最多只有一页数据
+
+    Args:
+        export_filter (ExportFilter): 导出条件
+        chunk_size (int): 每页的行数
+
+    Yields:
+        list[tuple]: 每一行是按 EXPORT_COLUMNS 顺序排列的字段值
+    """
+    journal = export_filter.select(EXPORT_COLUMNS)
+
+    last_id = 0
+    while True:
+        with db.session() as session:
+            chunk = session.execute(
+                select(journal)
+                .where(journal.c.id > last_id)
+                .order_by(journal.c.id)
+                .limit(chunk_size)
+            ).all()
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        yield [tuple(row) for row in chunk]
+
+
+def write_xlsx(path: Path, headers: list[str], chunks: Iterable[list[tuple]]) -> int:
+    """用 xlsxwriter 的 constant_memory 模式逐行写入 excel，写完的行会立即写入磁盘
+
+    Args:
+        path (Path): 文件路径
+        headers (list[str]): 表头
+        chunks (Iterable[list[tuple]]): 分批的数据
+
+    Returns:
+        int: 写入的行数
+    """
+    import xlsxwriter  # 只在导出 excel 时才导入，加快启动速度
+
+    workbook = xlsxwriter.Workbook(
+        str(path), {"constant_memory": True, "remove_timezone": True}
+    )
+    worksheet = workbook.add_worksheet()
+    date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
+    datetime_format = workbook.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})
+    amount_format = workbook.add_format({"num_format": "#,##0.00"})
+
+    worksheet.write_row(0, 0, headers)
+    amount_index = headers.index("金额") if "金额" in headers else -1
+
+    row_count = 0
+    for chunk in chunks:
+        for row in chunk:
+            row_count += 1
+            for col, value in enumerate(row):
+                if isinstance(value, datetime):
+                    worksheet.write_datetime(row_count, col, value, datetime_format)
+                elif isinstance(value, date):
+                    worksheet.write_datetime(row_count, col, value, date_format)
+                elif col == amount_index and value:
+                    # 金额在数据库里是字符串，能转化为数字的按数字写入，方便在 excel 里求和
+                    try:
+                        worksheet.write_number(
+                            row_count, col, Decimal(value), amount_format
+                        )
+                    except InvalidOperation:
+                        worksheet.write_string(row_count, col, value)
+                else:
+                    worksheet.write(row_count, col, value)
+
+    workbook.close()
+    return row_count
+
+
+def write_csv(path: Path, headers: list[str], chunks: Iterable[list[tuple]]) -> int:
+    """逐批写入 csv，使用 utf-8-sig 编码，用 excel 打开时中文不会乱码
+
+    Returns:
+        int: 写入的行数
+    """
+    row_count = 0
+    with path.open("w", newline="", encoding="utf-8-sig") as file_object:
+        writer = csv.writer(file_object)
+        writer.writerow(headers)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            row_count += len(chunk)
+    return row_count
+
+
+def write_parquet(path: Path, chunks: Iterable[list[tuple]]) -> int:
+    """先把数据逐批写入临时 csv，再用 polars 的流式引擎读取 csv 并写入 parquet，
+    整个过程不需要把所有数据读进内存
+
+    Returns:
+        int: 写入的行数
+    """
+    # polars 导入较慢，只在导出 parquet 时才导入
+    import polars as pl
+
+    from .batch import parse_amount_expr
+
+    fields = list(EXPORT_COLUMNS)
+
+    with tempfile.TemporaryDirectory(dir=path.parent) as temp_dir:
+        temp_csv = Path(temp_dir) / "export.csv"
+        with temp_csv.open("w", newline="", encoding="utf-8") as file_object:
+            writer = csv.writer(file_object)
+            writer.writerow(fields)
+            row_count = 0
+            for chunk in chunks:
+                writer.writerows(chunk)
+                row_count += len(chunk)
+
+        (
+            pl.scan_csv(temp_csv, schema={field: pl.String for field in fields})
+            .with_columns(
+                pl.col("id").cast(pl.Int64),
+                pl.col("trade_date").str.to_date(strict=False),
+                pl.col("created_datetime").str.to_datetime(strict=False),
+                parse_amount_expr(pl.col("amount")),
+            )
+            .sink_parquet(path)
+        )
+
+    return row_count
+
+
+def get_export_dir() -> Path:
+    export_dir = rx.get_upload_dir() / EXPORT_DIR_NAME
+    export_dir.mkdir(parents=True, exist_ok=True)
+    return export_dir
+
+
+def count_journal_rows(export_filter: ExportFilter) -> int:
+    """统计符合导出条件的流水数量，用于显示导出进度"""
+    with db.session() as session:
+        return session.exec(
+            select(func.count()).select_from(export_filter.select(["id"]))
+        ).one()
+
+
+def track_progress(
+    chunks: Iterable[list[tuple]], progress: ExportProgress
+) -> Iterator[list[tuple]]:
+    """每写完一批数据就更新一次导出进度"""
+    for chunk in chunks:
+        yield chunk
+        progress.written += len(chunk)
+
+
+def export_journal(
+    file_format: ExportFormat,
+    export_filter: ExportFilter | None = None,
+    chunk_size: int = settings.export_chunk_size,
+    progress: ExportProgress | None = None,
+) -> str:
+    """把数据库里的流水导出为文件，保存到上传目录的 exports 子目录
+
+    导出文件按 (导出条件, 表的数据版本) 命名，流水没有变化时重复导出会直接返回已有的文件，
+    流水发生变化后数据版本加一，会重新导出，并删除同一导出条件的旧文件
+
+    Args:
+        file_format (ExportFormat): 导出格式，xlsx、csv 或 parquet
+        export_filter (ExportFilter | None): 导出条件，默认导出全部流水
+        chunk_size (int): 每次从数据库读取的行数
+        progress (ExportProgress | None): 导出进度，会在导出过程中更新
+
+    Returns:
+        str: 导出文件的下载链接
+    """
+    if file_format not in ("xlsx", "csv", "parquet"):
+        raise ValueError(f"不支持的导出格式：{file_format}")
+
+    export_filter = export_filter or ExportFilter()
+    progress = progress or ExportProgress()
+    start_time = time.time()
+
+    # 先读取数据版本再读取数据，导出过程中数据发生变化时，文件对应的是旧版本，下次导出会重新生成
+    version = get_table_version(JournalAccount.__tablename__)  # type:ignore
+    query_key = export_filter.cache_key(file_format)
+    file_name = f"流水-{query_key}-v{version}.{file_format}"
+    export_dir = get_export_dir()
+    path = export_dir / file_name
+
+    if path.exists():
+        logger.info(
+            "导出条件和数据都没有变化，直接返回已有的文件",
+            extra={"file_format": file_format, "file_name": file_name},
+        )
+        path.touch()  # 更新修改时间，清理导出文件时按最后一次使用的时间计算保留期限
+        return get_file_url(f"{EXPORT_DIR_NAME}/{file_name}")
+
+    progress.total = count_journal_rows(export_filter)
+    chunks = track_progress(iter_journal_rows(export_filter, chunk_size), progress)
+    headers = list(EXPORT_COLUMNS.values())
+
+    # 先写入临时文件，写完后再重命名，避免其他请求拿到写了一半的文件
+    temp_path = export_dir / f"tmp-{generate_random_string()}-{file_name}"
+    try:
+        if file_format == "xlsx":
+            row_count = write_xlsx(temp_path, headers, chunks)
+        elif file_format == "csv":
+            row_count = write_csv(temp_path, headers, chunks)
+        else:
+            row_count = write_parquet(temp_path, chunks)
+        temp_path.replace(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+    for old_file in export_dir.glob(f"流水-{query_key}-v*.{file_format}"):
+        if old_file != path:
+            old_file.unlink(missing_ok=True)
+
+    logger.info(
+        f"导出 {row_count} 条流水，用时：{time.time() - start_time:.2f}s",
+        extra={"file_format": file_format, "file_name": file_name},
+    )
+    return get_file_url(f"{EXPORT_DIR_NAME}/{file_name}")
+
+
+def submit_export(fn: Callable[..., str], *args, **kwargs) -> asyncio.Future[str]:
+    """把导出任务交给导出线程池执行，不阻塞事件循环
+
+    Args:
+        fn (Callable[..., str]): export_journal 或 export_rows_to_xlsx
+
+    Returns:
+        asyncio.Future[str]: 导出文件的下载链接
+    """
+    return asyncio.get_running_loop().run_in_executor(
+        export_executor, functools.partial(fn, *args, **kwargs)
+    )
+
+
+def export_rows_to_xlsx(file_tag: str, headers: list[str], rows: list[list]) -> str:
+    """把前端表格里的数据写入 excel 文件，返回下载链接
+
+    Args:
+        file_tag (str): 文件名前缀
+        headers (list[str]): 表头
+        rows (list[list]): 表格数据
+
+    Returns:
+        str: 导出文件的下载链接
+    """
+    file_name = f"{file_tag}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{generate_random_string()}.xlsx"
+    write_xlsx(get_export_dir() / file_name, headers, [rows])
+    return get_file_url(f"{EXPORT_DIR_NAME}/{file_name}")
+
+
+def download_file(url: str) -> rx.event.EventSpec:
+    """生成下载导出文件的事件
+
+    rx.download 只接受以 / 开头的链接，导出文件在后端的上传目录里，链接带有 BACK_END 域名，
+    所以把链接包装成 Var 传入
+
+    Args:
+        url (str): export_journal 或 export_rows_to_xlsx 返回的下载链接
+
+    Returns:
+        rx.event.EventSpec: rx.download 事件
+    """
+    return rx.download(url=rx.Var.create(url), filename=url.rpartition("/")[-1])
@@ -0,0 +1,368 @@
+import asyncio
+import hashlib
+import json
+import uuid
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import Iterator, Literal
+
+from ..settings import settings
+from .categorize import apply_rules
+from .ingest import save_invoice_records, save_journal_drafts
+from .job_queue import Job, job_queue
+from .log import logger
+from .ocr_provider import OCRRecord, RecognizeMode
+from .records import BankSlipRow, InvoiceRow, JournalDraft
+from .request_api import save_upload_file
+from .storage import StorageQuotaError
+
+"""
+批量识别文件夹里的票据
+
+月底需要处理的票据一般有几百个文件，在网页上一次最多只能上传 MAX_UPLOAD_FILES 个。
+这里把一个文件夹里的所有文件保存到上传目录后提交到后台任务队列（jobs.db），由网页后端的 worker 识别，
+和网页上传的文件一样经过同一个进程里的限流器和识别结果缓存，命令行和网页同时使用时也不会超过 QPS 配额。
+识别结果分批写入数据库，也可以导出为文件。
+
+网页后端没有运行时，可以加上 --workers 在命令行进程里识别。没有配置 REDIS_URL 时限流和缓存只在进程内有效，
+所以网页后端正在运行时不要使用 --workers，否则请求速度会超过配额。
+
+每提交、识别完一个文件就在进度清单里追加一行，中断后重新运行时，已经提交的文件继续等待原来的任务，
+已经识别过的文件不会重复调用 OCR 接口，已经入库的文件也不会重复入库。命令行入口见 easy_finance/cli.py
+"""
+
+SUPPORTED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".pdf")
+# 默认的进度清单文件名，保存在识别的文件夹里
+MANIFEST_NAME = ".easy-finance-manifest.jsonl"
+DB_BATCH_SIZE = 200  # 每次写入数据库的识别结果数量
+SUBMIT_BATCH_SIZE = 20  # 每次提交到任务队列的文件数量
+
+# submitted：已经提交到任务队列；recognized：已经识别，还没有入库；
+# failed：识别失败，下次运行时重试；saved：已经入库
+ManifestStatus = Literal["submitted", "recognized", "failed", "saved"]
+
+
+@dataclass
+class ManifestEntry:
+    path: str  # 相对于识别文件夹的路径
+    sha256: str  # 文件内容的哈希值，文件被替换后会重新识别
+    status: ManifestStatus
+    result: dict | None = None  # OCRRecord.to_dict() 的结果
+    error: str = ""  # 识别失败时的错误信息
+    batch_id: str = ""  # 提交到任务队列时的批次 id
+
+
+class Manifest:
+    """识别进度清单，JSON Lines 格式，每次状态变化都追加一行，同一个文件以最后一行为准
+
+    进程被中断时最后一行可能只写了一半，读取时会跳过无法解析的行
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: dict[str, ManifestEntry] = {}
+        line = "\n"
+        if path.exists():
+            with path.open(encoding="utf-8") as file_object:
+                for line in file_object:
+                    try:
+                        entry = ManifestEntry(**json.loads(line))
+                    except (json.JSONDecodeError, TypeError):
+                        continue
+                    self._merge(entry)
+        self._file = path.open("a", encoding="utf-8")
+        if not line.endswith("\n"):  # 另起一行，不要接在写了一半的行后面
+            self._file.write("\n")
+
+    def _merge(self, entry: ManifestEntry) -> None:
+        # 入库后写入的行不再重复保存识别结果，沿用之前的识别结果
+        previous = self.entries.get(entry.path)
+        if entry.result is None and previous and previous.sha256 == entry.sha256:
+            entry.result = previous.result
+        self.entries[entry.path] = entry
+
+    def get(self, path: str, sha256: str) -> ManifestEntry | None:
+        """文件内容没有变化时返回之前的处理结果"""
+        entry = self.entries.get(path)
+        return entry if entry and entry.sha256 == sha256 else None
+
+    def record(self, entry: ManifestEntry, save_result: bool = True) -> None:
+        line = asdict(entry)
+        if not save_result:
+            line["result"] = None
+        self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._merge(entry)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+@dataclass
+class FolderResult:
+    total: int = 0  # 文件夹里的文件数量
+    recognized: int = 0  # 这次通过任务队列识别的文件数量
+    resumed: int = 0  # 之前已经识别过，这次跳过识别的文件数量
+    failed: int = 0  # 识别失败的文件数量
+    journals_saved: int = 0  # 新保存的流水数量
+    duplicates: int = 0  # 和数据库里的流水重复，没有保存的数量
+    invoices_saved: int = 0  # 新保存的发票数量
+    matched: int = 0  # 自动对账匹配的数量
+    errors: list[str] = field(default_factory=list)
+    exported: list[str] = field(default_factory=list)  # 导出文件的路径
+
+
+def iter_files(directory: Path, recursive: bool = True) -> Iterator[Path]:
+    """按路径顺序列出文件夹里支持识别的文件，跳过隐藏文件"""
+    paths = directory.rglob("*") if recursive else directory.glob("*")
+    for path in sorted(paths):
+        relative = path.relative_to(directory)
+        if any(part.startswith(".") for part in relative.parts):
+            continue
+        if path.is_file() and path.suffix.lower() in SUPPORTED_EXTENSIONS:
+            yield path
+
+
+class ResultWriter:
+    """把识别结果分批写入数据库，同一时间只有一批在写入，避免同一批流水的查重互相遗漏"""
+
+    def __init__(self, manifest: Manifest, result: FolderResult, batch_size: int):
+        self.manifest = manifest
+        self.result = result
+        self.batch_size = batch_size
+        self._pending: list[ManifestEntry] = []
+        self._lock = asyncio.Lock()
+
+    async def add(self, entry: ManifestEntry) -> None:
+        self._pending.append(entry)
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        from .batch import process_bank_slips
+
+        async with self._lock:
+            entries, self._pending = self._pending, []
+            if not entries:
+                return
+
+            records = [OCRRecord.from_dict(entry.result) for entry in entries]  # type: ignore
+            slips = [
+                (entry, record)
+                for entry, record in zip(entries, records)
+                if record.result_type == "bank_slip"
+            ]
+            # 命令行入库前没有人工检查，批量校验回单，缺少日期、金额或户名的记为识别失败，下次运行时重试
+            checked = await asyncio.to_thread(
+                process_bank_slips, [record for _, record in slips]
+            )
+            invalid: set[str] = set()
+            drafts = []
+            for (entry, record), error in zip(slips, checked["error"].to_list()):
+                if error:
+                    invalid.add(entry.path)
+                    self.manifest.record(replace(entry, status="failed", error=error))
+                    self.result.failed += 1
+                    self.result.errors.append(f"{entry.path}：{error}")
+                else:
+                    drafts.append(JournalDraft.from_record(record))
+            # 命令行入库前没有人工检查，按分类规则填写分类
+            categorized = await asyncio.to_thread(
+                apply_rules, [draft.to_dict() for draft in drafts]
+            )
+            for draft, row in zip(drafts, categorized):
+                draft.category = row["category"]
+                draft.category_rule_id = row["category_rule_id"]
+
+            if drafts:
+                saved = await save_journal_drafts(drafts)
+                self.result.journals_saved += len(saved.saved)
+                self.result.duplicates += saved.skipped
+                self.result.matched += saved.matched
+
+            invoices = [record for record in records if record.result_type == "invoice"]
+            if invoices:
+                invoice_ids, matched = await save_invoice_records(invoices)
+                self.result.invoices_saved += len(invoice_ids)
+                self.result.matched += matched
+
+            saved_entries = [entry for entry in entries if entry.path not in invalid]
+            for entry in saved_entries:
+                self.manifest.record(replace(entry, status="saved"), save_result=False)
+            logger.info(f"{len(saved_entries)} 个识别结果已经入库")
+
+
+def export_results(
+    manifest: Manifest, names: list[str], export_path: Path
+) -> list[str]:
+    """把识别结果导出为 xlsx 或 csv，银行回单和发票同时存在时分别导出到两个文件
+
+    Returns:
+        list[str]: 导出文件的路径
+    """
+    from .export import write_csv, write_xlsx
+
+    rows: dict[str, list[list[str]]] = {"bank_slip": [], "invoice": []}
+    for name in names:
+        entry = manifest.entries.get(name)
+        if entry is None or entry.result is None:
+            continue
+        record = OCRRecord.from_dict(entry.result)
+        row_type = BankSlipRow if record.result_type == "bank_slip" else InvoiceRow
+        rows[record.result_type].append(row_type.from_record(name, record).to_list())
+
+    present = {result_type: data for result_type, data in rows.items() if data}
+    exported = []
+    for result_type, data in present.items():
+        row_type = BankSlipRow if result_type == "bank_slip" else InvoiceRow
+        path = export_path
+        if len(present) > 1:
+            path = export_path.with_stem(f"{export_path.stem}-{result_type}")
+        if path.suffix.lower() == ".csv":
+            write_csv(path, row_type.headers(), [data])
+        else:
+            write_xlsx(path, row_type.headers(), [data])
+        exported.append(str(path))
+    return exported
+
+
+async def recognize_folder(
+    directory: Path,
+    mode: RecognizeMode = "auto",
+    manifest_path: Path | None = None,
+    max_pending: int = settings.watch_max_pending,
+    save_to_db: bool = True,
+    export_path: Path | None = None,
+    recursive: bool = True,
+    batch_size: int = DB_BATCH_SIZE,
+    run_workers: bool = False,
+) -> FolderResult:
+    """识别一个文件夹里的所有票据
+
+    Args:
+        directory (Path): 票据所在的文件夹
+        mode (RecognizeMode): 识别模式
+        manifest_path (Path | None): 进度清单的路径，默认保存在识别的文件夹里
+        max_pending (int): 任务队列里最多有多少个还没有识别完的文件，超过后等待识别结果再继续提交
+        save_to_db (bool): 是否把识别结果写入数据库
+        export_path (Path | None): 导出文件的路径，后缀是 .csv 时导出 csv，否则导出 excel
+        recursive (bool): 是否识别子文件夹里的文件
+        batch_size (int): 每次写入数据库的识别结果数量
+        run_workers (bool): 是否在当前进程里启动任务队列的 worker，网页后端没有运行时使用
+
+    Returns:
+        FolderResult: 识别结果的统计
+    """
+    paths = list(iter_files(directory, recursive))
+    names = [path.relative_to(directory).as_posix() for path in paths]
+    result = FolderResult(total=len(paths))
+    manifest = Manifest(manifest_path or directory / MANIFEST_NAME)
+    writer = ResultWriter(manifest, result, batch_size)
+    batch_id = f"cli-{uuid.uuid4().hex}"
+    # (批次 id, 文件名) → 文件的哈希值，等待任务队列返回识别结果的文件
+    waiting: dict[tuple[str, str], str] = {}
+    batches = {batch_id}  # 这次运行等待过的批次，全部处理完后从任务队列里删除
+    submitting: list[tuple[str, str, str]] = []  # (文件名, 保存后的文件名, 哈希值)
+    workers = asyncio.create_task(job_queue.run()) if run_workers else None
+
+    async def finish(entry: ManifestEntry) -> None:
+        manifest.record(entry)
+        if entry.status == "failed":
+            result.failed += 1
+            result.errors.append(f"{entry.path}：{entry.error}")
+        elif save_to_db:
+            await writer.add(entry)
+
+    async def collect() -> None:
+        """把任务队列里已经处理完的任务写入进度清单"""
+        for waiting_batch in {batch for batch, _ in waiting}:
+            jobs: dict[str, Job] = {
+                job.file_name: job
+                for job in await job_queue.store.get_batch(waiting_batch)
+            }
+            for key in [key for key in waiting if key[0] == waiting_batch]:
+                name = key[1]
+                job = jobs.get(name)
+                if job is not None and job.status not in ("done", "failed"):
+                    continue
+                sha256 = waiting.pop(key)
+                if job is None:  # 之前提交的任务已经被删除，下次运行时重新提交
+                    entry = ManifestEntry(
+                        name, sha256, "failed", error="识别任务不存在"
+                    )
+                elif job.status == "failed":
+                    entry = ManifestEntry(name, sha256, "failed", error=job.error)
+                else:
+                    entry = ManifestEntry(name, sha256, "recognized", job.result)
+                    result.recognized += 1
+                await finish(entry)
+
+    async def submit() -> None:
+        # 提交之后再写入进度清单，中断时还没有提交的文件下次运行会重新提交
+        await job_queue.submit(
+            batch_id, mode, [(name, stored_name) for name, stored_name, _ in submitting]
+        )
+        for name, _, sha256 in submitting:
+            waiting[(batch_id, name)] = sha256
+            manifest.record(ManifestEntry(name, sha256, "submitted", batch_id=batch_id))
+        submitting.clear()
+
+    async def wait_until(pending_limit: int) -> None:
+        while len(waiting) > pending_limit:
+            if workers and workers.done():
+                workers.result()  # worker 异常退出时抛出异常，不再继续等待
+            await collect()
+            if len(waiting) > pending_limit:
+                await asyncio.sleep(settings.job_poll_interval)
+
+    try:
+        for path, name in zip(paths, names):
+            file_content = await asyncio.to_thread(path.read_bytes)
+            sha256 = hashlib.sha256(file_content).hexdigest()
+            entry = manifest.get(name, sha256)
+
+            if entry and entry.status == "submitted":
+                waiting[(entry.batch_id, name)] = sha256
+                batches.add(entry.batch_id)
+                continue
+            if entry and entry.status != "failed":
+                result.resumed += 1
+                if save_to_db and entry.status == "recognized":
+                    await writer.add(entry)
+                continue
+
+            try:
+                stored_name = await asyncio.to_thread(
+                    save_upload_file, path.name, file_content
+                )
+            except StorageQuotaError as e:
+                await finish(ManifestEntry(name, sha256, "failed", error=str(e)))
+                continue
+            submitting.append((name, stored_name, sha256))
+            if len(submitting) >= SUBMIT_BATCH_SIZE:
+                await submit()
+                await wait_until(max_pending)
+
+        if submitting:
+            await submit()
+        if waiting:
+            logger.info(
+                f"{len(waiting)} 个文件已经提交到任务队列，等待识别"
+                + ("" if run_workers else "（网页后端没有运行时请加上 --workers）")
+            )
+        await wait_until(0)
+
+        if save_to_db:
+            await writer.flush()
+        for finished_batch in batches:
+            await job_queue.store.delete_batch(finished_batch)
+    finally:
+        manifest.close()
+        if workers:
+            workers.cancel()
+
+    if export_path:
+        result.exported = await asyncio.to_thread(
+            export_results, manifest, names, export_path
+        )
+    return result
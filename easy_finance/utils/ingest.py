@@ -0,0 +1,134 @@
+import asyncio
+from dataclasses import dataclass, field
+
+from ..models import JournalAccount
+from .change_feed import publish_changes
+from .counterparty import assign_counterparty_ids, counterparty_cache
+from .dedup import existing_fingerprints, record_fingerprint
+from .ocr_provider import PARSER_VERSION, OCRRecord
+from .records import JournalDraft
+
+"""
+识别结果入库
+
+upload 页面的"上传数据"按钮和命令行批量识别共用这里的入库流程：
+跳过重复的流水，关联交易对象，新流水和还没有匹配的发票自动对账，并通知打开了 /display 的用户
+"""
+
+
+@dataclass
+class SaveResult:
+    saved: list[JournalAccount] = field(default_factory=list)  # 新保存的流水
+    skipped: int = 0  # 和数据库里或者同一批里的流水重复，没有保存的数量
+    matched: int = 0  # 自动匹配到发票的流水数量
+
+
+async def save_journal_drafts(
+    drafts: list[JournalDraft], origin: str = ""
+) -> SaveResult:
+    """把待入库的流水保存到数据库
+
+    Args:
+        drafts (list[JournalDraft]): 待入库的流水
+        origin (str): 发出修改的用户的 client token，命令行入库时为空
+
+    Returns:
+        SaveResult: 入库结果
+
+    Raises:
+        ValueError: 有流水缺少日期、金额、付款方或收款方
+    """
+    # polars 导入较慢，第一次入库时才导入
+    from .batch import frame_to_journal_records, journals_to_frame
+
+    result = SaveResult()
+
+    # 日期、金额、付款方和收款方用和 reprocess 相同的表达式清洗，重新解析时不会因为格式不同被当成变化
+    journals = [draft.to_journal() for draft in drafts]
+    frame = await asyncio.to_thread(journals_to_frame, journals)
+    errors = [
+        f"第 {row + 1} 行：{error}"
+        for row, error in enumerate(frame["error"].to_list())
+        if error
+    ]
+    if errors:
+        raise ValueError("；".join(errors[:5]))
+    journals = [
+        {**journal, **cleaned}
+        for journal, cleaned in zip(journals, frame_to_journal_records(frame))
+    ]
+
+    # 和数据库里的流水指纹完全相同，或者在这一批里重复出现的流水不会入库
+    records = []
+    fingerprints = [record_fingerprint(journal) for journal in journals]
+    seen = await existing_fingerprints(
+        fingerprints, [journal["trade_date"] for journal in journals]
+    )
+    for journal, fingerprint in zip(journals, fingerprints):
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        records.append(
+            {**journal, "fingerprint": fingerprint, "parser_version": PARSER_VERSION}
+        )
+
+    result.skipped = len(drafts) - len(records)
+    if not records:
+        return result
+
+    from .reconcile import reconcile
+
+    # 银行回单上的账号用于区分名字相近的交易对象
+    identifiers = {}
+    for draft in drafts:
+        if draft.raw_response:
+            identifiers.update(
+                OCRRecord.decompress(draft.raw_response).to_counterparties()
+            )
+    records = await asyncio.to_thread(assign_counterparty_ids, records, identifiers)
+    result.saved = await JournalAccount.create_records(records=records)
+    # 新流水入库后，和还没有匹配的发票自动对账
+    reconcile_result = await asyncio.to_thread(
+        reconcile, journal_ids=[record.id for record in result.saved]
+    )
+    result.matched = reconcile_result.matched
+
+    if result.matched:  # 匹配到发票的流水填写了发票链接，其他用户需要重新加载
+        await publish_changes("reload")
+    else:
+        await publish_changes(
+            "add",
+            [record.model_dump(exclude={"raw_response"}) for record in result.saved],
+            origin=origin,
+        )
+    return result
+
+
+async def save_invoice_records(records: list[OCRRecord]) -> tuple[list[int], int]:
+    """保存识别出的发票，并和还没有关联发票的流水自动对账，
+    发票上的纳税人识别号会补充到对应的交易对象上
+
+    Args:
+        records (list[OCRRecord]): 增值税发票的识别结果
+
+    Returns:
+        tuple[list[int], int]: (新保存的发票 id, 自动匹配的流水数量)
+    """
+    # 对账用到 polars，导入较慢，第一次对账时才导入
+    from .reconcile import reconcile, save_invoices
+
+    identifiers = {}
+    for record in records:
+        identifiers.update(record.to_counterparties())
+    if identifiers:
+        await asyncio.to_thread(
+            counterparty_cache.resolve_many, list(identifiers), identifiers
+        )
+
+    invoice_ids = await asyncio.to_thread(
+        save_invoices, [record.to_invoice() for record in records]
+    )
+    result = await asyncio.to_thread(reconcile, invoice_ids=invoice_ids)
+    if result.matched:
+        await publish_changes("reload")
+    return invoice_ids, result.matched
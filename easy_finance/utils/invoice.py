@@ -2,6 +2,20 @@ from datetime import datetime
 
 from .bank_slip import parse_date, parse_none
 
+# get_invoice_data 返回值中各字段的 id，顺序和返回值一致
+INVOICE_FIELDS = (
+    "invoice_date",
+    "invoice_type",
+    "invoice_code",
+    "buyer_name",
+    "buyer_code",
+    "seller_name",
+    "seller_code",
+    "tax_amount",
+    "price_excluded_tax",
+    "price_included_tax",
+)
+
 
 def get_invoice_data(invoice_info: dict[str, str]) -> list[str]:
     """将 api 回传的发票信息整理成前端使用的标准格式
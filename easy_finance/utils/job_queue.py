@@ -0,0 +1,490 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Literal
+
+import reflex as rx
+
+from ..settings import settings
+from .log import logger
+from .ocr_provider import get_ocr_router
+from .request_api import get_file_url
+
+JobStatus = Literal["pending", "running", "done", "failed"]
+# 运行 worker 的进程持有这个租约，命令行通过它判断有没有进程在处理任务
+WORKERS_LEASE_NAME = "job-workers"
+
+
+@dataclass
+class Job:
+    """一个识别任务，对应用户上传的一个文件"""
+
+    batch_id: str  # 同一次上传的文件属于同一个 batch
+    mode: str  # 识别模式，见 ocr_provider.RecognizeMode
+    file_name: str  # 用户上传时的文件名
+    stored_name: str  # 保存到上传目录后的文件名
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: JobStatus = "pending"
+    result: dict | None = None  # 识别结果
+    error: str = ""  # 识别失败时的错误信息
+    attempts: int = 0  # 已经尝试处理的次数
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+
+class JobStore:
+    """任务存储的接口，默认实现是 SQLiteJobStore，
+    需要换成其他存储（例如 Redis、PostgreSQL）时实现这些方法即可"""
+
+    async def add(self, jobs: list[Job]) -> None:
+        raise NotImplementedError
+
+    async def claim(self) -> Job | None:
+        """取出一个 pending 状态的任务并标记为 running，没有任务时返回 None"""
+        raise NotImplementedError
+
+    async def complete(self, job_id: str, result: dict) -> None:
+        raise NotImplementedError
+
+    async def fail(self, job_id: str, error: str) -> None:
+        raise NotImplementedError
+
+    async def heartbeat(self, job_id: str) -> None:
+        """刷新 running 任务的 updated_at，说明处理它的进程还活着，租约不会过期"""
+        raise NotImplementedError
+
+    async def get_batch(self, batch_id: str) -> list[Job]:
+        raise NotImplementedError
+
+    async def delete_batch(self, batch_id: str) -> None:
+        raise NotImplementedError
+
+    async def requeue_running(self, lease: float, max_attempts: int) -> int:
+        """把超过 lease 秒还在 running 的任务恢复为 pending，返回恢复的数量
+
+        多个进程共用一个任务存储时，其他进程正在处理的任务不会被恢复；
+        已经处理了 max_attempts 次的任务不再恢复，直接标记为失败
+        """
+        raise NotImplementedError
+
+    async def count_unfinished(self, batch_id: str) -> int:
+        """批次里 pending 和 running 状态的任务数量"""
+        raise NotImplementedError
+
+    async def move_finished(self, from_batch: str, to_batch: str, limit: int) -> int:
+        """把一个批次里已经处理完的任务（最多 limit 个）移到另一个批次，返回移动的数量"""
+        raise NotImplementedError
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """取得或者续约名为 name 的租约，租约被其他 owner 持有并且还没有过期时返回 False"""
+        raise NotImplementedError
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        """释放自己持有的租约，其他进程可以立即接手"""
+        raise NotImplementedError
+
+
+class SQLiteJobStore(JobStore):
+    """基于 SQLite 的任务存储，进程重启后任务不会丢失"""
+
+    def __init__(self, path: str = settings.job_db_path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """第一次使用时才打开数据库、创建表，导入模块时不会创建 jobs.db"""
+        if self._db is None:
+            with self._connect_lock:
+                if self._db is None:
+                    self._db = self._connect()
+        return self._db
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    batch_id TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    stored_name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT NOT NULL DEFAULT '',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, created_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_jobs_batch_id ON jobs (batch_id)"
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+        return conn
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> Job:
+        job_data = dict(row)
+        job_data["result"] = json.loads(row["result"]) if row["result"] else None
+        return Job(**job_data)
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    async def _run(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        # sqlite3 是同步的，放到线程里执行，避免阻塞事件循环
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def add(self, jobs: list[Job]) -> None:
+        def _insert():
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    """
+                    INSERT INTO jobs (id, batch_id, mode, file_name, stored_name,
+                        status, result, error, attempts, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            job.id,
+                            job.batch_id,
+                            job.mode,
+                            job.file_name,
+                            job.stored_name,
+                            job.status,
+                            None,
+                            job.error,
+                            job.attempts,
+                            job.created_at,
+                            job.updated_at,
+                        )
+                        for job in jobs
+                    ],
+                )
+
+        await asyncio.to_thread(_insert)
+
+    async def claim(self) -> Job | None:
+        rows = await self._run(
+            """
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs WHERE status = 'pending'
+                ORDER BY created_at LIMIT 1
+            )
+            RETURNING *
+            """,
+            (time.time(),),
+        )
+        return self._to_job(rows[0]) if rows else None
+
+    async def complete(self, job_id: str, result: dict) -> None:
+        await self._run(
+            "UPDATE jobs SET status = 'done', result = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id),
+        )
+
+    async def fail(self, job_id: str, error: str) -> None:
+        await self._run(
+            "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+            (error, time.time(), job_id),
+        )
+
+    async def heartbeat(self, job_id: str) -> None:
+        await self._run(
+            "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), job_id),
+        )
+
+    async def get_batch(self, batch_id: str) -> list[Job]:
+        rows = await self._run(
+            "SELECT * FROM jobs WHERE batch_id = ? ORDER BY created_at", (batch_id,)
+        )
+        return [self._to_job(row) for row in rows]
+
+    async def delete_batch(self, batch_id: str) -> None:
+        await self._run("DELETE FROM jobs WHERE batch_id = ?", (batch_id,))
+
+    async def requeue_running(self, lease: float, max_attempts: int) -> int:
+        def _requeue() -> int:
+            now = time.time()
+            expired = now - lease
+            with self._lock, self._conn:
+                self._conn.execute(
+                    """
+                    UPDATE jobs SET status = 'failed', updated_at = ?,
+                        error = '多次处理都没有完成，可能是文件导致进程崩溃'
+                    WHERE status = 'running' AND updated_at < ? AND attempts >= ?
+                    """,
+                    (now, expired, max_attempts),
+                )
+                return self._conn.execute(
+                    """
+                    UPDATE jobs SET status = 'pending', updated_at = ?
+                    WHERE status = 'running' AND updated_at < ?
+                    """,
+                    (now, expired),
+                ).rowcount
+
+        return await asyncio.to_thread(_requeue)
+
+    async def count_unfinished(self, batch_id: str) -> int:
+        rows = await self._run(
+            "SELECT COUNT(*) FROM jobs "
+            "WHERE batch_id = ? AND status IN ('pending', 'running')",
+            (batch_id,),
+        )
+        return rows[0][0]
+
+    async def move_finished(self, from_batch: str, to_batch: str, limit: int) -> int:
+        rows = await self._run(
+            """
+            UPDATE jobs SET batch_id = ?, updated_at = ?
+            WHERE id IN (
+                SELECT id FROM jobs WHERE batch_id = ? AND status IN ('done', 'failed')
+                ORDER BY created_at LIMIT ?
+            )
+            RETURNING id
+            """,
+            (to_batch, time.time(), from_batch, limit),
+        )
+        return len(rows)
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        # 冲突时只有租约是自己的或者已经过期才更新，没有更新时 RETURNING 不返回行
+        rows = await self._run(
+            """
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE
+                SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            RETURNING owner
+            """,
+            (name, owner, now + ttl, now),
+        )
+        return bool(rows)
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        await self._run(
+            "DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)
+        )
+
+
+async def process_job(job: Job) -> dict:
+    """读取已经保存的文件，交给 get_ocr_router() 识别（限流、重试和熔断由各服务商负责）
+
+    Args:
+        job (Job): 需要处理的任务
+
+    Returns:
+        dict: OCRRecord.to_dict() 的结果
+    """
+    upload_file = rx.get_upload_dir() / job.stored_name
+    upload_data = await asyncio.to_thread(upload_file.read_bytes)
+
+    record = await get_ocr_router().recognize(
+        upload_data, job.file_name, job.mode  # type:ignore
+    )
+    record.file_url = get_file_url(job.stored_name)
+
+    return record.to_dict()
+
+
+class JobQueue:
+    """后台识别任务队列：
+    1. 用户上传的文件先保存到磁盘，再以任务的形式写入 JobStore
+    2. 应用启动后由 run 启动多个 worker，不断从 JobStore 取出任务处理，结果写回 JobStore
+    3. 前端通过 batch_id 查询处理进度，即使刷新页面或后端重启，任务也不会丢失
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        handler: Callable[[Job], Awaitable[dict]] = process_job,
+        workers: int = settings.job_workers,
+        poll_interval: float = settings.job_poll_interval,
+        lease: float = settings.job_lease_seconds,
+        max_attempts: int = settings.job_max_attempts,
+    ):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+
+    async def submit(self, batch_id: str, mode: str, files: list[tuple[str, str]]):
+        """提交一批任务
+
+        Args:
+            batch_id (str): 批次 id
+            mode (str): 识别模式
+            files (list[tuple[str, str]]): (用户上传时的文件名, 保存后的文件名) 的列表
+        """
+        await self.store.add(
+            [
+                Job(
+                    batch_id=batch_id,
+                    mode=mode,
+                    file_name=file_name,
+                    stored_name=stored_name,
+                )
+                for file_name, stored_name in files
+            ]
+        )
+        self._wakeup.set()  # 唤醒正在等待的 worker
+
+    async def batch_progress(self, batch_id: str) -> dict[str, Any]:
+        """查询一个批次的处理进度
+
+        Returns:
+            dict[str, Any]: 包含 total、finished、jobs 三个字段
+        """
+        jobs = await self.store.get_batch(batch_id)
+        finished = sum(1 for job in jobs if job.status in ("done", "failed"))
+        return {"total": len(jobs), "finished": finished, "jobs": jobs}
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            job = await self.store.claim()
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = asyncio.create_task(self._heartbeat(job))
+            try:
+                result = await self.handler(job)
+                await self.store.complete(job.id, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(
+                    f"worker {worker_id} 处理文件「{job.file_name}」失败：{e}",
+                    extra={"job_id": job.id, "batch_id": job.batch_id},
+                )
+                await self.store.fail(job.id, str(e))
+            finally:
+                heartbeat.cancel()
+
+    async def _heartbeat(self, job: Job) -> None:
+        """处理任务期间每隔 lease / 3 秒刷新一次 updated_at，
+        处理时间超过 lease 的任务（例如 OCR 重试、限流等待）不会被当成进程已经退出而重新处理
+        """
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.store.heartbeat(job.id)
+            except Exception as e:
+                logger.warning(
+                    f"刷新任务「{job.file_name}」的租约失败：{e}",
+                    extra={"job_id": job.id, "batch_id": job.batch_id},
+                )
+
+    async def _requeue_loop(self) -> None:
+        """定期恢复租约过期的任务，处理任务的进程退出后，其他进程可以接着处理"""
+        while True:
+            requeued = await self.store.requeue_running(self.lease, self.max_attempts)
+            if requeued:
+                logger.info(f"恢复了 {requeued} 个超时未处理完的任务")
+            await asyncio.sleep(self.lease / 2)
+
+    async def run_exclusive(
+        self,
+        name: str,
+        task: Callable[[], Awaitable[None]],
+        ttl: float = settings.singleton_lease_seconds,
+    ) -> None:
+        """在共用这个任务存储的所有进程里只运行一份 task
+
+        每个后端 worker 进程都会启动 lifespan task，取得租约的进程运行 task 并定期续约，
+        其他进程每隔 ttl / 3 秒检查一次，持有租约的进程退出后接手。
+        续约失败（例如进程卡住超过 ttl 秒）时取消 task，避免两个进程同时运行
+        """
+        owner = uuid.uuid4().hex
+        running: asyncio.Task | None = None
+        try:
+            while True:
+                held = await self.store.acquire_lease(name, owner, ttl)
+                if held and running is None:
+                    logger.info(f"这个进程开始运行「{name}」")
+                    running = asyncio.create_task(task())
+                elif not held and running is not None:
+                    logger.warning(f"「{name}」的租约被其他进程取得，停止运行")
+                    running.cancel()
+                    running = None
+
+                sleep = asyncio.create_task(asyncio.sleep(ttl / 3))
+                await asyncio.wait(
+                    [sleep] + ([running] if running else []),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                sleep.cancel()
+                if running is not None and running.done():
+                    running.result()  # task 异常退出时抛出异常
+                    return
+        finally:
+            if running is not None:
+                running.cancel()
+            await self.store.release_lease(name, owner)
+
+    async def _presence_loop(
+        self, ttl: float = settings.singleton_lease_seconds
+    ) -> None:
+        """运行 worker 期间持续续约 WORKERS_LEASE_NAME，多个进程里只要有一个取得租约即可"""
+        owner = uuid.uuid4().hex
+        try:
+            while True:
+                await self.store.acquire_lease(WORKERS_LEASE_NAME, owner, ttl)
+                await asyncio.sleep(ttl / 3)
+        finally:
+            await self.store.release_lease(WORKERS_LEASE_NAME, owner)
+
+    async def has_workers(self) -> bool:
+        """共用这个任务存储的进程里有没有正在运行的 worker（例如网页后端）"""
+        owner = uuid.uuid4().hex
+        if await self.store.acquire_lease(WORKERS_LEASE_NAME, owner, 0):
+            await self.store.release_lease(WORKERS_LEASE_NAME, owner)
+            return False
+        return True
+
+    async def run(self) -> None:
+        """启动所有 worker，作为 reflex 的 lifespan task 运行"""
+        await asyncio.gather(
+            self._presence_loop(),
+            self._requeue_loop(),
+            *(self._worker(i) for i in range(self.workers)),
+        )
+
+
+job_queue = JobQueue(SQLiteJobStore())
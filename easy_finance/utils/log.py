@@ -1,17 +1,156 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import random
+from typing import Any
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.FileHandler("./EasyFinance.log"),  # 输出到文件
-        logging.StreamHandler(),  # 输出到控制台
-    ],
-)
+from ..settings import settings
+
+# LogRecord 自带的属性，JsonFormatter 只把这之外的属性（也就是 extra 传入的字段）写入日志
+_RESERVED_ATTRS = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+    "message",
+    "asctime",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志记录格式化为单行 JSON，方便日志系统检索"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_entry: dict[str, Any] = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+
+        # extra 传入的字段
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                log_entry[key] = value
+
+        if record.exc_info:
+            log_entry["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(log_entry, ensure_ascii=False, default=str)
+
+
+def _create_file_handler() -> logging.Handler:
+    """根据 LOG_ROTATE_WHEN 创建按时间或按大小切割的文件 handler"""
+    if settings.log_rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            settings.log_file,
+            when=settings.log_rotate_when,
+            backupCount=settings.log_backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+    return logging.handlers.RotatingFileHandler(
+        settings.log_file,
+        maxBytes=settings.log_max_bytes,
+        backupCount=settings.log_backup_count,
+        encoding="utf-8",
+        delay=True,
+    )
+
+
+def setup_logging() -> logging.handlers.QueueListener | None:
+    """配置根 logger：
+    1. 业务代码只把日志放进队列（QueueHandler），不会在事件循环里写磁盘
+    2. 由后台线程里的 QueueListener 负责写文件（JSON 格式）和输出到控制台
+
+    Returns:
+        logging.handlers.QueueListener | None: 启动的 listener，如果已经配置过则返回 None
+    """
+    root = logging.getLogger()
+
+    # reflex 热重载时会重复导入本模块，避免重复添加 handler
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return None
+
+    file_handler = _create_file_handler()
+    file_handler.setFormatter(JsonFormatter())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+    )
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+
+    root.setLevel(settings.log_level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("httpcore").setLevel(logging.WARNING)
+    logging.getLogger("multipart").setLevel(logging.WARNING)
+
+    listener.start()
+    atexit.register(listener.stop)  # 退出时把队列里剩余的日志写完
+
+    return listener
+
+
+def truncate_payload(
+    payload: Any, max_chars: int = settings.log_payload_max_chars
+) -> str:
+    """把 API 返回内容转化为字符串，超过 max_chars 的部分截断
+
+    Args:
+        payload (Any): 需要记录的内容
+        max_chars (int): 最大字符数
+
+    Returns:
+        str: 截断后的字符串
+    """
+    text = json.dumps(payload, ensure_ascii=False, default=str)
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}...(已截断，共{len(text)}字符)"
+
+
+def log_payload(message: str, payload: Any, **fields: Any) -> None:
+    """按 LOG_PAYLOAD_SAMPLE_RATE 采样记录 API 返回内容，
+    未被采样的请求只记录内容长度，避免大批量识别时日志文件迅速膨胀
+
+    Args:
+        message (str): 日志信息
+        payload (Any): API 返回内容
+        **fields: 其他需要写入结构化日志的字段
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    if random.random() < settings.log_payload_sample_rate:
+        fields["payload"] = truncate_payload(payload)
+    else:
+        fields["payload_chars"] = len(
+            json.dumps(payload, ensure_ascii=False, default=str)
+        )
+
+    logger.info(message, extra=fields, stacklevel=2)
+
+
+class _SetupOnFirstLog(logging.Filter):
+    """第一次记录日志时才调用 setup_logging，只导入模块时不会创建日志文件、启动写日志的线程"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        logger.removeFilter(self)
+        setup_logging()  # 之后 record 会继续传给根 logger 上刚添加的 handler
+        return True
 
 
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("httpcore").setLevel(logging.WARNING)
-logging.getLogger("multipart").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
+# 配置根 logger 之前也要让 INFO 日志通过，否则第一条日志会被丢弃
+logger.setLevel(settings.log_level)
+logger.addFilter(_SetupOnFirstLog())
@@ -0,0 +1,574 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone
+from typing import Literal
+
+import httpx
+
+from ..settings import settings
+from .bank_slip import BANK_SLIP_FIELDS, get_bank_slip_data
+from .invoice import INVOICE_FIELDS, get_invoice_data
+from .log import log_payload, logger
+from .resilience import (
+    AttemptMetrics,
+    CircuitBreaker,
+    CircuitOpenError,
+    OCRAPIError,
+    RetryPolicy,
+    call_with_resilience,
+)
+from .request_api import extract_amount, parse_date, recognize_filetype
+from .shared_store import SharedRateLimiter, get_shared_store
+
+# 解析器版本，修改 normalize、get_bank_slip_data 等解析逻辑后需要加 1，
+# 这样 reprocess 就能找出需要重新解析的记录
+PARSER_VERSION = 2
+
+# bank_slip：银行回单；invoice：增值税发票；auto：由服务商自动判断票据类型
+RecognizeMode = Literal["bank_slip", "invoice", "auto"]
+ResultType = Literal["bank_slip", "invoice"]
+
+
+@dataclass
+class OCRRecord:
+    """所有服务商的识别结果都统一转化为这个格式"""
+
+    result_type: ResultType  # 票据类型
+    fields: dict[str, str]  # 字段 id 对应 BANK_SLIP_FIELDS 或 INVOICE_FIELDS
+    provider: str = ""  # 识别所用的服务商
+    file_url: str = ""  # 票据文件的链接
+    raw: dict = field(default_factory=dict)  # 服务商返回的原始数据
+
+    def to_journal(self) -> dict:
+        """转化为 JournalAccount 使用的字典，只适用于银行回单"""
+
+        def get(field_id: str) -> str:
+            value = self.fields.get(field_id) or ""
+            return "" if value == "未识别" else value
+
+        return {
+            "trade_date": get("trans_date"),
+            "amount": get("trans_amount"),
+            "payer": get("buyer_name"),
+            "receiver": get("seller_name"),
+            "bank_slip_url": self.file_url,
+        }
+
+    def to_invoice(self) -> dict:
+        """转化为 TaxInvoice 使用的字典，只适用于增值税发票"""
+
+        def get(field_id: str) -> str:
+            value = self.fields.get(field_id) or ""
+            return "" if value == "未识别" else value
+
+        return {
+            "invoice_date": get("invoice_date") or None,
+            "invoice_type": get("invoice_type"),
+            "invoice_code": get("invoice_code"),
+            "buyer_name": get("buyer_name"),
+            "seller_name": get("seller_name"),
+            "price_included_tax": get("price_included_tax"),
+            "file_url": self.file_url,
+        }
+
+    def to_counterparties(self) -> dict[str, tuple[str, str]]:
+        """票据上的户名 → (纳税人识别号, 银行账号)，用于补充交易对象的信息，见 utils.counterparty"""
+
+        def get(field_id: str) -> str:
+            value = self.fields.get(field_id) or ""
+            return "" if value == "未识别" else value
+
+        if self.result_type == "bank_slip":
+            parties = [
+                (get("buyer_name"), "", get("buyer_account")),
+                (get("seller_name"), "", get("seller_account")),
+            ]
+        else:
+            parties = [
+                (get("buyer_name"), get("buyer_code"), ""),
+                (get("seller_name"), get("seller_code"), ""),
+            ]
+        return {name: (tax_id, account) for name, tax_id, account in parties if name}
+
+    def to_dict(self) -> dict:
+        return {
+            "result_type": self.result_type,
+            "fields": self.fields,
+            "provider": self.provider,
+            "file_url": self.file_url,
+            "raw": self.raw,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OCRRecord":
+        return cls(**data)
+
+    def compress(self) -> bytes:
+        """压缩后的识别结果，保存在 JournalAccount.raw_response 中"""
+        return zlib.compress(
+            json.dumps(self.to_dict(), ensure_ascii=False).encode("utf-8")
+        )
+
+    @classmethod
+    def decompress(cls, data: bytes) -> "OCRRecord":
+        return cls.from_dict(json.loads(zlib.decompress(data)))
+
+
+class OCRProvider:
+    """OCR 服务商的接口：
+    1. 声明支持的识别模式、QPS 配额和文件大小限制
+    2. request 负责请求一次接口，normalize 负责把返回值转化为 OCRRecord
+    3. 每个服务商有自己的限流器、熔断器和统计数据，限流器的令牌桶保存在共享存储里，
+       多个后端进程加起来也不会超过服务商的 QPS 配额
+    """
+
+    name: str = ""
+    modes: frozenset[str] = frozenset()  # 支持的识别模式
+    max_file_size: int = 7 * 1024 * 1024  # base64 编码前的文件大小限制
+
+    def __init__(self, qps: float):
+        self.qps = qps
+        self.limiter = SharedRateLimiter(f"ocr:{self.name}", qps)
+        self.breaker = CircuitBreaker()
+        self.metrics = AttemptMetrics()
+        self.retry_policy = RetryPolicy(attempt_timeout=settings.ocr_timeout)
+        self.in_flight = 0  # 正在处理的请求数量，用于路由时判断负载
+
+    def supports(self, mode: RecognizeMode, file_size: int) -> bool:
+        return mode in self.modes and file_size <= self.max_file_size
+
+    async def on_token_error(self) -> None:
+        """鉴权信息失效时的回调，需要缓存 token 的服务商重写这个方法"""
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        file_b64: str,
+        filetype: str,
+        mode: RecognizeMode,
+    ) -> dict:
+        raise NotImplementedError
+
+    @staticmethod
+    def normalize(raw: dict, mode: RecognizeMode, filename: str) -> OCRRecord:
+        """把接口返回值转化为 OCRRecord，不依赖服务商实例，重新解析历史数据时也会调用"""
+        raise NotImplementedError
+
+    async def recognize(
+        self, upload_data: bytes, filename: str, mode: RecognizeMode
+    ) -> OCRRecord:
+        """在限流、重试和熔断的保护下识别一个文件
+
+        Args:
+            upload_data (bytes): 文件内容
+            filename (str): 用户上传时的文件名
+            mode (RecognizeMode): 识别模式
+
+        Returns:
+            OCRRecord: 识别结果
+        """
+        filetype, _ = recognize_filetype(filename)
+        file_b64 = base64.b64encode(upload_data).decode("utf-8")
+
+        self.in_flight += 1
+        try:
+            async with httpx.AsyncClient(timeout=settings.ocr_timeout) as client:
+                raw = await call_with_resilience(
+                    lambda: self.request(client, file_b64, filetype, mode),
+                    limiter=self.limiter,
+                    breaker=self.breaker,
+                    metrics=self.metrics,
+                    policy=self.retry_policy,
+                    hedge_delay=settings.ocr_hedge_delay,
+                    on_token_error=self.on_token_error,
+                )
+        finally:
+            self.in_flight -= 1
+
+        log_payload(
+            f"正在处理文件：{filename}",
+            raw,
+            file_name=filename,
+            mode=mode,
+            provider=self.name,
+        )
+
+        record = self.normalize(raw, mode, filename)
+        record.provider = self.name
+        record.raw = raw
+        return record
+
+
+def format_date(date_string: str) -> str:
+    """把票据里的日期字符串转化为 "%Y-%m-%d" 格式，无法解析时返回空字符串"""
+    parsed = parse_date(date_string[:11]) if date_string else ""
+    return parsed.isoformat() if isinstance(parsed, date) else ""
+
+
+class BaiduProvider(OCRProvider):
+    """百度 OCR：银行回单（bank_receipt_new）和增值税发票（vat_invoice）"""
+
+    name = "baidu"
+    modes = frozenset({"bank_slip", "invoice"})
+
+    ENDPOINTS = {"bank_slip": "bank_receipt_new", "invoice": "vat_invoice"}
+
+    def __init__(self, api_key: str, secret_key: str, qps: float = settings.baidu_qps):
+        super().__init__(qps)
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.token = ""
+        self.token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()  # 避免多个请求同时获取 token
+        self._token_key = f"ocr_token:{self.name}"  # token 在共享存储里的 key
+
+    async def get_token(self, client: httpx.AsyncClient) -> str:
+        """获取 access token，token 过期前直接使用缓存：
+        先查进程内的缓存，再查共享存储（其他后端进程获取的 token），都没有时才重新获取
+        """
+        async with self._token_lock:
+            if self.token and time.time() < self.token_expires_at:
+                return self.token
+
+            cached = await get_shared_store().get(self._token_key)
+            if cached:
+                token_data = json.loads(cached)
+                self.token = token_data["token"]
+                self.token_expires_at = token_data["expires_at"]
+                return self.token
+
+            return await self._refresh_token(client)
+
+    async def _refresh_token(self, client: httpx.AsyncClient) -> str:
+        token_url = f"https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={self.api_key}&client_secret={self.secret_key}"
+
+        token_payload = ""
+        token_headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+
+        token_res = await client.post(
+            token_url, json=token_payload, headers=token_headers
+        )
+        token_res.raise_for_status()
+        token_data = token_res.json()
+
+        self.token = token_data["access_token"]
+        # 提前一分钟过期，避免使用时刚好过期
+        ttl = token_data.get("expires_in", 0) - 60
+        self.token_expires_at = time.time() + ttl
+        if ttl > 0:
+            await get_shared_store().set(
+                self._token_key,
+                json.dumps(
+                    {"token": self.token, "expires_at": self.token_expires_at}
+                ).encode(),
+                ttl,
+            )
+
+        return self.token
+
+    async def on_token_error(self) -> None:
+        self.token = ""
+        self.token_expires_at = 0.0
+        await get_shared_store().delete(self._token_key)
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        file_b64: str,
+        filetype: str,
+        mode: RecognizeMode,
+    ) -> dict:
+        token = await self.get_token(client)
+
+        res = await client.post(
+            url=f"https://aip.baidubce.com/rest/2.0/ocr/v1/{self.ENDPOINTS[mode]}?access_token={token}",
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={"image": file_b64} if filetype == "img" else {"pdf_file": file_b64},
+        )
+        res.raise_for_status()
+        result = res.json()
+
+        if "error_code" in result:
+            raise OCRAPIError(result["error_code"], result.get("error_msg", ""))
+
+        return result
+
+    @staticmethod
+    def normalize(raw: dict, mode: RecognizeMode, filename: str) -> OCRRecord:
+        words_result: dict = raw["words_result"]
+
+        if mode == "bank_slip":
+            # bank_receipt_new 的每个字段都是 [{"word": ...}] 格式
+            words = {key: value[0]["word"] for key, value in words_result.items()}
+
+            # 校验api 回传数据是否都是空值
+            if all(word == "" for word in words.values()):
+                logger.error(f"系统报错：「{filename}」似乎不是银行回单")
+                raise ValueError(f"用户上传的文件「{filename}」似乎不是银行回单")
+
+            return OCRRecord(
+                result_type="bank_slip",
+                fields={
+                    "trans_date": format_date(words.get("交易日期", "")),
+                    "buyer_name": words.get("付款人户名", ""),
+                    "buyer_account": words.get("付款人账号", ""),
+                    "buyer_bank": words.get("付款人开户银行", ""),
+                    "seller_name": words.get("收款人户名", ""),
+                    "seller_account": words.get("收款人账号", ""),
+                    "seller_bank": words.get("收款人开户银行", ""),
+                    "trans_amount": extract_amount(words.get("小写金额", "")),
+                },
+            )
+
+        return OCRRecord(
+            result_type="invoice",
+            fields={
+                "invoice_date": format_date(words_result.get("InvoiceDate", "")),
+                "invoice_type": words_result.get("InvoiceType", ""),
+                "invoice_code": words_result.get("InvoiceNum", ""),
+                "buyer_name": words_result.get("PurchaserName", ""),
+                "buyer_code": words_result.get("PurchaserRegisterNum", ""),
+                "seller_name": words_result.get("SellerName", ""),
+                "seller_code": words_result.get("SellerRegisterNum", ""),
+                "tax_amount": words_result.get("TotalTax", ""),
+                "price_excluded_tax": words_result.get("TotalAmount", ""),
+                "price_included_tax": words_result.get("AmountInFiguers", ""),
+            },
+        )
+
+
+class TencentProvider(OCRProvider):
+    """腾讯云通用票据识别（RecognizeGeneralInvoice），可以自动判断票据类型，
+    银行回单会被归类为“其他发票”（OtherInvoice）"""
+
+    name = "tencent"
+    modes = frozenset({"bank_slip", "invoice", "auto"})
+
+    HOST = "ocr.tencentcloudapi.com"
+    SERVICE = "ocr"
+    ACTION = "RecognizeGeneralInvoice"
+    VERSION = "2018-11-19"
+
+    def __init__(
+        self,
+        secret_id: str,
+        secret_key: str,
+        region: str = settings.tencent_region,
+        qps: float = settings.tencent_qps,
+    ):
+        super().__init__(qps)
+        self.secret_id = secret_id
+        self.secret_key = secret_key
+        self.region = region
+
+    def sign_headers(self, payload: str) -> dict[str, str]:
+        """生成 TC3-HMAC-SHA256 签名的请求头"""
+        timestamp = int(time.time())
+        request_date = datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+            "%Y-%m-%d"
+        )
+        content_type = "application/json; charset=utf-8"
+
+        canonical_request = "\n".join(
+            [
+                "POST",
+                "/",
+                "",
+                f"content-type:{content_type}\nhost:{self.HOST}\n",
+                "content-type;host",
+                hashlib.sha256(payload.encode("utf-8")).hexdigest(),
+            ]
+        )
+        credential_scope = f"{request_date}/{self.SERVICE}/tc3_request"
+        string_to_sign = "\n".join(
+            [
+                "TC3-HMAC-SHA256",
+                str(timestamp),
+                credential_scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            ]
+        )
+
+        def _hmac(key: bytes, msg: str) -> bytes:
+            return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+        secret_date = _hmac(f"TC3{self.secret_key}".encode("utf-8"), request_date)
+        secret_service = _hmac(secret_date, self.SERVICE)
+        secret_signing = _hmac(secret_service, "tc3_request")
+        signature = hmac.new(
+            secret_signing, string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+
+        return {
+            "Authorization": (
+                f"TC3-HMAC-SHA256 Credential={self.secret_id}/{credential_scope}, "
+                f"SignedHeaders=content-type;host, Signature={signature}"
+            ),
+            "Content-Type": content_type,
+            "Host": self.HOST,
+            "X-TC-Action": self.ACTION,
+            "X-TC-Timestamp": str(timestamp),
+            "X-TC-Version": self.VERSION,
+            "X-TC-Region": self.region,
+        }
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        file_b64: str,
+        filetype: str,
+        mode: RecognizeMode,
+    ) -> dict:
+        payload = json.dumps({"ImageBase64": file_b64, "EnablePdf": filetype == "pdf"})
+
+        # 每次请求都要重新签名，签名里包含时间戳
+        res = await client.post(
+            f"https://{self.HOST}", headers=self.sign_headers(payload), content=payload
+        )
+        res.raise_for_status()
+        result = res.json()["Response"]
+
+        if "Error" in result:
+            raise OCRAPIError(result["Error"]["Code"], result["Error"]["Message"])
+
+        return result
+
+    @staticmethod
+    def normalize(raw: dict, mode: RecognizeMode, filename: str) -> OCRRecord:
+        items = raw.get("MixedInvoiceItems") or []
+        if not items or items[0].get("Code") != "OK":
+            raise ValueError(f"用户上传的文件「{filename}」没有识别出票据")
+
+        sub_type: str = items[0]["SubType"]
+        invoice_info = items[0]["SingleInvoiceInfos"][sub_type]
+
+        if sub_type == "OtherInvoice":
+            result_type: ResultType = "bank_slip"
+            result_data = get_bank_slip_data(invoice_info["OtherInvoiceListItems"])
+            field_ids = BANK_SLIP_FIELDS
+        else:
+            result_type = "invoice"
+            result_data = get_invoice_data(invoice_info)
+            field_ids = INVOICE_FIELDS
+
+        if mode != "auto" and mode != result_type:
+            raise ValueError(f"用户上传的文件「{filename}」似乎不是{mode}")
+
+        return OCRRecord(
+            result_type=result_type, fields=dict(zip(field_ids, result_data))
+        )
+
+
+class ProviderRouter:
+    """把识别请求分配给多个服务商：
+    1. 只考虑支持当前识别模式和文件大小、并且熔断器没有打开的服务商
+    2. 优先选择 (正在处理的请求数 / QPS 配额) 最小的服务商，这样请求会按配额比例分散，
+       总吞吐量可以超过单个服务商的 QPS 上限
+    3. 服务商熔断时自动换下一个
+    """
+
+    def __init__(self, providers: list[OCRProvider]):
+        self.providers = providers
+
+    def supports_mode(self, mode: RecognizeMode) -> bool:
+        """是否配置了支持这个识别模式的服务商"""
+        return any(mode in provider.modes for provider in self.providers)
+
+    def candidates(self, mode: RecognizeMode, file_size: int) -> list[OCRProvider]:
+        providers = [p for p in self.providers if p.supports(mode, file_size)]
+        return sorted(
+            providers,
+            key=lambda p: (
+                p.breaker.state == "open",
+                not p.limiter.has_capacity(),
+                p.in_flight / p.qps,
+            ),
+        )
+
+    async def recognize(
+        self, upload_data: bytes, filename: str, mode: RecognizeMode
+    ) -> OCRRecord:
+        cache_key = f"ocr_result:{mode}:{hashlib.sha256(upload_data).hexdigest()}"
+        cached = await self.load_cached(cache_key, filename, mode)
+        if cached:
+            return cached
+
+        providers = self.candidates(mode, len(upload_data))
+        if not providers:
+            raise ValueError(f"没有可以处理「{filename}」的 OCR 服务商，请检查配置")
+
+        error: Exception | None = None
+        for provider in providers:
+            try:
+                record = await provider.recognize(upload_data, filename, mode)
+            except CircuitOpenError as e:
+                error = e
+                continue
+            if settings.ocr_cache_ttl > 0:
+                await get_shared_store().set(
+                    cache_key, record.compress(), settings.ocr_cache_ttl
+                )
+            return record
+        raise error  # type:ignore
+
+    @staticmethod
+    async def load_cached(
+        cache_key: str, filename: str, mode: RecognizeMode
+    ) -> OCRRecord | None:
+        """读取缓存的识别结果，用当前的解析器重新解析原始数据，解析器更新后缓存仍然可以使用"""
+        if settings.ocr_cache_ttl <= 0:
+            return None
+        cached = await get_shared_store().get(cache_key)
+        if not cached:
+            return None
+
+        cached_record = OCRRecord.decompress(cached)
+        provider_class = PROVIDER_CLASSES.get(cached_record.provider)
+        if provider_class is None:
+            return None
+        record = provider_class.normalize(cached_record.raw, mode, filename)
+        record.provider = cached_record.provider
+        record.raw = cached_record.raw
+        logger.info(
+            f"文件「{filename}」使用缓存的识别结果",
+            extra={"provider": record.provider, "mode": mode},
+        )
+        return record
+
+
+PROVIDER_CLASSES: dict[str, type[OCRProvider]] = {
+    BaiduProvider.name: BaiduProvider,
+    TencentProvider.name: TencentProvider,
+}
+
+
+def create_router() -> ProviderRouter:
+    """根据环境变量里配置的密钥创建服务商"""
+    providers: list[OCRProvider] = []
+    if settings.baidu_api_key and settings.baidu_secret_key:
+        providers.append(
+            BaiduProvider(settings.baidu_api_key, settings.baidu_secret_key)
+        )
+    if settings.tencent_secret_id and settings.tencent_secret_key:
+        providers.append(
+            TencentProvider(settings.tencent_secret_id, settings.tencent_secret_key)
+        )
+    if not providers:
+        logger.warning("没有配置任何 OCR 服务商的密钥")
+    return ProviderRouter(providers)
+
+
+@functools.cache
+def get_ocr_router() -> ProviderRouter:
+    """第一次识别时才创建服务商，导入模块时不会读取密钥、记录日志"""
+    return create_router()
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Awaitable, Callable
+
+from ..models import JournalAccount, aget_table_version
+from ..settings import settings
+from .archive import load_journal_records
+from .log import logger
+
+"""
+查询结果缓存
+
+/display 每次加载都要扫描整张流水表，并把每一行转化为字典。查询结果按 "查询条件 + 表的版本号"
+缓存在进程内，所有用户共用；create_records、单元格修改、归档等写操作会把表的版本号加一，
+之后的查询自动读取新数据，不需要主动清除缓存
+
+缓存的是序列化后的 JSON 数据块，占用的内存可以准确计算，每次取出时都会解析出新的字典，
+一个用户修改自己表格里的数据不会影响缓存和其他用户
+"""
+
+ROWS_PER_BLOCK = 1000  # 每个数据块的行数
+
+
+@dataclass
+class CacheEntry:
+    version: int  # 缓存时表的版本号
+    blocks: list[bytes]  # JSON 序列化后的数据块，每块最多 ROWS_PER_BLOCK 行
+    size: int  # 占用的字节数
+
+
+def encode_rows(rows: list[dict]) -> list[bytes]:
+    """把查询结果分块序列化，日期等类型和 reflex 序列化的结果一样转化为字符串"""
+    return [
+        json.dumps(
+            rows[start : start + ROWS_PER_BLOCK], ensure_ascii=False, default=str
+        ).encode("utf-8")
+        for start in range(0, len(rows), ROWS_PER_BLOCK)
+    ]
+
+
+def decode_rows(blocks: list[bytes]) -> list[dict]:
+    rows = []
+    for block in blocks:
+        rows.extend(json.loads(block))
+    return rows
+
+
+class QueryCache:
+    """按版本号失效的 LRU 查询结果缓存
+
+    1. 同一个查询只保留最新版本的结果，版本号变化后旧的结果在下次查询时被替换
+    2. 多个用户同时查询同一个没有缓存的结果时，只有一个会读取数据库，其他的等待结果
+    3. 所有结果占用的内存超过 max_bytes 时，淘汰最久没有使用的结果
+    """
+
+    def __init__(self, max_bytes: int = settings.query_cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # 没有用户在等待的锁会被自动回收
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = (
+            weakref.WeakValueDictionary()
+        )
+
+    def _lookup(self, key: str, version: int) -> CacheEntry | None:
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, version: int, rows: list[dict]) -> CacheEntry:
+        blocks = encode_rows(rows)
+        entry = CacheEntry(
+            version=version, blocks=blocks, size=sum(len(block) for block in blocks)
+        )
+        self.invalidate(key)
+        if entry.size > self.max_bytes:
+            logger.info(
+                "查询结果超过缓存的内存上限，不缓存",
+                extra={"key": key, "size": entry.size},
+            )
+            return entry
+
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+        return entry
+
+    def invalidate(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry.size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    async def get_or_load(
+        self,
+        key: str,
+        version: int,
+        loader: Callable[[], Awaitable[list[dict]]],
+    ) -> list[dict]:
+        """
+        读取查询结果，缓存里没有这个版本的结果时调用 loader 读取数据库
+
+        Args:
+            key (str): 查询条件组成的 key
+            version (int): 读取数据之前获取的表的版本号，
+                读取过程中数据发生变化时，缓存的结果对应的是旧版本，下次查询会重新读取
+            loader (Callable[[], Awaitable[list[dict]]]): 读取数据库的函数
+
+        Returns:
+            list[dict]: 查询结果，每次都是新的字典，可以修改
+        """
+        entry = self._lookup(key, version)
+        if entry is None:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = asyncio.Lock()
+            async with lock:
+                entry = self._lookup(key, version)
+                if entry is None:
+                    self.misses += 1
+                    entry = self._store(key, version, await loader())
+                else:
+                    self.hits += 1
+        else:
+            self.hits += 1
+        return decode_rows(entry.blocks)
+
+
+journal_query_cache = QueryCache()
+
+
+async def cached_journal_records(
+    start_date: date | None = None, end_date: date | None = None
+) -> list[dict]:
+    """带缓存的 load_journal_records，流水表没有变化时不读取数据库"""
+    version = await aget_table_version(JournalAccount.__tablename__)  # type:ignore
+    return await journal_query_cache.get_or_load(
+        f"journal:{start_date}:{end_date}",
+        version,
+        lambda: load_journal_records(start_date, end_date),
+    )
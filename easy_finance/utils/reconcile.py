@@ -0,0 +1,467 @@
+import argparse
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import Iterable
+
+import polars as pl
+import reflex as rx
+from sqlalchemy import update
+from sqlmodel import select
+
+from .. import db
+from ..models import JournalAccount, TaxInvoice, bump_table_version
+from ..settings import settings
+from .batch import parse_amount_expr
+from .dedup import normalize_party, within_one_edit
+from .log import logger
+
+NAME_WEIGHT = 0.6  # 户名得分的权重，剩下的是日期得分的权重
+PAGE_SIZE = 20000  # 每次从数据库读取的行数
+
+
+@dataclass
+class ReconcileResult:
+    """一次对账的统计结果"""
+
+    invoices: int = 0  # 参与对账的发票数量
+    journals: int = 0  # 参与对账的流水数量
+    candidates: int = 0  # 金额和日期符合条件的候选组合数量
+    matched: int = 0  # 匹配成功的数量
+
+
+@lru_cache(maxsize=65536)
+def name_similarity(a: str, b: str) -> float:
+    """两个标准化后的户名的相似度：
+    完全相同为 1；只差一个字（一般是 OCR 识别错误）为 0.8；
+    一个包含另一个（例如简称和全称）为 0.6；其他为 0
+    """
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    if within_one_edit(a, b):
+        return 0.8
+    if a in b or b in a:
+        return 0.6
+    return 0.0
+
+
+def amount_cents_expr(column: str) -> pl.Expr:
+    """金额转化为以分为单位的整数，作为候选匹配的分桶依据"""
+    return (
+        (parse_amount_expr(pl.col(column)) * 100).cast(pl.Int64).alias("amount_cents")
+    )
+
+
+def load_frame(
+    model: type[rx.Model], query, schema: dict, page_size: int = PAGE_SIZE
+) -> pl.DataFrame:
+    """按 id 分页读取查询结果，合并为 DataFrame，query 的第一列必须是 model 的 id"""
+    frames = []
+    last_id = 0
+    while True:
+        with db.session() as session:
+            rows = session.exec(
+                query.where(model.id > last_id)  # type:ignore
+                .order_by(model.id)  # type:ignore
+                .limit(page_size)
+            ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        frames.append(
+            pl.DataFrame([tuple(row) for row in rows], schema=schema, orient="row")
+        )
+    return pl.concat(frames) if frames else pl.DataFrame(schema=schema)
+
+
+def load_invoices(
+    invoice_ids: Iterable[int] | None, date_range: tuple[date, date] | None
+) -> pl.DataFrame:
+    """读取还没有匹配的发票"""
+    query = select(
+        TaxInvoice.id,
+        TaxInvoice.invoice_date,
+        TaxInvoice.buyer_name,
+        TaxInvoice.seller_name,
+        TaxInvoice.price_included_tax,
+        TaxInvoice.file_url,
+    ).where(
+        TaxInvoice.journal_id.is_(None),  # type:ignore
+        TaxInvoice.invoice_date.is_not(None),  # type:ignore
+    )
+    if invoice_ids is not None:
+        query = query.where(TaxInvoice.id.in_(list(invoice_ids)))  # type:ignore
+    if date_range:
+        query = query.where(
+            TaxInvoice.invoice_date >= date_range[0],  # type:ignore
+            TaxInvoice.invoice_date <= date_range[1],  # type:ignore
+        )
+
+    return load_frame(
+        TaxInvoice,
+        query,
+        {
+            "invoice_id": pl.Int64,
+            "invoice_date": pl.Date,
+            "buyer_name": pl.String,
+            "seller_name": pl.String,
+            "price_included_tax": pl.String,
+            "file_url": pl.String,
+        },
+    ).with_columns(amount_cents_expr("price_included_tax"))
+
+
+def load_journals(
+    journal_ids: Iterable[int] | None, date_range: tuple[date, date] | None
+) -> pl.DataFrame:
+    """读取还没有关联发票的流水"""
+    query = select(
+        JournalAccount.id,
+        JournalAccount.trade_date,
+        JournalAccount.payer,
+        JournalAccount.receiver,
+        JournalAccount.amount,
+    ).where(JournalAccount.tax_invoice_url == "")
+    if journal_ids is not None:
+        query = query.where(JournalAccount.id.in_(list(journal_ids)))  # type:ignore
+    if date_range:
+        query = query.where(
+            JournalAccount.trade_date >= date_range[0],
+            JournalAccount.trade_date <= date_range[1],
+        )
+
+    return load_frame(
+        JournalAccount,
+        query,
+        {
+            "journal_id": pl.Int64,
+            "trade_date": pl.Date,
+            "payer": pl.String,
+            "receiver": pl.String,
+            "amount": pl.String,
+        },
+    ).with_columns(amount_cents_expr("amount"))
+
+
+def date_bucket_expr(column: str, window: int) -> pl.Expr:
+    """日期按 window 天分桶，相差不超过 window 天的两个日期一定在相同或者相邻的桶里"""
+    return (pl.col(column).cast(pl.Int32) // window).alias("date_bucket")
+
+
+def generate_candidates(
+    invoices: pl.DataFrame,
+    journals: pl.DataFrame,
+    window: int = settings.reconcile_date_window_days,
+    max_pairs_per_key: int = settings.reconcile_max_pairs_per_key,
+) -> pl.DataFrame:
+    """候选组合：金额（分）相同，且日期在相同或相邻的桶里，再过滤掉日期相差超过 window 天的组合
+
+    1. 先按 (金额, 日期桶, 标准化后的收款方/销售方) 做等值连接，
+    同一个金额（例如每月固定的 1000 元房租）的发票和流水只会和同一个交易对象的组合
+    2. 没有找到候选组合的发票和流水（一般是户名有 OCR 识别错误或者使用了简称），再按 (金额, 日期桶) 连接，
+    这一步是两两组合，组合数量超过 max_pairs_per_key 的桶会跳过，避免数据倾斜时占满内存
+
+    Returns:
+        pl.DataFrame: 每一行是一个 (发票, 流水) 组合，包含 date_diff 列
+    """
+    invoice_keys = (
+        invoices.lazy()
+        .drop_nulls(["amount_cents"])
+        .with_columns(
+            date_bucket_expr("invoice_date", window),
+            normalize_party_expr("seller_name").alias("party_key"),
+        )
+        # 发票复制到相邻的三个桶里，流水只需要连接自己所在的桶
+        .with_columns(
+            pl.concat_list(
+                pl.col("date_bucket") - 1,
+                pl.col("date_bucket"),
+                pl.col("date_bucket") + 1,
+            )
+        )
+        .explode("date_bucket")
+        .collect()
+    )
+    journal_keys = (
+        journals.lazy()
+        .drop_nulls(["amount_cents"])
+        .with_columns(
+            date_bucket_expr("trade_date", window),
+            normalize_party_expr("receiver").alias("party_key"),
+        )
+        .collect()
+    )
+
+    def within_window(pairs: pl.LazyFrame) -> pl.LazyFrame:
+        return (
+            pairs.with_columns(
+                date_diff=(
+                    pl.col("trade_date") - pl.col("invoice_date")
+                ).dt.total_days()
+            )
+            .filter(pl.col("date_diff").abs() <= window)
+            .drop("party_key", "party_key_right", strict=False)
+        )
+
+    exact = within_window(
+        invoice_keys.lazy()
+        .filter(pl.col("party_key") != "")  # 没有识别出户名的发票只能模糊匹配
+        .join(journal_keys.lazy(), on=["amount_cents", "date_bucket", "party_key"])
+    ).collect()
+
+    rest_invoices = invoice_keys.join(exact, on="invoice_id", how="anti")
+    rest_journals = journal_keys.join(exact, on="journal_id", how="anti")
+    key = ["amount_cents", "date_bucket"]
+    pair_counts = (
+        rest_invoices.group_by(key)
+        .len("invoice_count")
+        .join(rest_journals.group_by(key).len("journal_count"), on=key)
+        .with_columns(pairs=pl.col("invoice_count") * pl.col("journal_count"))
+    )
+    skipped = pair_counts.filter(pl.col("pairs") > max_pairs_per_key)
+    if not skipped.is_empty():
+        logger.warning(
+            f"{len(skipped)} 个金额和日期相同的分组组合数量过多，跳过户名模糊匹配",
+            extra={"max_pairs": skipped["pairs"].max()},
+        )
+
+    fuzzy = within_window(
+        rest_invoices.lazy()
+        .join(
+            pair_counts.lazy().filter(pl.col("pairs") <= max_pairs_per_key).select(key),
+            on=key,
+            how="semi",
+        )
+        .join(rest_journals.lazy(), on=key)
+    ).collect()
+
+    return pl.concat([exact, fuzzy.select(exact.columns)])
+
+
+def normalize_party_expr(column: str) -> pl.Expr:
+    """户名标准化，每个不同的户名只计算一次"""
+    return pl.col(column).map_batches(
+        lambda names: names.replace_strict(
+            {name: normalize_party(name) for name in names.unique()},
+            return_dtype=pl.String,
+        ),
+        return_dtype=pl.String,
+    )
+
+
+def similarity_frame(pairs: pl.DataFrame) -> pl.DataFrame:
+    """计算 (a, b) 两列户名的相似度，只对不重复的户名组合调用 name_similarity"""
+    pairs = pairs.unique()
+    return pairs.with_columns(
+        pl.Series(
+            [name_similarity(a, b) for a, b in pairs.iter_rows()], dtype=pl.Float64
+        ).alias("similarity")
+    )
+
+
+def score_candidates(
+    candidates: pl.DataFrame, window: int = settings.reconcile_date_window_days
+) -> pl.DataFrame:
+    """给候选组合打分：
+    1. 户名得分：收款方和销售方的相似度，付款方和购买方的相似度（发票没有识别出购买方时只看销售方）
+    2. 日期得分：日期越接近得分越高
+    得分 = 户名得分 * NAME_WEIGHT + 日期得分 * (1 - NAME_WEIGHT)
+
+    候选组合可能有几百万个，但不同的户名组合很少，所以先对户名组合去重再计算相似度
+    """
+    candidates = candidates.with_columns(
+        *(
+            normalize_party_expr(column)
+            for column in ("payer", "receiver", "buyer_name", "seller_name")
+        )
+    )
+    seller_scores = similarity_frame(
+        candidates.select("receiver", "seller_name")
+    ).rename({"similarity": "seller_score"})
+    buyer_scores = similarity_frame(candidates.select("payer", "buyer_name")).rename(
+        {"similarity": "buyer_score"}
+    )
+
+    return (
+        candidates.join(seller_scores, on=["receiver", "seller_name"], join_nulls=True)
+        # 户名完全对不上的组合即使日期很接近也不匹配
+        .filter(pl.col("seller_score") > 0)
+        .join(buyer_scores, on=["payer", "buyer_name"], join_nulls=True)
+        .with_columns(
+            name_score=pl.when(pl.col("buyer_name").fill_null("") == "")
+            .then(pl.col("seller_score"))
+            .otherwise((pl.col("seller_score") + pl.col("buyer_score")) / 2),
+            date_score=1 - pl.col("date_diff").abs() / window,
+        )
+        .with_columns(
+            score=pl.col("name_score") * NAME_WEIGHT
+            + pl.col("date_score") * (1 - NAME_WEIGHT)
+        )
+        .filter(pl.col("score") >= settings.reconcile_min_score)
+    )
+
+
+def assign_matches(scored: pl.DataFrame) -> list[dict]:
+    """按得分从高到低贪心地一对一分配，每张发票和每笔流水最多匹配一次"""
+    used_invoices: set[int] = set()
+    used_journals: set[int] = set()
+    matches = []
+
+    for row in scored.sort(
+        ["score", "invoice_id", "journal_id"], descending=[True, False, False]
+    ).iter_rows(named=True):
+        if row["invoice_id"] in used_invoices or row["journal_id"] in used_journals:
+            continue
+        used_invoices.add(row["invoice_id"])
+        used_journals.add(row["journal_id"])
+        matches.append(row)
+
+    return matches
+
+
+def save_matches(matches: list[dict]) -> None:
+    """把匹配结果写入数据库：流水的 tax_invoice_url 设置为发票链接，发票记录匹配到的流水"""
+    with db.session() as session:
+        session.execute(
+            update(JournalAccount),
+            [
+                {"id": match["journal_id"], "tax_invoice_url": match["file_url"]}
+                for match in matches
+            ],
+        )
+        session.execute(
+            update(TaxInvoice),
+            [
+                {
+                    "id": match["invoice_id"],
+                    "journal_id": match["journal_id"],
+                    "match_score": round(match["score"], 4),
+                }
+                for match in matches
+            ],
+        )
+        bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+        session.commit()
+
+
+def reconcile(
+    invoice_ids: Iterable[int] | None = None,
+    journal_ids: Iterable[int] | None = None,
+    apply: bool = True,
+    window: int = settings.reconcile_date_window_days,
+) -> ReconcileResult:
+    """把还没有匹配的发票和还没有关联发票的流水自动对账
+
+    1. 不传 invoice_ids 和 journal_ids 时，对整个账本做全量对账
+    2. 传入 invoice_ids 时（新上传了发票），只对这些发票开票日期前后 window 天内的流水对账
+    3. 传入 journal_ids 时（新上传了流水），只对这些流水交易日期前后 window 天内的发票对账
+
+    Args:
+        invoice_ids (Iterable[int] | None): 新增的发票 id
+        journal_ids (Iterable[int] | None): 新增的流水 id
+        apply (bool): 是否把匹配结果写入数据库
+        window (int): 日期最多相差的天数，至少为 1
+
+    Returns:
+        ReconcileResult: 对账结果
+    """
+    if window < 1:
+        raise ValueError(f"日期最多相差的天数至少为 1，当前为 {window}")
+
+    start_time = time.time()
+    result = ReconcileResult()
+
+    if invoice_ids is not None:
+        invoices = load_invoices(invoice_ids, None)
+        if invoices.is_empty():
+            return result
+        journals = load_journals(
+            journal_ids,
+            (
+                invoices["invoice_date"].min() - timedelta(days=window),  # type:ignore
+                invoices["invoice_date"].max() + timedelta(days=window),  # type:ignore
+            ),
+        )
+    elif journal_ids is not None:
+        journals = load_journals(journal_ids, None)
+        if journals.is_empty():
+            return result
+        invoices = load_invoices(
+            None,
+            (
+                journals["trade_date"].min() - timedelta(days=window),  # type:ignore
+                journals["trade_date"].max() + timedelta(days=window),  # type:ignore
+            ),
+        )
+    else:
+        invoices = load_invoices(None, None)
+        journals = load_journals(None, None)
+
+    result.invoices, result.journals = len(invoices), len(journals)
+    if invoices.is_empty() or journals.is_empty():
+        return result
+
+    candidates = generate_candidates(invoices, journals, window)
+    result.candidates = len(candidates)
+    matches = assign_matches(score_candidates(candidates, window))
+    result.matched = len(matches)
+
+    if apply and matches:
+        save_matches(matches)
+
+    logger.info(
+        f"对账完成，用时：{time.time() - start_time:.2f}s",
+        extra={"apply": apply, **result.__dict__},
+    )
+    return result
+
+
+def save_invoices(invoices: list[dict]) -> list[int]:
+    """保存识别出的发票，发票号码已经存在的发票不会重复保存
+
+    Args:
+        invoices (list[dict]): OCRRecord.to_invoice() 的结果
+
+    Returns:
+        list[int]: 新保存的发票 id
+    """
+    codes = [invoice["invoice_code"] for invoice in invoices if invoice["invoice_code"]]
+    with db.session() as session:
+        existing = set(
+            session.exec(
+                select(TaxInvoice.invoice_code).where(
+                    TaxInvoice.invoice_code.in_(codes)  # type:ignore
+                )
+            ).all()
+        )
+        new_invoices = []
+        for invoice in invoices:
+            if invoice["invoice_code"] and invoice["invoice_code"] in existing:
+                continue
+            existing.add(invoice["invoice_code"])
+            new_invoices.append(TaxInvoice.model_validate(invoice))
+        session.add_all(new_invoices)
+        session.commit()
+        return [invoice.id for invoice in new_invoices]  # type:ignore
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.reconcile [--dry-run]
+    parser = argparse.ArgumentParser(description="发票和流水全量自动对账")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="只统计匹配结果，不写入数据库"
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=settings.reconcile_date_window_days,
+        help="日期最多相差的天数",
+    )
+    args = parser.parse_args()
+    if args.window < 1:
+        parser.error("--window 至少为 1")
+
+    print(reconcile(apply=not args.dry_run, window=args.window))
@@ -0,0 +1,246 @@
+import argparse
+import tracemalloc
+from dataclasses import asdict, dataclass, fields
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Literal
+
+from .bank_slip import BANK_SLIP_FIELDS, parse_none
+from .invoice import INVOICE_FIELDS
+
+if TYPE_CHECKING:
+    from .ocr_provider import OCRRecord
+
+"""
+识别结果在内存里的格式
+
+每个用户的识别结果保存在后端的 state 里，一个批次可能有上千行。以前每一行是一个列表或字典，
+字典要为每一行保存一份字段名的哈希表，列表也要额外分配一块数组。现在每一行是一个
+slots dataclass，字段直接保存在对象里，字段名和表头只在 COLUMNS 里保存一份，
+由解析结果、上传页面、入库和导出共用，只有发送给前端的时候才转化为列表或字典。
+
+测量每行节省的内存：
+
+    python -m easy_finance.utils.records --rows 10000
+"""
+
+CellType = Literal["text", "date", "number"]
+
+
+@dataclass(frozen=True, slots=True)
+class Column:
+    """表格的一列"""
+
+    field: str  # 字段 id
+    title: str  # 表头
+    width: int = 200  # recognize 页面的列宽
+    cell_type: CellType = "text"  # upload 和 display 页面表格的单元格类型
+
+    def to_data_editor(self) -> dict:
+        """转化为 rx.data_editor 使用的列定义"""
+        return {
+            "title": self.title,
+            "id": self.field,
+            "type": "str",
+            "width": self.width,
+        }
+
+
+@dataclass(slots=True)
+class RecognizedRow:
+    """recognize 页面表格的一行，第一列是文件名，其余各列和 OCRRecord.fields 对应"""
+
+    COLUMNS: ClassVar[tuple[Column, ...]] = ()
+
+    @classmethod
+    def from_record(cls, file_name: str, record: "OCRRecord") -> "RecognizedRow":
+        return cls(
+            file_name,  # type:ignore
+            **{
+                column.field: parse_none(record.fields.get(column.field))
+                for column in cls.COLUMNS[1:]
+            },
+        )
+
+    def to_list(self) -> list[str]:
+        """转化为前端表格和导出 excel 使用的列表，顺序和 COLUMNS 一致"""
+        return [getattr(self, column.field) for column in self.COLUMNS]
+
+    def set_cell(self, col: int, value: str) -> None:
+        setattr(self, self.COLUMNS[col].field, value)
+
+    @classmethod
+    def headers(cls) -> list[str]:
+        return [column.title for column in cls.COLUMNS]
+
+
+@dataclass(slots=True)
+class BankSlipRow(RecognizedRow):
+    COLUMNS: ClassVar[tuple[Column, ...]] = (
+        Column("file_name", "文件名"),
+        Column("trans_date", "转账日期", 100),
+        Column("buyer_name", "付款人名称"),
+        Column("buyer_account", "付款人账号", 250),
+        Column("buyer_bank", "付款人开户行"),
+        Column("seller_name", "收款人名称"),
+        Column("seller_account", "收款人账号", 250),
+        Column("seller_bank", "收款人开户银行"),
+        Column("trans_amount", "转账金额", 100),
+    )
+
+    file_name: str
+    trans_date: str
+    buyer_name: str
+    buyer_account: str
+    buyer_bank: str
+    seller_name: str
+    seller_account: str
+    seller_bank: str
+    trans_amount: str
+
+
+@dataclass(slots=True)
+class InvoiceRow(RecognizedRow):
+    COLUMNS: ClassVar[tuple[Column, ...]] = (
+        Column("file_name", "文件名"),
+        Column("invoice_date", "开票日期", 100),
+        Column("invoice_type", "发票类型"),
+        Column("invoice_code", "发票号码"),
+        Column("buyer_name", "购买方名称"),
+        Column("buyer_code", "购买方统一社会信用代码"),
+        Column("seller_name", "销售方名称"),
+        Column("seller_code", "销售方统一社会信用代码"),
+        Column("tax_amount", "税额", 50),
+        Column("price_excluded_tax", "不含税价格", 100),
+        Column("price_included_tax", "价税合计", 100),
+    )
+
+    file_name: str
+    invoice_date: str
+    invoice_type: str
+    invoice_code: str
+    buyer_name: str
+    buyer_code: str
+    seller_name: str
+    seller_code: str
+    tax_amount: str
+    price_excluded_tax: str
+    price_included_tax: str
+
+
+# 流水表格的列，upload 和 display 页面的表格、导出文件的表头都使用这些列
+JOURNAL_COLUMNS: tuple[Column, ...] = (
+    Column("trade_date", "交易日期", cell_type="date"),
+    Column("description", "项目描述"),
+    Column("additional_info", "备注"),
+    Column("amount", "金额", cell_type="number"),
+    Column("category", "分类"),
+    Column("payer", "付款方"),
+    Column("receiver", "收款方"),
+    Column("bank_slip_url", "银行回单"),
+    Column("tax_invoice_url", "发票"),
+)
+
+JOURNAL_EDITABLE_FIELDS = frozenset(column.field for column in JOURNAL_COLUMNS)
+
+
+@dataclass(slots=True)
+class JournalDraft:
+    """upload 页面表格里还没有入库的一条流水"""
+
+    trade_date: str = ""
+    description: str = ""
+    additional_info: str = ""
+    amount: str = ""
+    category: str = ""
+    payer: str = ""
+    receiver: str = ""
+    bank_slip_url: str = ""
+    tax_invoice_url: str = ""
+    category_rule_id: int | None = None  # 按规则填写的分类对应的 CategoryRule id
+    duplicate: str = ""  # 重复检查的结果，见 utils.dedup.DuplicateFlag
+    raw_response: bytes | None = None  # 压缩后的识别结果，只保存在后端
+
+    @classmethod
+    def from_record(cls, record: "OCRRecord") -> "JournalDraft":
+        return cls(**record.to_journal(), raw_response=record.compress())
+
+    def to_dict(self) -> dict:
+        """转化为前端表格、查重和自动分类使用的字典，不包括原始识别结果"""
+        return {
+            field.name: getattr(self, field.name)
+            for field in fields(self)
+            if field.name != "raw_response"
+        }
+
+    def to_journal(self) -> dict:
+        """转化为 JournalAccount 使用的字典"""
+        journal = asdict(self)
+        del journal["duplicate"]
+        return journal
+
+    def set_cell(self, field: str, value: Any) -> None:
+        """修改用户可以编辑的字段"""
+        if field not in JOURNAL_EDITABLE_FIELDS:
+            raise ValueError(f"字段 {field} 不能修改")
+        setattr(self, field, value)
+
+
+def measure_bytes(build: Callable[[], list]) -> int:
+    """用 tracemalloc 统计 build 新分配的内存，build 的返回值在统计结束后才释放"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return allocated
+
+
+def measure_row_memory(rows: int = 10000) -> dict[str, tuple[float, float]]:
+    """
+    比较旧格式（列表、字典）和 slots dataclass 每行占用的内存，
+    字段值的字符串事先生成，两种格式共用，只统计容器本身的内存
+
+    Returns:
+        dict[str, tuple[float, float]]: 表格名称对应 (旧格式每行字节数, 新格式每行字节数)
+    """
+
+    def sample_values(field_count: int) -> list[list[str]]:
+        return [[f"{row}-{col}" for col in range(field_count)] for row in range(rows)]
+
+    bank_slips = sample_values(len(BANK_SLIP_FIELDS) + 1)
+    invoices = sample_values(len(INVOICE_FIELDS) + 1)
+    journal_fields = [field.name for field in fields(JournalDraft)][:-1]
+    journals = sample_values(len(journal_fields))
+
+    def per_row(build: Callable[[], list]) -> float:
+        return measure_bytes(build) / rows
+
+    return {
+        "银行回单": (
+            per_row(lambda: [list(values) for values in bank_slips]),
+            per_row(lambda: [BankSlipRow(*values) for values in bank_slips]),
+        ),
+        "增值税发票": (
+            per_row(lambda: [list(values) for values in invoices]),
+            per_row(lambda: [InvoiceRow(*values) for values in invoices]),
+        ),
+        "待入库流水": (
+            per_row(lambda: [dict(zip(journal_fields, values)) for values in journals]),
+            per_row(lambda: [JournalDraft(*values) for values in journals]),
+        ),
+    }
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.records
+    parser = argparse.ArgumentParser(description="测量识别结果每行占用的内存")
+    parser.add_argument("--rows", type=int, default=10000, help="测量的行数")
+    args = parser.parse_args()
+
+    for name, (old, new) in measure_row_memory(args.rows).items():
+        print(
+            f"{name}：旧格式 {old:.0f} 字节/行，slots {new:.0f} 字节/行，"
+            f"节省 {1 - new / old:.0%}"
+        )
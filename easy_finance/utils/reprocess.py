@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import Iterator
+
+import polars as pl
+
+from sqlalchemy import update
+from sqlmodel import select
+
+from .. import db
+from ..models import JournalAccount, bump_table_version
+from .batch import process_bank_slips
+from .categorize import apply_rules
+from .change_feed import publish_changes
+from .counterparty import assign_counterparty_ids
+from .dedup import record_fingerprint
+from .log import logger
+from .ocr_provider import PARSER_VERSION, OCRRecord
+
+# 重新解析时会比较和更新的字段
+REPROCESS_FIELDS = ("trade_date", "amount", "payer", "receiver")
+# 重新分类时还需要用到的字段
+STORED_FIELDS = REPROCESS_FIELDS + ("description", "category", "category_rule_id")
+
+
+def reparse(rows: list[tuple[int, bytes]]) -> list[tuple[int, dict | None, str]]:
+    """用 batch.process_bank_slips 批量重新解析一组记录保存的原始返回值，在子进程中运行
+
+    Args:
+        rows (list[tuple[int, bytes]]): (记录 id, 压缩后的原始返回值) 的列表
+
+    Returns:
+        list[tuple[int, dict | None, str]]: (记录 id, 新的字段值, 错误信息) 的列表，
+        解析失败或者缺少日期、金额、付款方、收款方时字段值为 None
+    """
+    results: list[tuple[int, dict | None, str]] = []
+    record_ids = []
+    records = []
+    for record_id, raw_response in rows:
+        try:
+            records.append(OCRRecord.decompress(raw_response))
+            record_ids.append(record_id)
+        except Exception as e:
+            results.append((record_id, None, f"原始返回值无法解压：{e}"))
+
+    frame = process_bank_slips(records).select(
+        *(
+            pl.col(field).cast(pl.String) if field == "amount" else field
+            for field in REPROCESS_FIELDS
+        ),
+        "error",
+    )
+    for record_id, values in zip(record_ids, frame.iter_rows(named=True)):
+        error = values.pop("error")
+        results.append((record_id, None, error) if error else (record_id, values, ""))
+    return results
+
+
+def iter_raw_rows(reprocess_all: bool, chunk_size: int) -> Iterator[list[tuple]]:
+    """按 id 分页读取保存了原始返回值的记录，不会一次性把整张表读进内存，
+    每一页都使用单独的 session，读取时不会长时间占用数据库，不影响写入
+
+    Args:
+        reprocess_all (bool): 为 True 时读取所有记录，否则只读取解析器版本低于当前版本的记录
+        chunk_size (int): 每页的数量
+
+    Yields:
+        list[tuple]: (id, raw_response, *STORED_FIELDS) 的列表
+    """
+    query = select(
+        JournalAccount.id,
+        JournalAccount.raw_response,
+        *(getattr(JournalAccount, field) for field in STORED_FIELDS),
+    ).where(
+        JournalAccount.raw_response.is_not(None)  # type:ignore
+    )
+    if not reprocess_all:
+        query = query.where(JournalAccount.parser_version < PARSER_VERSION)
+
+    last_id = 0
+    while True:
+        with db.session() as session:
+            chunk = session.exec(
+                query.where(JournalAccount.id > last_id)  # type:ignore
+                .order_by(JournalAccount.id)  # type:ignore
+                .limit(chunk_size)
+            ).all()
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        yield list(chunk)
+
+
+def reprocess_ledger(
+    apply: bool = False,
+    reprocess_all: bool = False,
+    workers: int | None = None,
+    chunk_size: int = 1000,
+) -> dict[str, int]:
+    """用当前版本的解析器重新解析数据库里保存的原始返回值，不需要再次调用 OCR 接口：
+    1. 分批读取记录，交给进程池在所有 CPU 核心上并行解析，每个进程用 batch.process_bank_slips 批量清洗
+    2. 和数据库里的值比较，找出发生变化的记录
+    3. apply 为 True 时批量更新这些记录，重新计算交易对象和分类，并把解析器版本更新为当前版本，
+    最后通知所有页面重新加载流水
+
+    注意：用户在表格里手动修改过的值也会被覆盖，所以默认只统计差异，不更新数据库；
+    解析不出日期、金额、付款方或收款方的记录不会更新，计入解析失败的数量
+
+    Args:
+        apply (bool): 是否把结果写入数据库
+        reprocess_all (bool): 是否重新解析所有记录，默认只解析版本低于当前版本的记录
+        workers (int | None): 进程数量，默认是 CPU 核心数
+        chunk_size (int): 每批处理的记录数量
+
+    Returns:
+        dict[str, int]: 处理的记录数、发生变化的记录数和解析失败的记录数
+    """
+    stats = {"processed": 0, "changed": 0, "failed": 0}
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for chunk in iter_raw_rows(reprocess_all, chunk_size):
+            stored_rows = {row[0]: dict(zip(STORED_FIELDS, row[2:])) for row in chunk}
+            updates = []
+            changed_rows = []
+
+            # 每个子进程处理一段，段内用 polars 表达式批量清洗
+            step = max(1, len(chunk) // (4 * (workers or os.cpu_count() or 1)))
+            raw_rows = [(row[0], row[1]) for row in chunk]
+            for record_id, new_values, error in chain.from_iterable(
+                executor.map(
+                    reparse,
+                    [
+                        raw_rows[start : start + step]
+                        for start in range(0, len(raw_rows), step)
+                    ],
+                )
+            ):
+                stats["processed"] += 1
+                if new_values is None:
+                    stats["failed"] += 1
+                    logger.warning(f"记录 {record_id} 重新解析失败：{error}")
+                    continue
+
+                changed = {
+                    field: value
+                    for field, value in new_values.items()
+                    if value != stored_rows[record_id][field]
+                }
+                if changed:
+                    stats["changed"] += 1
+                    logger.info(
+                        f"记录 {record_id} 重新解析后发生变化：{changed}",
+                        extra={"record_id": record_id},
+                    )
+                    changed_rows.append(
+                        {**stored_rows[record_id], **changed, "id": record_id}
+                    )
+                else:
+                    updates.append({"id": record_id, "parser_version": PARSER_VERSION})
+
+            if apply and changed_rows:
+                # 付款方或收款方变化后交易对象也会变化，分类规则可能按交易对象、金额匹配，
+                # 所以和新建流水一样重新计算交易对象、分类和指纹，手动填写的分类不会被覆盖
+                derived = apply_rules(
+                    assign_counterparty_ids(changed_rows), overwrite=True
+                )
+                updates.extend(
+                    {
+                        **{field: row[field] for field in REPROCESS_FIELDS},
+                        "id": row["id"],
+                        "payer_id": row["payer_id"],
+                        "receiver_id": row["receiver_id"],
+                        "category": row["category"],
+                        "category_rule_id": row["category_rule_id"],
+                        "fingerprint": record_fingerprint(row),
+                        "parser_version": PARSER_VERSION,
+                    }
+                    for row in derived
+                )
+
+            if apply and updates:
+                with db.session() as session:
+                    # 按主键批量更新
+                    session.execute(update(JournalAccount), updates)
+                    bump_table_version(
+                        session, JournalAccount.__tablename__
+                    )  # type:ignore
+                    session.commit()
+
+    if apply and stats["changed"]:
+        asyncio.run(publish_changes("reload"))
+
+    logger.info(
+        f"重新解析完成，用时：{time.time() - start_time:.2f}s",
+        extra={"apply": apply, **stats},
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.reprocess [--apply] [--all]
+    parser = argparse.ArgumentParser(description="用当前版本的解析器重新解析历史记录")
+    parser.add_argument(
+        "--apply", action="store_true", help="把结果写入数据库，默认只统计差异"
+    )
+    parser.add_argument(
+        "--all", action="store_true", help="重新解析所有记录，默认只解析旧版本的记录"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="进程数量")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="每批处理的数量")
+    args = parser.parse_args()
+
+    print(
+        reprocess_ledger(
+            apply=args.apply,
+            reprocess_all=args.all,
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+        )
+    )
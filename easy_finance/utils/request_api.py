@@ -1,11 +1,4 @@
-import os
-from typing import Literal
-
-import httpx
-from aiolimiter import AsyncLimiter
-from dotenv import load_dotenv
 import reflex as rx
-import base64
 import re
 
 from .log import logger
@@ -13,32 +6,25 @@ import string
 import random
 from datetime import date, datetime
 
-load_dotenv()
-
-
-# 从环境变量中获取密钥参数
-API_KEY = os.getenv("APIKEY")
-SECRET_KEY = os.getenv("SECRETKEY")
-BACK_END = os.getenv("BACK_END")
-
-rate_limit = AsyncLimiter(
-    3, 1
-)  # 腾讯云api限制，最高 QPS 为 5，所以创建一个 limiter ，限制每秒最多并发3个请求
+from ..settings import settings
 
+# 全角字符转半角字符，OCR 识别结果里经常混有全角的数字、字母和标点
+FULL_WIDTH_CHARS = [chr(code) for code in range(0xFF01, 0xFF5F)] + ["　"]
+HALF_WIDTH_CHARS = [chr(code - 0xFEE0) for code in range(0xFF01, 0xFF5F)] + [" "]
 
 DATE_TO_REMOVE = "-/\\.:：年月日时秒分 "
 AMOUNT_PATTERN = re.compile(r"[^\d.]")
 
 
-def recognize_filetype(file: rx.UploadFile) -> tuple[str, str]:
+def recognize_filetype(filename: str) -> tuple[str, str]:
     """
     检查用户上传的文件是图片还是pdf
     Args:
-        file:用户上传的文件
+        filename:用户上传的文件名
     Returns: 是图片就返回img，是pdf，就返回pdf，都不是就报错
 
     """
-    filename = file.filename.lower()
+    filename = filename.lower()
     image_extensions = (".jpg", ".jpeg", ".png", ".bmp")
     file_extension = (
         "." + filename.split(".")[-1] if "." in filename else ""
@@ -109,130 +95,38 @@ def extract_amount(amount_str: str) -> str:
         return result
 
 
-def process_bank_slip(words_result: dict) -> dict:
-    trade_date = parse_date(words_result["交易日期"][0]["word"])
-    amount = extract_amount(words_result["小写金额"][0]["word"])
-    payer = words_result["付款人户名"][0]["word"]
-    receiver = words_result["收款人户名"][0]["word"]
-
-    return {
-        "trade_date": trade_date,
-        "amount": amount,
-        "payer": payer,
-        "receiver": receiver,
-    }
+def new_upload_filename(filename: str) -> str:
+    """用时间和随机字符串生成上传目录里的新文件名，扩展名和用户上传时的文件名相同"""
+    _, file_extension = recognize_filetype(filename)  # 获取文件扩展名
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{generate_random_string()}{file_extension}"
 
 
-async def request_api(
-    file: rx.UploadFile, mode: Literal["bank_slip", "vat_invoice"]
-) -> dict:
+def save_upload_file(filename: str, upload_data: bytes) -> str:
     """
-    想百度api发出请求，将文件（图片/pdf）上传，根据模式不同上传到不同的 api 接口
+    用时间和随机字符串给文件重新命名，并保存到上传目录（默认是 uploaded_files）
     Args:
-        file: 用户上传的 文件（图片/pdf）
-        mode: 识别模式，目前支持两种模式，银行回单识别（bank_slip）或增值税发票识别（vat_invoice）
+        filename: 用户上传时的文件名，用于获取扩展名
+        upload_data: 文件内容
 
     Returns:
-        返回识别结果的字典。
-
+        保存后的新文件名
     """
+    # storage 导入了本模块，在这里导入避免循环导入
+    from .storage import storage_manager
 
-    async with httpx.AsyncClient() as client:
-
-        # ---------获取token-----------
-
-        token_url = f"https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={API_KEY}&client_secret={SECRET_KEY}"
-
-        token_payload = ""
-        token_headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-
-        token_res = await client.post(
-            token_url, json=token_payload, headers=token_headers
-        )
-
-        token = token_res.json()["access_token"]
-
-        # ----处理文件-----
-
-        filetype, file_extension = recognize_filetype(
-            file
-        )  # 获取文件类型 和 文件扩展名
-
-        # 用时间和随机字符串给文件重新命名
-        new_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{generate_random_string()}{file_extension}"
-        upload_file = rx.get_upload_dir() / new_filename  # 创建一个保存上传文件的地址，
-
-        # 默认保存文件的目录时 upload_files
-
-        upload_data = await file.read()
-
-        with upload_file.open("wb") as file_object:
-            file_object.write(upload_data)  # 把文件保存到指定目录
-
-        # 输出文件的 base64 字符串
-        file_b64 = base64.b64encode(upload_data).decode("utf-8")
-
-        # 请求api的参数
-        request_headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        request_payload = (
-            {"image": file_b64} if filetype == "img" else {"pdf_file": file_b64}
-        )
-
-        match mode:
-
-            case "bank_slip":
-
-                # ----------银行回单请求-------
-
-                bank_slip_url = f"https://aip.baidubce.com/rest/2.0/ocr/v1/bank_receipt_new?access_token={token}"
-
-                bank_slip_res = await client.post(
-                    url=bank_slip_url, headers=request_headers, data=request_payload
-                )
-
-                bank_slip_result = bank_slip_res.json()
-
-                logger.info(
-                    f"正在处理文件：{file.filename};API返回的银行回单信息：{bank_slip_result}"
-                )
-
-                words_result: dict = bank_slip_result["words_result"]
-
-                # 校验api 回传数据是否都是空值
-                validate_result = [i[0]["word"] for i in words_result.values()]
-                if all(i == "" for i in validate_result):
-                    logger.error(f"系统报错：「{file.filename}」似乎不是银行回单")
-                    raise ValueError(
-                        f"用户上传的文件「{file.filename}」似乎不是银行回单"
-                    )
-
-                result = process_bank_slip(words_result)
-
-                result["bank_slip_url"] = f"{BACK_END}/_upload/{new_filename}"
-
-                logger.info(result)
-
-                return result
-
-            case "vat_invoice":
-
-                # ------------发票请求-----------
-
-                vat_invoice_url = f"https://aip.baidubce.com/rest/2.0/ocr/v1/vat_invoice?access_token={token}"
+    new_filename = new_upload_filename(filename)
+    storage_manager.reserve(len(upload_data))  # 超过容量时抛出 StorageQuotaError
+    upload_file = rx.get_upload_dir() / new_filename  # 创建一个保存上传文件的地址，
 
-                vat_invoice_res = await client.post(
-                    url=vat_invoice_url, headers=request_headers, data=request_payload
-                )
+    with upload_file.open("wb") as file_object:
+        file_object.write(upload_data)  # 把文件保存到指定目录
 
-                vat_invoice_result = vat_invoice_res.json()
+    return new_filename
 
-                words_result = vat_invoice_result["words_result"]
 
-            case _:
-                raise AttributeError("识别模式错误！")
+def get_file_url(new_filename: str) -> str:
+    """获取上传目录内文件的访问链接"""
+    return f"{settings.back_end}/_upload/{new_filename}"
 
 
 if __name__ == "__main__":
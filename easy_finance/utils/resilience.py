@@ -0,0 +1,446 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from contextlib import AbstractAsyncContextManager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Literal, TypeVar
+
+import httpx
+
+from .log import logger
+
+T = TypeVar("T")
+
+ErrorKind = Literal["retry", "token", "fatal"]
+
+# 百度 OCR 的错误码（数字），详见 https://ai.baidu.com/ai-doc/OCR/dk3h7y5vr
+# 腾讯云 OCR 的错误码（字符串），详见 https://cloud.tencent.com/document/api/866/33528
+RETRY_ERROR_CODES = {
+    2,  # 服务暂不可用
+    4,  # 集群超限额
+    18,  # QPS 超限
+    282000,  # 服务器内部错误
+    "RequestLimitExceeded",  # 请求频率超限
+    "InternalError",  # 内部错误
+    "ResourceUnavailable",  # 服务暂不可用
+    "AuthFailure.SignatureExpire",  # 签名过期，重试时会重新签名
+}
+TOKEN_ERROR_CODES = {
+    110,  # access token 无效
+    111,  # access token 过期
+}
+
+
+class OCRAPIError(Exception):
+    """OCR 接口返回了 error_code"""
+
+    def __init__(self, error_code: int | str, error_msg: str = ""):
+        self.error_code = error_code
+        self.error_msg = error_msg
+        super().__init__(f"OCR 接口报错，错误码：{error_code}，错误信息：{error_msg}")
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，直接拒绝请求"""
+
+
+def classify_error(error: BaseException) -> ErrorKind:
+    """判断一次请求失败后应该怎么处理
+
+    Args:
+        error (BaseException): 请求时抛出的异常
+
+    Returns:
+        ErrorKind: retry 表示可以重试；token 表示需要刷新 access token 后重试；fatal 表示重试也没用
+    """
+    if isinstance(error, OCRAPIError):
+        if error.error_code in TOKEN_ERROR_CODES:
+            return "token"
+        if error.error_code in RETRY_ERROR_CODES:
+            return "retry"
+        return "fatal"
+
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return "retry" if status_code >= 500 or status_code == 429 else "fatal"
+
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError)):
+        return "retry"
+
+    if isinstance(error, asyncio.TimeoutError):
+        return "retry"
+
+    return "fatal"
+
+
+@dataclass
+class RetryPolicy:
+    """重试策略：指数退避 + full jitter"""
+
+    max_attempts: int = 4  # 最多尝试次数（包括第一次）
+    base_delay: float = 0.5  # 第一次重试前的最长等待时间（秒）
+    max_delay: float = 8  # 单次等待时间的上限（秒）
+    attempt_timeout: float = 15  # 单次请求的超时时间（秒）
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次失败后需要等待的时间"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    """熔断器：
+    1. closed：正常放行请求，连续失败 failure_threshold 次后切换为 open
+    2. open：直接拒绝请求，recovery_timeout 秒后切换为 half_open
+    3. half_open：放行一个试探请求，成功则回到 closed，失败则重新 open
+    """
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> None:
+        """请求前调用，熔断器打开时抛出 CircuitOpenError"""
+        if self.state == "closed":
+            return
+
+        # 试探请求还没有结果时，其他请求继续拒绝；
+        # 试探请求迟迟没有结果（例如只遇到了 token 失效）时，每隔 recovery_timeout 秒再放行一个
+        if time.monotonic() - self.opened_at < self.recovery_timeout:
+            raise CircuitOpenError("OCR 服务暂时不可用，请稍后再试")
+        self.state = "half_open"
+        self.opened_at = time.monotonic()
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"OCR 服务连续失败 {self.failures} 次，熔断器打开")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+@dataclass
+class AttemptMetrics:
+    """记录每一次请求尝试的结果，用于观察 OCR 服务的稳定性"""
+
+    counters: Counter = field(default_factory=Counter)
+    total_latency: float = 0.0
+
+    def record(self, outcome: str, latency: float = 0.0) -> None:
+        self.counters[outcome] += 1
+        self.total_latency += latency
+
+    def snapshot(self) -> dict[str, Any]:
+        attempts = self.counters["success"] + sum(
+            count
+            for outcome, count in self.counters.items()
+            if outcome.startswith("error_")
+        )
+        return {
+            **self.counters,
+            "attempts": attempts,
+            "avg_latency": self.total_latency / attempts if attempts else 0.0,
+        }
+
+
+async def _attempt(
+    fn: Callable[[], Awaitable[T]],
+    limiter: AbstractAsyncContextManager,
+    policy: RetryPolicy,
+    metrics: AttemptMetrics,
+) -> T:
+    """在 limiter 的限制下执行一次请求，并记录结果"""
+    async with limiter:
+        start_time = time.monotonic()
+        try:
+            result = await asyncio.wait_for(fn(), policy.attempt_timeout)
+        except Exception as e:
+            metrics.record(f"error_{classify_error(e)}", time.monotonic() - start_time)
+            raise
+        metrics.record("success", time.monotonic() - start_time)
+        return result
+
+
+async def _hedged_attempt(
+    fn: Callable[[], Awaitable[T]],
+    limiter: AbstractAsyncContextManager,
+    policy: RetryPolicy,
+    metrics: AttemptMetrics,
+    hedge_delay: float,
+) -> T:
+    """第一个请求超过 hedge_delay 秒还没有返回时，再发一个相同的请求，取先成功的结果"""
+    tasks = {asyncio.ensure_future(_attempt(fn, limiter, policy, metrics))}
+    error: BaseException | None = None
+    try:
+        done, tasks = await asyncio.wait(tasks, timeout=hedge_delay)
+        if not done:
+            metrics.record("hedge")
+            tasks.add(asyncio.ensure_future(_attempt(fn, limiter, policy, metrics)))
+
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not tasks:
+                raise error  # type:ignore
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_with_resilience(
+    fn: Callable[[], Awaitable[T]],
+    *,
+    limiter: AbstractAsyncContextManager,
+    breaker: CircuitBreaker,
+    metrics: AttemptMetrics,
+    policy: RetryPolicy | None = None,
+    hedge_delay: float = 0,
+    on_token_error: Callable[[], Awaitable[None]] | None = None,
+) -> T:
+    """带重试、对冲请求和熔断的调用
+
+    Args:
+        fn (Callable[[], Awaitable[T]]): 发起一次请求的函数，每次重试都会重新调用
+        limiter (AbstractAsyncContextManager): 限流器，每次尝试（包括重试和对冲请求）都要经过它
+        breaker (CircuitBreaker): 熔断器
+        metrics (AttemptMetrics): 记录每次尝试结果的对象
+        policy (RetryPolicy | None): 重试策略，默认使用 RetryPolicy()
+        hedge_delay (float): 对冲请求的等待时间，0 表示不使用对冲请求
+        on_token_error (Callable[[], Awaitable[None]] | None): access token 失效时的回调，一般用于清空 token 缓存
+
+    Returns:
+        T: fn 的返回值
+    """
+    policy = policy or RetryPolicy()
+
+    for attempt in range(policy.max_attempts):
+        breaker.allow()
+        try:
+            if hedge_delay > 0:
+                result = await _hedged_attempt(
+                    fn, limiter, policy, metrics, hedge_delay
+                )
+            else:
+                result = await _attempt(fn, limiter, policy, metrics)
+        except Exception as e:
+            kind = classify_error(e)
+
+            if kind == "retry":
+                breaker.record_failure()
+            elif kind == "token":
+                # access token 失效不代表服务出了问题，不计入熔断
+                if on_token_error:
+                    await on_token_error()
+            else:
+                # 接口正常返回了无法重试的错误（例如文件格式不对），说明服务本身是可用的
+                breaker.record_success()
+
+            if kind == "fatal" or attempt == policy.max_attempts - 1:
+                raise
+
+            delay = policy.backoff(attempt)
+            metrics.record("retry")
+            logger.warning(
+                f"第 {attempt + 1} 次请求失败：{e}，{delay:.2f}s 后重试",
+                extra={"error_kind": kind},
+            )
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+    raise AssertionError("unreachable")
+
+
+if __name__ == "__main__":
+    # 用本地的 mock 接口注入故障，检查重试、对冲请求和熔断是否符合预期，有一项不符合就以非 0 状态码退出
+    # 运行方式：python -m easy_finance.utils.resilience
+    import sys
+    from contextlib import nullcontext
+
+    from aiolimiter import AsyncLimiter
+
+    def mock_request(*responses: httpx.Response | float):
+        """按顺序返回 responses 的 mock 请求，数字表示先等待这么多秒再返回成功结果"""
+        calls = []
+
+        async def request() -> dict:
+            index = len(calls)
+            calls.append(index)
+            response = responses[min(index, len(responses) - 1)]
+            if isinstance(response, (int, float)):
+                await asyncio.sleep(response)
+                response = httpx.Response(200, json={"words_result": {"call": index}})
+            response.request = httpx.Request("POST", "https://mock/ocr")
+            response.raise_for_status()
+            result = response.json()
+            if "error_code" in result:
+                raise OCRAPIError(result["error_code"])
+            return result
+
+        return request, calls
+
+    def call(request, breaker=None, metrics=None, **kwargs):
+        return call_with_resilience(
+            request,
+            limiter=kwargs.pop("limiter", nullcontext()),
+            breaker=breaker or CircuitBreaker(),
+            metrics=metrics or AttemptMetrics(),
+            policy=kwargs.pop("policy", RetryPolicy(base_delay=0.01)),
+            **kwargs,
+        )
+
+    async def check_retry():
+        request, calls = mock_request(
+            httpx.Response(500), httpx.Response(200, json={"error_code": 18}), 0
+        )
+        metrics = AttemptMetrics()
+        result = await call(request, metrics=metrics)
+        assert result == {"words_result": {"call": 2}}, result
+        assert len(calls) == 3, calls
+        assert metrics.counters["retry"] == 2, metrics.snapshot()
+
+    async def check_retry_exhausted():
+        request, calls = mock_request(httpx.Response(503))
+        try:
+            await call(request)
+        except httpx.HTTPStatusError:
+            pass
+        else:
+            raise AssertionError("重试次数用完后应该抛出最后一次的异常")
+        assert len(calls) == RetryPolicy().max_attempts, calls
+
+    async def check_fatal():
+        request, calls = mock_request(httpx.Response(200, json={"error_code": 216201}))
+        breaker = CircuitBreaker(failure_threshold=1)
+        try:
+            await call(request, breaker=breaker)
+        except OCRAPIError as e:
+            assert e.error_code == 216201
+        else:
+            raise AssertionError("无法重试的错误应该直接抛出")
+        assert len(calls) == 1, calls
+        assert breaker.state == "closed", breaker.state
+
+    async def check_token():
+        request, calls = mock_request(httpx.Response(200, json={"error_code": 111}), 0)
+        refreshed = []
+
+        async def on_token_error():
+            refreshed.append(True)
+
+        breaker = CircuitBreaker(failure_threshold=1)
+        await call(request, breaker=breaker, on_token_error=on_token_error)
+        assert len(calls) == 2 and len(refreshed) == 1, (calls, refreshed)
+        assert breaker.state == "closed", breaker.state
+
+    async def check_breaker():
+        breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=0.2)
+        policy = RetryPolicy(max_attempts=1)
+        request, calls = mock_request(httpx.Response(500))
+        for _ in range(3):
+            try:
+                await call(request, breaker=breaker, policy=policy)
+            except httpx.HTTPStatusError:
+                pass
+        assert breaker.state == "open", breaker.state
+
+        try:
+            await call(request, breaker=breaker, policy=policy)
+        except CircuitOpenError:
+            pass
+        else:
+            raise AssertionError("熔断器打开后应该直接拒绝请求")
+        assert len(calls) == 3, calls
+
+        await asyncio.sleep(0.25)
+        request, calls = mock_request(0)
+        await call(request, breaker=breaker, policy=policy)
+        assert len(calls) == 1 and breaker.state == "closed", (calls, breaker.state)
+
+    async def check_hedge():
+        request, calls = mock_request(2, 0)
+        metrics = AttemptMetrics()
+        start_time = time.monotonic()
+        result = await call(request, metrics=metrics, hedge_delay=0.05)
+        assert result == {"words_result": {"call": 1}}, result
+        assert time.monotonic() - start_time < 1, "对冲请求没有取先返回的结果"
+        assert metrics.counters["hedge"] == 1, metrics.snapshot()
+
+    async def check_load():
+        random.seed(0)
+        calls = []
+
+        def mock_ocr(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            roll = random.random()
+            if roll < 0.15:
+                return httpx.Response(500)
+            if roll < 0.3:
+                return httpx.Response(200, json={"error_code": 18})
+            if roll < 0.35:
+                return httpx.Response(200, json={"error_code": 111})
+            return httpx.Response(200, json={"words_result": {}})
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(mock_ocr)) as client:
+
+            async def request() -> dict:
+                response = await client.post("https://mock/ocr")
+                response.raise_for_status()
+                result = response.json()
+                if "error_code" in result:
+                    raise OCRAPIError(result["error_code"])
+                return result
+
+            metrics = AttemptMetrics()
+            breaker = CircuitBreaker(failure_threshold=20)
+            results = await asyncio.gather(
+                *(
+                    call(
+                        request,
+                        breaker=breaker,
+                        metrics=metrics,
+                        limiter=AsyncLimiter(50, 1),
+                    )
+                    for _ in range(200)
+                ),
+                return_exceptions=True,
+            )
+
+        failed = sum(isinstance(result, Exception) for result in results)
+        # 单次失败率 35%，最多尝试 4 次，最终失败的比例应该在 2% 左右
+        assert failed <= 10, f"200 个请求，最终失败 {failed} 个"
+        assert metrics.snapshot()["attempts"] == len(calls), metrics.snapshot()
+
+    async def main() -> int:
+        failed = 0
+        for check in (
+            check_retry,
+            check_retry_exhausted,
+            check_fatal,
+            check_token,
+            check_breaker,
+            check_hedge,
+            check_load,
+        ):
+            try:
+                await check()
+            except AssertionError as e:
+                failed += 1
+                print(f"FAIL {check.__name__}: {e}")
+            else:
+                print(f"ok   {check.__name__}")
+        return failed
+
+    sys.exit(1 if asyncio.run(main()) else 0)
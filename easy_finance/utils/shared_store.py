@@ -0,0 +1,235 @@
+import asyncio
+import functools
+import math
+import time
+from collections import defaultdict
+from typing import AsyncGenerator
+
+from ..settings import settings
+from .log import logger
+
+# 配置了 Redis 时，多个后端进程通过 Redis 共享状态、限流和缓存，可以部署在负载均衡后面；
+# 没有配置时使用进程内的 LocalStore，只适合单个后端进程
+KEY_PREFIX = "easy_finance:"  # 所有 key 的前缀，和 reflex 保存 state 的 key 区分开
+SUBSCRIBER_QUEUE_SIZE = 1000  # LocalStore 每个订阅者最多积压的消息数量
+LOCAL_PURGE_INTERVAL = 60.0  # LocalStore 清理过期 key 的间隔（秒）
+
+
+class SharedStore:
+    """多个后端进程共享的键值存储和消息频道，值和消息统一是 bytes
+
+    默认实现是 LocalStore（进程内），配置 REDIS_URL 后使用 RedisStore
+    """
+
+    async def get(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        """写入一个值，ttl 秒后过期，None 表示不过期"""
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def take_token(self, key: str, rate: float, capacity: float) -> float:
+        """从令牌桶里取出一个令牌
+
+        Args:
+            key (str): 令牌桶的 key
+            rate (float): 每秒放入的令牌数量
+            capacity (float): 桶的容量，也就是允许的突发请求数量
+
+        Returns:
+            float: 0 表示取到了令牌；大于 0 表示没有令牌，需要等待的秒数
+        """
+        raise NotImplementedError
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        """向频道发布一条消息，所有进程里订阅了这个频道的订阅者都会收到"""
+        raise NotImplementedError
+
+    def subscribe(self, channel: str) -> AsyncGenerator[bytes | None, None]:
+        """订阅频道，返回消息的异步迭代器，迭代器关闭时取消订阅
+
+        订阅者处理得太慢、积压的消息被丢弃时，迭代器返回 None，订阅者需要重新加载全部数据
+        """
+        raise NotImplementedError
+
+
+class LocalStore(SharedStore):
+    """进程内的 SharedStore，用于单个后端进程和测试"""
+
+    def __init__(self):
+        self._values: dict[str, tuple[bytes, float]] = {}  # key → (值, 过期时间)
+        self._buckets: dict[str, tuple[float, float]] = {}  # key → (令牌数, 更新时间)
+        # 频道 → 订阅者的消息队列
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        self._next_purge = time.monotonic() + LOCAL_PURGE_INTERVAL
+
+    def _purge_expired(self, now: float) -> None:
+        """删除所有已经过期的 key，过期后不再读取的 key 也不会一直占用内存"""
+        expired = [
+            key for key, (_, expires_at) in self._values.items() if now >= expires_at
+        ]
+        for key in expired:
+            del self._values[key]
+        self._next_purge = now + LOCAL_PURGE_INTERVAL
+
+    async def get(self, key: str) -> bytes | None:
+        value, expires_at = self._values.get(key, (None, math.inf))
+        if value is not None and time.monotonic() >= expires_at:
+            del self._values[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        now = time.monotonic()
+        if now >= self._next_purge:
+            self._purge_expired(now)
+        expires_at = now + ttl if ttl else math.inf
+        self._values[key] = (value, expires_at)
+
+    async def delete(self, key: str) -> None:
+        self._values.pop(key, None)
+
+    async def take_token(self, key: str, rate: float, capacity: float) -> float:
+        # 事件循环是单线程的，这里没有 await，不需要加锁
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        return wait
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        for queue in self._subscribers.get(channel, ()):
+            if queue.full():
+                # 订阅者处理不过来，丢弃积压的消息，用 None 通知它重新加载
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(message)
+
+    async def subscribe(self, channel: str) -> AsyncGenerator[bytes | None, None]:
+        queue: asyncio.Queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[channel].add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[channel].discard(queue)
+
+
+class RedisStore(SharedStore):
+    """基于 Redis 的 SharedStore，令牌桶用 Lua 脚本在 Redis 里原子地完成"""
+
+    # 使用 Redis 服务器的时间，各个后端进程的时钟不一致也不会影响限流
+    TOKEN_BUCKET_SCRIPT = """
+    local now_parts = redis.call('TIME')
+    local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self._token_bucket = self.client.register_script(self.TOKEN_BUCKET_SCRIPT)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(KEY_PREFIX + key)
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        await self.client.set(
+            KEY_PREFIX + key, value, px=int(ttl * 1000) if ttl else None
+        )
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(KEY_PREFIX + key)
+
+    async def take_token(self, key: str, rate: float, capacity: float) -> float:
+        wait = await self._token_bucket(keys=[KEY_PREFIX + key], args=[rate, capacity])
+        return float(wait)
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        await self.client.publish(KEY_PREFIX + channel, message)
+
+    async def subscribe(self, channel: str) -> AsyncGenerator[bytes | None, None]:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(KEY_PREFIX + channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+
+@functools.cache
+def get_shared_store() -> SharedStore:
+    if settings.redis_url:
+        logger.info("使用 Redis 共享限流和缓存")
+        return RedisStore(settings.redis_url)
+    return LocalStore()
+
+
+class SharedRateLimiter:
+    """基于 SharedStore 令牌桶的限流器，所有后端进程共用同一个桶，总 QPS 不会超过 rate
+
+    用法和 aiolimiter.AsyncLimiter 相同：async with limiter: ...
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        capacity: float | None = None,
+        store: SharedStore | None = None,
+    ):
+        self.key = f"rate_limit:{name}"
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)  # 默认允许一秒的突发请求
+        self._store = store
+        self._next_free = 0.0  # 上次没有取到令牌时，预计下一个令牌的时间
+
+    @property
+    def store(self) -> SharedStore:
+        return self._store or get_shared_store()
+
+    def has_capacity(self) -> bool:
+        """根据上次取令牌的结果估计现在是否有令牌，不访问共享存储，用于路由时的排序"""
+        return time.monotonic() >= self._next_free
+
+    async def acquire(self) -> None:
+        while True:
+            wait = await self.store.take_token(self.key, self.rate, self.capacity)
+            if wait <= 0:
+                return
+            self._next_free = time.monotonic() + wait
+            await asyncio.sleep(wait)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
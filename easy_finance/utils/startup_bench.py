@@ -0,0 +1,162 @@
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+
+from ..settings import settings
+
+"""
+启动耗时测试
+
+用 python -X importtime 在子进程里导入应用，统计导入耗时最多的模块，并检查只在使用时才需要的
+重型依赖（polars、xlsxwriter 等）有没有在启动时被导入，以及导入时有没有创建文件（jobs.db、
+日志文件等应该在第一次使用时才创建）。耗时超过上限、重型依赖被提前导入或者导入时创建了文件时
+以非 0 状态码退出，可以直接放进 CI：
+
+    python -m easy_finance.utils.startup_bench --budget-ms 4000
+"""
+
+APP_MODULE = "easy_finance.easy_finance"
+# 只在导出、对账、导入对账单时才需要的依赖，启动时不应该导入
+LAZY_MODULES = ("polars", "xlsxwriter", "openpyxl")
+
+# -X importtime 的输出格式：import time:       self [us] |  cumulative | imported package
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+@dataclass
+class ImportTiming:
+    module: str
+    self_us: int  # 只计算这个模块本身的耗时（微秒）
+    cumulative_us: int  # 包括这个模块导入的其他模块的耗时（微秒）
+    depth: int  # 被导入的层级，0 表示由 -c 的代码直接导入
+
+
+def measure_imports(module: str = APP_MODULE) -> list[ImportTiming]:
+    """在新的子进程里导入模块，返回每个模块的导入耗时"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败：\n{completed.stderr[-2000:]}")
+
+    timings = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            timings.append(
+                ImportTiming(
+                    module=name,
+                    self_us=int(self_us),
+                    cumulative_us=int(cumulative_us),
+                    depth=(len(indent) - 1) // 2,
+                )
+            )
+    return timings
+
+
+def total_ms(timings: list[ImportTiming]) -> float:
+    return sum(timing.cumulative_us for timing in timings if timing.depth == 0) / 1000
+
+
+def eager_lazy_modules(timings: list[ImportTiming]) -> list[str]:
+    """启动时被导入的重型依赖"""
+    return sorted(
+        {
+            timing.module.split(".")[0]
+            for timing in timings
+            if timing.module.split(".")[0] in LAZY_MODULES
+        }
+    )
+
+
+def created_files(module: str = APP_MODULE) -> list[str]:
+    """在空的临时目录里导入模块，返回导入时在工作目录下创建的文件"""
+    with tempfile.TemporaryDirectory() as directory:
+        workdir = Path(directory)
+        shutil.copy("rxconfig.py", workdir)
+        env = {**os.environ, "PYTHONPATH": os.getcwd()}
+        completed = subprocess.run(
+            [sys.executable, "-c", f"import {module}"],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"导入 {module} 失败：\n{completed.stderr[-2000:]}")
+        return sorted(
+            str(path.relative_to(workdir))
+            for path in workdir.rglob("*")
+            if path.is_file()
+            and path.name != "rxconfig.py"
+            and "__pycache__" not in path.parts
+        )
+
+
+def run_benchmark(
+    module: str = APP_MODULE,
+    budget_ms: float = settings.startup_import_budget_ms,
+    repeat: int = 3,
+    top: int = 15,
+) -> bool:
+    """
+    多次测量导入耗时，取最快的一次（第一次可能需要编译 .pyc），打印耗时最多的模块
+
+    Returns:
+        bool: 是否在耗时上限以内，没有提前导入重型依赖，并且导入时没有创建文件
+    """
+    timings = min(
+        (measure_imports(module) for _ in range(repeat)),
+        key=total_ms,
+    )
+    elapsed = total_ms(timings)
+
+    print(f"导入 {module} 用时 {elapsed:.0f} ms（上限 {budget_ms:.0f} ms）")
+    print("耗时最多的包（包括它导入的其他模块）：")
+    top_level = sorted(
+        (timing for timing in timings if "." not in timing.module),
+        key=lambda timing: timing.cumulative_us,
+        reverse=True,
+    )
+    for timing in top_level[:top]:
+        print(f"  {timing.cumulative_us / 1000:8.1f} ms  {timing.module}")
+
+    passed = elapsed <= budget_ms
+    if not passed:
+        print(f"启动耗时超过上限 {budget_ms:.0f} ms")
+    eager = eager_lazy_modules(timings)
+    if eager:
+        print(f"这些依赖应该在使用时才导入：{', '.join(eager)}")
+        passed = False
+    created = created_files(module)
+    if created:
+        print(f"导入时不应该创建文件：{', '.join(created)}")
+        passed = False
+    return passed
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.startup_bench，需要在项目根目录（rxconfig.py 所在目录）运行
+    parser = argparse.ArgumentParser(description="测量应用启动时导入模块的耗时")
+    parser.add_argument("--module", default=APP_MODULE, help="导入的模块")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=settings.startup_import_budget_ms,
+        help="导入耗时的上限（毫秒）",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="测量次数，取最快的一次")
+    parser.add_argument("--top", type=int, default=15, help="打印耗时最多的模块数量")
+    args = parser.parse_args()
+    sys.exit(
+        0 if run_benchmark(args.module, args.budget_ms, args.repeat, args.top) else 1
+    )
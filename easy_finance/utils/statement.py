@@ -0,0 +1,332 @@
+import codecs
+import csv
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date, datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
+
+from sqlalchemy import insert
+
+from .. import db
+from ..models import JournalAccount, bump_table_version
+from .archive import select_journal
+from .categorize import apply_rules
+from .counterparty import assign_counterparty_ids
+from .dedup import record_fingerprint
+from .log import logger
+
+if TYPE_CHECKING:
+    import polars as pl
+
+# polars 导入较慢，页面只需要 BANK_PROFILES，所以 polars 和 .batch 在导入对账单时才导入
+
+STATEMENT_EXTENSIONS = (".csv", ".xlsx")  # 支持导入的对账单格式
+INSERT_CHUNK_SIZE = 5000  # 每次批量插入的行数
+
+# 判断重复流水时比较的字段
+DEDUP_KEY = ["trade_date", "amount", "payer", "receiver"]
+
+
+@dataclass(frozen=True)
+class BankProfile:
+    """一家银行导出的对账单的格式，也就是对账单的列名和 JournalAccount 字段的对应关系
+
+    金额有两种写法：
+    1. 只有一列金额，收入是正数，支出是负数，使用 amount_column
+    2. 收入和支出分成两列，使用 income_column 和 expense_column
+    """
+
+    name: str  # 显示给用户的名称
+    date_column: str  # 交易日期
+    counterparty_column: str  # 对方户名
+    amount_column: str = ""  # 带正负号的金额
+    income_column: str = ""  # 收入金额（贷方）
+    expense_column: str = ""  # 支出金额（借方）
+    description_column: str = ""  # 摘要或用途
+    skip_rows: int = 0  # 表头前面需要跳过的行数（例如账户信息）
+
+
+# 不同银行导出的对账单格式，列名以实际导出的文件为准，可以按需增加或修改
+BANK_PROFILES: dict[str, BankProfile] = {
+    "generic": BankProfile(
+        name="通用模板",
+        date_column="交易日期",
+        counterparty_column="对方户名",
+        income_column="收入金额",
+        expense_column="支出金额",
+        description_column="摘要",
+    ),
+    "icbc": BankProfile(
+        name="工商银行",
+        date_column="交易时间",
+        counterparty_column="对方单位",
+        income_column="贷方发生额",
+        expense_column="借方发生额",
+        description_column="摘要",
+    ),
+    "ccb": BankProfile(
+        name="建设银行",
+        date_column="交易时间",
+        counterparty_column="对方户名",
+        income_column="贷方发生额（收入）",
+        expense_column="借方发生额（支取）",
+        description_column="摘要",
+    ),
+    "cmb": BankProfile(
+        name="招商银行",
+        date_column="交易日",
+        counterparty_column="收(付)方名称",
+        income_column="贷方金额",
+        expense_column="借方金额",
+        description_column="摘要",
+    ),
+    "alipay": BankProfile(
+        name="支付宝",
+        date_column="入账时间",
+        counterparty_column="对方名称",
+        income_column="收入（+元）",
+        expense_column="支出（-元）",
+        description_column="备注",
+    ),
+}
+
+
+@dataclass
+class ImportResult:
+    """一次导入的统计结果"""
+
+    total: int = 0  # 对账单里的交易数量
+    invalid: int = 0  # 缺少日期、金额或对方户名，无法导入的数量
+    duplicated: int = 0  # 数据库里已经存在的数量
+    inserted: int = 0  # 成功导入的数量
+
+
+@contextmanager
+def as_utf8_csv(path: Path) -> Iterator[Path]:
+    """把对账单转化为 polars 可以流式读取的 utf-8 csv 文件
+
+    1. utf-8 编码的 csv 直接使用
+    2. 其他编码的 csv（国内银行一般是 GBK）逐行转码到临时文件
+    3. xlsx 用 openpyxl 的只读模式逐行写入临时文件
+
+    Args:
+        path (Path): 对账单文件
+
+    Yields:
+        Path: utf-8 编码的 csv 文件
+    """
+    suffix = path.suffix.lower()
+    if suffix not in STATEMENT_EXTENSIONS:
+        raise TypeError(f"不支持的对账单格式：{suffix}")
+
+    if suffix == ".csv":
+        with path.open("rb") as file_object:
+            head = file_object.read(64 * 1024)
+        try:
+            # 截断的位置可能刚好在一个多字节字符中间，用增量解码器忽略末尾不完整的字符
+            codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        except UnicodeDecodeError:
+            pass
+        else:
+            yield path
+            return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_csv = Path(temp_dir) / "statement.csv"
+        with temp_csv.open("w", newline="", encoding="utf-8") as output:
+            if suffix == ".csv":
+                with path.open("r", newline="", encoding="gb18030") as source:
+                    for line in source:
+                        output.write(line)
+            else:
+                from openpyxl import load_workbook
+
+                workbook = load_workbook(path, read_only=True, data_only=True)
+                writer = csv.writer(output)
+                for row in workbook.active.iter_rows(values_only=True):
+                    writer.writerow(
+                        [
+                            (
+                                value.strftime("%Y-%m-%d")
+                                if isinstance(value, (date, datetime))
+                                else value
+                            )
+                            for value in row
+                        ]
+                    )
+                workbook.close()
+        yield temp_csv
+
+
+def scan_statement(
+    source: Path, profile: BankProfile, account_name: str
+) -> "pl.LazyFrame":
+    """按银行的格式读取对账单，整理成 JournalAccount 的字段
+
+    Args:
+        source (Path): utf-8 编码的 csv 文件
+        profile (BankProfile): 对账单的格式
+        account_name (str): 对账单所属账户的户名，收入时是收款方，支出时是付款方
+
+    Returns:
+        pl.LazyFrame: 包含 trade_date、amount、payer、receiver、description、error 列
+    """
+    import polars as pl
+
+    from .batch import (
+        normalize_text,
+        parse_amount_expr,
+        parse_date_expr,
+        validate_exprs,
+    )
+
+    lf = pl.scan_csv(
+        source,
+        skip_rows=profile.skip_rows,
+        infer_schema=False,  # 所有列都按字符串读取，由下面的表达式负责转化
+        truncate_ragged_lines=True,
+    ).rename(lambda column: column.strip())
+
+    if profile.amount_column:
+        raw_amount = normalize_text(pl.col(profile.amount_column))
+        is_income = ~raw_amount.str.starts_with("-").fill_null(False)
+        amount = parse_amount_expr(raw_amount)
+    else:
+        income = parse_amount_expr(normalize_text(pl.col(profile.income_column)))
+        expense = parse_amount_expr(normalize_text(pl.col(profile.expense_column)))
+        is_income = income.fill_null(0) > 0
+        amount = pl.when(is_income).then(income).otherwise(expense)
+
+    counterparty = normalize_text(pl.col(profile.counterparty_column))
+    description = (
+        normalize_text(pl.col(profile.description_column)).fill_null("")
+        if profile.description_column
+        else pl.lit("")
+    )
+
+    return (
+        lf.select(
+            trade_date=parse_date_expr(normalize_text(pl.col(profile.date_column))),
+            amount=amount,
+            payer=pl.when(is_income).then(counterparty).otherwise(pl.lit(account_name)),
+            receiver=pl.when(is_income)
+            .then(pl.lit(account_name))
+            .otherwise(counterparty),
+            description=description,
+        )
+        # 金额为 0 的行一般是对账单末尾的合计或者余额调整，不是真实的交易
+        .filter(pl.col("amount").is_null() | (pl.col("amount") > 0)).with_columns(
+            validate_exprs(DEDUP_KEY)
+        )
+    )
+
+
+def with_occurrence(df: "pl.DataFrame") -> "pl.DataFrame":
+    """给相同 DEDUP_KEY 的行编号，同一天和同一个对象的多笔相同金额的交易不会被当成重复"""
+    import polars as pl
+
+    return df.with_columns(occurrence=pl.int_range(pl.len()).over(DEDUP_KEY))
+
+
+def load_existing_keys(start_date: date, end_date: date) -> "pl.DataFrame":
+    """读取数据库里日期范围内已有流水的 DEDUP_KEY，金额用和对账单相同的规则转化，
+    日期范围包含已经归档的年度时会同时查询归档表"""
+    import polars as pl
+
+    from .batch import parse_amount_expr
+
+    with db.session() as session:
+        rows = session.execute(select_journal(DEDUP_KEY, start_date, end_date)).all()
+
+    return pl.DataFrame(
+        [tuple(row) for row in rows],
+        schema={
+            "trade_date": pl.Date,
+            "amount": pl.String,
+            "payer": pl.String,
+            "receiver": pl.String,
+        },
+        orient="row",
+    ).with_columns(parse_amount_expr(pl.col("amount")))
+
+
+def import_statement(
+    path: Path, profile: BankProfile, account_name: str
+) -> ImportResult:
+    """导入银行对账单：
+    1. 用 polars 流式读取和整理对账单
+    2. 和数据库里日期范围内的流水比较，去掉已经存在的交易（重复导入同一个对账单不会产生重复数据）
+    3. 分批插入数据库
+
+    Args:
+        path (Path): 对账单文件，csv 或 xlsx
+        profile (BankProfile): 对账单的格式
+        account_name (str): 对账单所属账户的户名
+
+    Returns:
+        ImportResult: 导入结果
+    """
+    import polars as pl
+
+    start_time = time.time()
+    result = ImportResult()
+
+    with as_utf8_csv(path) as source:
+        try:
+            df = scan_statement(source, profile, account_name).collect(streaming=True)
+        except pl.exceptions.ColumnNotFoundError as e:
+            # polars 的报错信息里还有完整的执行计划，只保留第一行
+            missing_column = str(e).splitlines()[0]
+            raise ValueError(
+                f"对账单里没有「{profile.name}」格式需要的列：{missing_column}"
+            ) from e
+
+    result.total = len(df)
+    valid = df.filter(pl.col("error").is_null()).drop("error")
+    result.invalid = result.total - len(valid)
+    if valid.is_empty():
+        return result
+
+    existing = load_existing_keys(valid["trade_date"].min(), valid["trade_date"].max())  # type: ignore
+    new_rows = with_occurrence(valid).join(
+        with_occurrence(existing),
+        on=[*DEDUP_KEY, "occurrence"],
+        how="anti",
+        join_nulls=True,
+    )
+    result.duplicated = len(valid) - len(new_rows)
+
+    created_datetime = datetime.now()
+    records = apply_rules(
+        assign_counterparty_ids(
+            new_rows.drop("occurrence")
+            .with_columns(pl.col("amount").cast(pl.String))
+            .to_dicts()
+        )
+    )
+    if records:
+        with db.session() as session:
+            for start in range(0, len(records), INSERT_CHUNK_SIZE):
+                session.execute(
+                    insert(JournalAccount),
+                    [
+                        {
+                            **record,
+                            "fingerprint": record_fingerprint(record),
+                            "created_datetime": created_datetime,
+                        }
+                        for record in records[start : start + INSERT_CHUNK_SIZE]
+                    ],
+                )
+            bump_table_version(session, JournalAccount.__tablename__)  # type:ignore
+            session.commit()
+    result.inserted = len(records)
+
+    logger.info(
+        f"导入对账单「{path.name}」，用时：{time.time() - start_time:.2f}s",
+        extra={"profile": profile.name, **result.__dict__},
+    )
+    return result
@@ -0,0 +1,431 @@
+import asyncio
+import gzip
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import reflex as rx
+from sqlalchemy import delete, update
+from sqlmodel import Session, select
+
+from .. import db
+from ..models import StoredFile, TaxInvoice
+from ..settings import settings
+from .archive import journal_partitions
+from .export import EXPORT_DIR_NAME
+from .job_queue import job_queue
+from .log import logger
+from .request_api import get_file_url
+
+"""
+上传目录的清理和容量管理
+
+识别失败的文件、用户没有点击"上传数据"的文件也会保存在上传目录里，时间长了会占用大量磁盘空间。
+这里定期清理上传目录：
+
+1. 扫描上传目录，把新文件登记到 StoredFile 表，记录登记时的文件链接
+2. 超过 STORAGE_GRACE_DAYS 还没有确认被引用的文件，每 LOOKUP_BATCH_SIZE 个一批，
+   按链接到流水（包括归档表）和发票的 url 索引里查找，不需要为每个文件扫描整张表
+3. 被引用的文件标记为 referenced，以后不再检查；没有被引用的文件压缩后移到回收站，
+   在回收站保留 STORAGE_TRASH_DAYS 天后删除，误删的文件可以用 restore_file 恢复
+4. 删除 exports 子文件夹里超过 STORAGE_EXPORT_DAYS 没有使用的导出文件，导出文件不登记到 StoredFile 表
+5. 统计上传目录和回收站占用的空间，达到 STORAGE_QUOTA_BYTES 的 STORAGE_ALERT_RATIO 时在日志里报警，
+   超过容量后拒绝新上传的文件
+
+没有上传完的分片由 chunked_upload 在开始新的上传时删除过期的部分，这里只统计占用的空间。
+后端有多个 worker 进程时，通过任务队列数据库（jobs.db）里的租约保证同一时间只有一个进程定期清理，
+租约只能协调同一台机器上的进程，每台机器有自己的上传目录，各自清理
+"""
+
+LOOKUP_BATCH_SIZE = 500  # 每次查询引用的文件数量
+TRASH_SUFFIX = ".gz"
+REFERENCE_COLUMNS = ("bank_slip_url", "tax_invoice_url")  # 流水表里引用文件的字段
+SWEEP_LEASE_NAME = "storage-sweep"  # 定期清理的租约，同一时间只有一个进程清理
+ALERT_INTERVAL = 3600  # 容量报警的最短间隔（秒）
+
+
+class StorageQuotaError(Exception):
+    """上传目录和回收站占用的空间超过了 STORAGE_QUOTA_BYTES"""
+
+
+@dataclass
+class SweepResult:
+    discovered: int = 0  # 新登记的文件数量
+    referenced: int = 0  # 这次确认被引用的文件数量
+    trashed: int = 0  # 压缩后移到回收站的文件数量
+    deleted: int = 0  # 删除的文件数量，包括回收站里过期的文件
+    freed_bytes: int = 0  # 释放的空间（字节）
+    usage_bytes: int = 0  # 清理后上传目录和回收站占用的空间（字节）
+
+
+def directory_size(path: Path) -> int:
+    """文件夹里所有文件的大小之和，包括子文件夹"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def referenced_urls(session: Session, urls: list[str]) -> set[str]:
+    """在流水（包括归档表）和发票的 url 索引里查找被引用的链接"""
+    found: set[str] = set()
+    for table in journal_partitions():
+        for column in REFERENCE_COLUMNS:
+            if column in table.c:
+                found.update(
+                    session.exec(
+                        select(table.c[column]).where(table.c[column].in_(urls))
+                    ).all()
+                )
+    found.update(
+        session.exec(
+            select(TaxInvoice.file_url).where(
+                TaxInvoice.file_url.in_(urls)  # type:ignore
+            )
+        ).all()
+    )
+    return found
+
+
+def referenced_names(session: Session) -> set[str]:
+    """从所有流水和发票的链接里取出文件名
+
+    只在第一次清理时执行一次：以前的文件在登记前可能换过后端地址，链接和 get_file_url 的结果不同，
+    按文件名判断是否被引用
+    """
+    names: set[str] = set()
+    columns = [
+        table.c[column]
+        for table in journal_partitions()
+        for column in REFERENCE_COLUMNS
+        if column in table.c
+    ]
+    columns.append(TaxInvoice.file_url)
+    for column in columns:
+        for url in session.exec(select(column).where(column != "")):
+            names.add(url.rsplit("/", 1)[-1])
+    return names
+
+
+class StorageManager:
+    def __init__(
+        self,
+        upload_dir: Path | None = None,
+        trash_dir: Path | None = None,
+        grace_days: float = settings.storage_grace_days,
+        trash_days: float = settings.storage_trash_days,
+        quota_bytes: int = settings.storage_quota_bytes,
+        alert_ratio: float = settings.storage_alert_ratio,
+        sweep_interval: float = settings.storage_sweep_interval,
+        export_days: float = settings.storage_export_days,
+    ):
+        self._upload_dir = upload_dir
+        self._trash_dir = trash_dir
+        self.grace_days = grace_days
+        self.trash_days = trash_days
+        self.quota_bytes = quota_bytes
+        self.alert_ratio = alert_ratio
+        self.sweep_interval = sweep_interval
+        self.export_days = export_days
+        # 上传目录和回收站占用的空间，每次清理时重新统计，两次清理之间按新上传的文件累加
+        self.usage_bytes: int | None = None
+        self._last_alert = 0.0
+
+    @property
+    def upload_dir(self) -> Path:
+        return self._upload_dir or rx.get_upload_dir()
+
+    @property
+    def trash_dir(self) -> Path:
+        if self._trash_dir is None:
+            self._trash_dir = (
+                Path(settings.storage_trash_dir)
+                if settings.storage_trash_dir
+                else self.upload_dir.parent / "uploaded_files_trash"
+            )
+        return self._trash_dir
+
+    def measure_usage(self) -> int:
+        self.usage_bytes = directory_size(self.upload_dir) + directory_size(
+            self.trash_dir
+        )
+        return self.usage_bytes
+
+    def _check_alert(self) -> None:
+        if not self.quota_bytes or self.usage_bytes is None:
+            return
+        ratio = self.usage_bytes / self.quota_bytes
+        if ratio < self.alert_ratio or time.time() - self._last_alert < ALERT_INTERVAL:
+            return
+        self._last_alert = time.time()
+        logger.error(
+            f"上传文件占用的空间达到容量的 {ratio:.0%}",
+            extra={"usage_bytes": self.usage_bytes, "quota_bytes": self.quota_bytes},
+        )
+
+    def reserve(self, size: int) -> None:
+        """保存新文件之前检查容量，超过容量时抛出 StorageQuotaError
+
+        Args:
+            size (int): 新文件的大小（字节）
+        """
+        if not self.quota_bytes:
+            return
+        usage = self.measure_usage() if self.usage_bytes is None else self.usage_bytes
+        if usage + size > self.quota_bytes:
+            self._check_alert()
+            raise StorageQuotaError(
+                f"上传文件占用的空间已经达到 {self.quota_bytes // 1024 // 1024}mb 的上限，"
+                "请联系管理员清理"
+            )
+        self.usage_bytes = usage + size
+        self._check_alert()
+
+    def discover(self, result: SweepResult) -> None:
+        """把上传目录里还没有登记的文件登记到 StoredFile 表"""
+        entries: dict[str, os.stat_result] = {}
+        with os.scandir(self.upload_dir) as iterator:
+            for entry in iterator:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                try:
+                    entries[entry.name] = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+        with db.session() as session:
+            first_sweep = session.exec(select(StoredFile.id).limit(1)).first() is None
+            legacy_names = (
+                referenced_names(session) if first_sweep and entries else set()
+            )
+            names = list(entries)
+            for start in range(0, len(names), LOOKUP_BATCH_SIZE):
+                batch = names[start : start + LOOKUP_BATCH_SIZE]
+                known = set(
+                    session.exec(
+                        select(StoredFile.name).where(
+                            StoredFile.name.in_(batch)  # type:ignore
+                        )
+                    ).all()
+                )
+                for name in batch:
+                    if name in known:
+                        continue
+                    stat = entries[name]
+                    session.add(
+                        StoredFile(
+                            name=name,
+                            url=get_file_url(name),
+                            size=stat.st_size,
+                            referenced=name in legacy_names,
+                            created_datetime=datetime.fromtimestamp(stat.st_mtime),
+                        )
+                    )
+                    result.discovered += 1
+                session.commit()
+
+    def _trash(self, stored_file: StoredFile) -> int:
+        """把没有被引用的文件压缩后移到回收站，不使用回收站时直接删除
+
+        Returns:
+            int: 释放的空间（字节）
+        """
+        source = self.upload_dir / stored_file.name
+        try:
+            if self.trash_days <= 0:
+                size = source.stat().st_size
+                source.unlink()
+                return size
+            self.trash_dir.mkdir(parents=True, exist_ok=True)
+            target = self.trash_dir / f"{stored_file.name}{TRASH_SUFFIX}"
+            with (
+                source.open("rb") as source_file,
+                gzip.open(target, "wb") as target_file,
+            ):
+                shutil.copyfileobj(source_file, target_file)
+            size = source.stat().st_size
+            source.unlink()
+            return size - target.stat().st_size
+        except FileNotFoundError:  # 文件已经被手动删除，或者被另一个进程处理过
+            return 0
+
+    def collect(self, result: SweepResult, now: datetime) -> None:
+        """检查超过保留期限、还没有确认被引用的文件，没有被引用的移到回收站"""
+        cutoff = now - timedelta(days=self.grace_days)
+        last_id = 0
+        with db.session() as session:
+            while True:
+                stored_files = session.exec(
+                    select(StoredFile)
+                    .where(
+                        StoredFile.referenced == False,  # noqa: E712
+                        StoredFile.trashed_datetime == None,  # noqa: E711
+                        StoredFile.created_datetime < cutoff,
+                        StoredFile.id > last_id,  # type:ignore
+                    )
+                    .order_by(StoredFile.id)  # type:ignore
+                    .limit(LOOKUP_BATCH_SIZE)
+                ).all()
+                if not stored_files:
+                    return
+                last_id = stored_files[-1].id  # type:ignore
+
+                found = referenced_urls(
+                    session, [stored_file.url for stored_file in stored_files]
+                )
+                referenced_ids = []
+                trashed_ids = []
+                deleted_ids = []
+                for stored_file in stored_files:
+                    if stored_file.url in found:
+                        referenced_ids.append(stored_file.id)
+                        continue
+                    result.freed_bytes += self._trash(stored_file)
+                    if self.trash_days <= 0:
+                        deleted_ids.append(stored_file.id)
+                    else:
+                        trashed_ids.append(stored_file.id)
+
+                # 用批量更新，另一个进程同时修改了同一行时不会报错
+                if referenced_ids:
+                    session.execute(
+                        update(StoredFile)
+                        .where(StoredFile.id.in_(referenced_ids))  # type:ignore
+                        .values(referenced=True)
+                    )
+                if trashed_ids:
+                    session.execute(
+                        update(StoredFile)
+                        .where(StoredFile.id.in_(trashed_ids))  # type:ignore
+                        .values(trashed_datetime=now)
+                    )
+                if deleted_ids:
+                    session.execute(
+                        delete(StoredFile).where(
+                            StoredFile.id.in_(deleted_ids)  # type:ignore
+                        )
+                    )
+                session.commit()
+                result.referenced += len(referenced_ids)
+                result.trashed += len(trashed_ids)
+                result.deleted += len(deleted_ids)
+
+    def purge(self, result: SweepResult, now: datetime) -> None:
+        """删除在回收站里超过 STORAGE_TRASH_DAYS 的文件"""
+        cutoff = now - timedelta(days=self.trash_days)
+        with db.session() as session:
+            while True:
+                stored_files = session.exec(
+                    select(StoredFile)
+                    .where(StoredFile.trashed_datetime < cutoff)  # type:ignore
+                    .limit(LOOKUP_BATCH_SIZE)
+                ).all()
+                if not stored_files:
+                    return
+                for stored_file in stored_files:
+                    target = self.trash_dir / f"{stored_file.name}{TRASH_SUFFIX}"
+                    try:
+                        result.freed_bytes += target.stat().st_size
+                        target.unlink()
+                    except FileNotFoundError:
+                        pass
+                session.execute(
+                    delete(StoredFile).where(
+                        StoredFile.id.in_(  # type:ignore
+                            [stored_file.id for stored_file in stored_files]
+                        )
+                    )
+                )
+                session.commit()
+                result.deleted += len(stored_files)
+
+    def prune_exports(self, result: SweepResult, now: datetime) -> None:
+        """删除超过 STORAGE_EXPORT_DAYS 没有使用的导出文件，包括导出中断时留下的临时文件"""
+        export_dir = self.upload_dir / EXPORT_DIR_NAME
+        if not export_dir.is_dir():
+            return
+        cutoff = (now - timedelta(days=self.export_days)).timestamp()
+        for path in export_dir.iterdir():
+            try:
+                stat = path.stat()
+                if not path.is_file() or stat.st_mtime >= cutoff:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            result.freed_bytes += stat.st_size
+            result.deleted += 1
+
+    def sweep(self) -> SweepResult:
+        """清理一次上传目录"""
+        start_time = time.time()
+        now = datetime.now()
+        result = SweepResult()
+        self.discover(result)
+        self.collect(result, now)
+        if self.trash_days > 0:
+            self.purge(result, now)
+        self.prune_exports(result, now)
+        result.usage_bytes = self.measure_usage()
+        self._check_alert()
+        logger.info(
+            f"清理上传目录用时：{time.time() - start_time:.2f}s",
+            extra={
+                "discovered": result.discovered,
+                "trashed": result.trashed,
+                "deleted": result.deleted,
+                "freed_bytes": result.freed_bytes,
+                "usage_bytes": result.usage_bytes,
+            },
+        )
+        return result
+
+    def restore_file(self, name: str) -> Path:
+        """把回收站里的文件恢复到上传目录，恢复后不会再被清理
+
+        Args:
+            name (str): 上传目录里的文件名
+
+        Returns:
+            Path: 恢复后的文件路径
+        """
+        source = self.trash_dir / f"{name}{TRASH_SUFFIX}"
+        target = self.upload_dir / name
+        with gzip.open(source, "rb") as source_file, target.open("wb") as target_file:
+            shutil.copyfileobj(source_file, target_file)
+        source.unlink()
+        with db.session() as session:
+            session.execute(
+                update(StoredFile)
+                .where(StoredFile.name == name)  # type:ignore
+                .values(referenced=True, trashed_datetime=None)
+            )
+            session.commit()
+        return target
+
+    async def run(self) -> None:
+        """定期清理上传目录，可以作为 reflex 的 lifespan task 运行，多个进程里只有取得租约的进程清理"""
+        await job_queue.run_exclusive(SWEEP_LEASE_NAME, self._sweep_loop)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"清理上传目录失败：{e}")
+            await asyncio.sleep(self.sweep_interval)
+
+
+storage_manager = StorageManager()
+
+
+if __name__ == "__main__":
+    # 运行方式：python -m easy_finance.utils.storage
+    print(storage_manager.sweep())
@@ -0,0 +1,261 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+from datetime import date
+from pathlib import Path
+
+from ..settings import settings
+from .job_queue import JobQueue, job_queue
+from .log import logger
+from .request_api import generate_random_string, save_upload_file
+from .storage import StorageQuotaError
+
+"""
+扫描文件夹
+
+扫描仪把银行回单保存到一个共享文件夹，这里监听这个文件夹，把新文件提交到后台识别任务队列，
+识别结果保存在 WATCH_BATCH_ID 批次里，用户在 upload 页面点击"导入扫描文件"后移到自己的批次，
+和网页上传的文件一样在表格里检查后入库。
+
+1. Linux 上用 inotify 监听文件夹的变化，其他系统或者 inotify 不可用时定时扫描
+2. 文件的大小和修改时间连续两次扫描都没有变化，并且距离修改时间超过 debounce 秒，才认为文件已经写完
+3. 提交前先把文件移到 .processed 子文件夹，提交失败的再移到 .failed 子文件夹；
+   移动失败的文件不会提交，重启或者下次扫描时不会重复提交
+4. 等待提交的文件最多 QUEUE_SIZE 个，任务队列里还没有识别完的扫描文件最多 max_pending 个，
+   一次放进几千个文件也不会占用过多内存，识别速度由各服务商的限流器控制，不会超过 QPS 配额
+5. 后端有多个 worker 进程、或者同时运行了 easy-finance watch 时，通过任务队列数据库里的租约
+   保证同一时间只有一个进程监听文件夹，不会重复提交同一个文件。租约保存在 jobs.db 里，
+   只能协调同一台机器上的进程，部署在多台机器上时只在一台机器上配置 WATCH_DIR
+"""
+
+WATCH_BATCH_ID = "watch-folder"  # 扫描文件的识别任务所在的批次
+WATCH_LEASE_NAME = "watch-folder"  # 监听文件夹的租约，同一时间只有一个进程监听
+SUPPORTED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".pdf")
+PROCESSED_DIR_NAME = ".processed"
+FAILED_DIR_NAME = ".failed"
+QUEUE_SIZE = 50  # 等待提交的文件数量上限
+# 收到变化通知后等待的时间（秒），大量文件同时写入时合并成一次扫描
+SCAN_COALESCE_DELAY = 0.5
+
+# inotify 的事件类型，见 <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class ChangeNotifier:
+    """定时唤醒扫描，wait 在 timeout 秒后返回"""
+
+    async def wait(self, timeout: float) -> None:
+        await asyncio.sleep(timeout)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyNotifier(ChangeNotifier):
+    """用 inotify 监听文件夹，有文件写入或者移入时立即唤醒扫描
+
+    事件本身不需要解析，收到事件后重新扫描整个文件夹，内核的事件队列溢出也不会漏掉文件
+    """
+
+    def __init__(self, directory: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "inotify_add_watch 失败")
+
+        self._changed = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self) -> None:
+        try:
+            while os.read(self._fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        self._changed.set()
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+        self._changed.clear()
+        await asyncio.sleep(SCAN_COALESCE_DELAY)
+
+    def close(self) -> None:
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+
+
+def create_notifier(directory: Path) -> ChangeNotifier:
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyNotifier(directory)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify 不可用，改为定时扫描：{e}")
+    return ChangeNotifier()
+
+
+def move_to(path: Path, target_dir: Path) -> Path:
+    """把文件移到 target_dir 下按日期命名的子文件夹，重名时在文件名后加随机字符串"""
+    target_dir = target_dir / date.today().isoformat()
+    target_dir.mkdir(parents=True, exist_ok=True)
+    target = target_dir / path.name
+    if target.exists():
+        target = target_dir / f"{path.stem}-{generate_random_string()}{path.suffix}"
+    return path.replace(target)
+
+
+class FolderWatcher:
+    """监听一个文件夹，把写完的文件提交到后台识别任务队列"""
+
+    def __init__(
+        self,
+        directory: Path,
+        mode: str = settings.watch_mode,
+        queue: JobQueue = job_queue,
+        debounce: float = settings.watch_debounce,
+        poll_interval: float = settings.watch_poll_interval,
+        max_pending: int = settings.watch_max_pending,
+    ):
+        self.directory = directory
+        self.mode = mode
+        self.queue = queue
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+        self.submitted = 0
+        # 还没有写完的文件的 (大小, 修改时间)
+        self._observed: dict[Path, tuple[int, int]] = {}
+        self._queued: set[Path] = set()  # 等待提交或者正在提交的文件
+        self._ready: asyncio.Queue[Path] = asyncio.Queue(QUEUE_SIZE)
+
+    def scan(self, now: float) -> list[Path]:
+        """扫描文件夹，返回已经写完、还没有提交的文件"""
+        ready = []
+        observed = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                path = Path(entry.path)
+                if (
+                    entry.name.startswith(".")
+                    or path.suffix.lower() not in SUPPORTED_EXTENSIONS
+                    or path in self._queued
+                    or not entry.is_file()
+                ):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if (
+                    self._observed.get(path) == signature
+                    and now - stat.st_mtime >= self.debounce
+                ):
+                    ready.append(path)
+                else:
+                    observed[path] = signature
+        self._observed = observed
+        return sorted(ready)
+
+    async def _scan_loop(self) -> None:
+        notifier = create_notifier(self.directory)
+        try:
+            while True:
+                ready = await asyncio.to_thread(self.scan, time.time())
+                for path in ready:
+                    self._queued.add(path)
+                    await self._ready.put(path)  # 等待提交的文件达到上限时在这里等待
+                # 还有没写完的文件时，过 debounce 秒再检查一次
+                await notifier.wait(
+                    min(self.debounce, self.poll_interval)
+                    if self._observed
+                    else self.poll_interval
+                )
+        finally:
+            notifier.close()
+
+    async def _wait_for_capacity(self) -> None:
+        """任务队列里还没有识别完的扫描文件达到上限时，等待识别完成后再提交"""
+        while (
+            await self.queue.store.count_unfinished(WATCH_BATCH_ID) >= self.max_pending
+        ):
+            await asyncio.sleep(self.poll_interval)
+
+    async def submit(self, path: Path) -> None:
+        """先把文件移到 .processed 再保存到上传目录、提交识别任务，
+        移动失败时不会提交，文件留在扫描文件夹里也不会被重复识别
+        """
+        processed = await asyncio.to_thread(
+            move_to, path, self.directory / PROCESSED_DIR_NAME
+        )
+        try:
+            file_content = await asyncio.to_thread(processed.read_bytes)
+            stored_name = await asyncio.to_thread(
+                save_upload_file, path.name, file_content
+            )
+            await self.queue.submit(
+                WATCH_BATCH_ID, self.mode, [(path.name, stored_name)]
+            )
+        except StorageQuotaError:
+            # 移回扫描文件夹，清理出空间后重新提交
+            await asyncio.to_thread(processed.replace, path)
+            raise
+        except Exception:
+            await asyncio.to_thread(
+                move_to, processed, self.directory / FAILED_DIR_NAME
+            )
+            raise
+        self.submitted += 1
+
+    async def _submit_loop(self) -> None:
+        while True:
+            path = await self._ready.get()
+            try:
+                await self._wait_for_capacity()
+                await self.submit(path)
+                logger.info(f"扫描文件「{path.name}」已提交识别")
+            except FileNotFoundError:
+                logger.info(f"扫描文件「{path.name}」已经被移走")
+            except StorageQuotaError as e:
+                # 文件留在扫描文件夹里，清理出空间后重新提交
+                logger.error(f"扫描文件「{path.name}」暂时不能提交：{e}")
+                await asyncio.sleep(self.poll_interval)
+            except Exception as e:
+                logger.error(f"扫描文件「{path.name}」提交失败：{e}")
+            finally:
+                self._queued.discard(path)
+
+    async def run(self) -> None:
+        """持续监听文件夹，多个进程同时运行时只有取得租约的进程监听"""
+        await self.queue.run_exclusive(WATCH_LEASE_NAME, self._watch)
+
+    async def _watch(self) -> None:
+        # 之前失去过租约时，其他进程可能已经提交了这些文件，重新扫描
+        self._observed = {}
+        self._queued = set()
+        self._ready = asyncio.Queue(QUEUE_SIZE)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        logger.info(
+            f"开始监听扫描文件夹「{self.directory}」",
+            extra={"mode": self.mode, "max_pending": self.max_pending},
+        )
+        await asyncio.gather(self._scan_loop(), self._submit_loop())
+
+
+async def watch_folder() -> None:
+    """按 WATCH_DIR 配置监听扫描文件夹，没有配置时直接返回"""
+    if settings.watch_dir:
+        await FolderWatcher(Path(settings.watch_dir)).run()
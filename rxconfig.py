@@ -11,7 +11,10 @@ config = rx.Config(
     app_name="easy_finance",
     loglevel="info",
     api_url=api_url,
-    db_url="sqlite:///reflex.db",
+    # 默认使用 SQLite，多人使用时可以换成 PostgreSQL，见 easy_finance/db.py
+    db_url=os.getenv("DB_URL", "sqlite:///reflex.db"),
+    # 部署多个后端进程时需要配置 Redis，所有进程共享 state、OCR 限流和缓存，见 easy_finance/utils/shared_store.py
+    redis_url=os.getenv("REDIS_URL"),
     tailwind={
         "theme": {
             "extend": {},